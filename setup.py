@@ -9,6 +9,8 @@ import sys
 # python setup.py clean --all build_ext --inplace
 # To just build, without clean:
 # python setup.py build_ext --inplace
+# To build with rollout profiling counters (see Rollout_Profiling.pxd), set CAR_PROFILE=1 and rebuild with --force:
+# CAR_PROFILE=1 python setup.py build_ext --inplace --force
 
 # Search for all .pyx files in subdirectories
 pyx_files = glob.glob('**/*.pyx', recursive=True)
@@ -24,6 +26,7 @@ extensions = [
         name=filepath_to_modulename(pyx_file),
         sources=[pyx_file],
         extra_compile_args=["/Ox"],
+        define_macros=[("CAR_PROFILE", "1")] if os.environ.get("CAR_PROFILE") == "1" else [],
     ) for pyx_file in pyx_files
 ]
 
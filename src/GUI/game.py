@@ -1,14 +1,65 @@
 import math
 import time
+from pathlib import Path
 
 from PySide6.QtCore import QRectF, Qt, QTimer
-from PySide6.QtGui import QColor, QFont, QPainter, QPixmap
+from PySide6.QtGui import QColor, QFont, QPainter, QPixmap, QTransform
 from PySide6.QtWidgets import QWidget, QLabel, QVBoxLayout, QHBoxLayout, QPushButton, QSpacerItem, QSizePolicy
 
 from src.GUI.styles import BUTTON_STYLE
 from src.car_simulator.car_cython import CarDrawInfo
 from src.game_control.constants import FPS
 from src.game_control.game_controller import GameController
+from src.game_control.simulation_runner import SimulationRunner
+
+# Qt keys of player's car controls, named as keys of InputState
+QT_KEY_NAMES = {
+    Qt.Key_Up: "up",
+    Qt.Key_Down: "down",
+    Qt.Key_Left: "left",
+    Qt.Key_Right: "right",
+    Qt.Key_W: "w",
+    Qt.Key_S: "s",
+    Qt.Key_A: "a",
+    Qt.Key_D: "d",
+    Qt.Key_Space: "space",
+}
+SPRITE_ANGLES = 360  # number of pre-rendered rotations of each car image, i.e. 1 degree step
+
+
+class RotatedPixmapCache:
+    """
+    Car image scaled to car dimensions and pre-rendered at SPRITE_ANGLES angles with smooth transformation,
+    so drawing a car is one plain drawPixmap of the nearest rotation, without transforming painter
+    """
+    def __init__(self, image: QPixmap, width: float, height: float, angles: int = SPRITE_ANGLES):
+        scaled = image.scaled(round(height), round(width), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        self.angle_step = 360 / angles
+        # painter y axis points down, so positive (counter-clockwise) car angle is negative rotation
+        self.pixmaps = [
+            scaled.transformed(QTransform().rotate(-i * self.angle_step), Qt.SmoothTransformation)
+            for i in range(angles)
+        ]
+
+    def get(self, angle_radians: float) -> QPixmap:
+        return self.pixmaps[round(math.degrees(angle_radians) / self.angle_step) % len(self.pixmaps)]
+
+
+_pixmap_caches: dict[tuple[str, float, float], RotatedPixmapCache] = {}
+
+
+def get_rotated_pixmap_cache(image: Path, width: float, height: float) -> RotatedPixmapCache:
+    """
+    Cars with the same image and dimensions share one cache, also between games
+    :param image: path of car image
+    :param width:
+    :param height:
+    :return:
+    """
+    key = (str(Path(image).resolve()), width, height)
+    if key not in _pixmap_caches:
+        _pixmap_caches[key] = RotatedPixmapCache(QPixmap(str(image)), width, height)
+    return _pixmap_caches[key]
 
 
 class GamePage(QWidget):
@@ -18,27 +69,53 @@ class GamePage(QWidget):
         self.main_window = main_window
         self.game_running = False
         self.game_frozen = False
+        self.is_replay = False
+        self.runner = None
+        self.setFocusPolicy(Qt.StrongFocus)
         self.initUI()
 
-        # Update the widget periodically based on the simulation
+        # Redraw the widget periodically, simulation runs in its own thread (SimulationRunner)
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.update_data)
         self.timer.start(1000 // 60)  # Update at 60 FPS
 
     def start_game(self):
         self.simulation = self.game_controller.create_game_simulation()
+        self.is_replay = False
+        self._start(self.game_controller.get_map_image())
+
+    def start_replay(self, file_path: Path):
+        self.simulation, map_image = self.game_controller.create_replay_simulation(file_path)
+        self.is_replay = True
+        self._start(map_image)
+
+    def _start(self, map_image: Path):
         self.cars = self.simulation.cars_ai + [self.simulation.cars_players[0]]
-        self.cars_images = [QPixmap(car.image) for car in self.cars]
+        cars_info = [car.get_car_draw_info() for car in self.cars]
+        self.cars_sprites = [
+            get_rotated_pixmap_cache(car.image, car_info.width, car_info.height)
+            for car, car_info in zip(self.cars, cars_info)
+        ]
         self.car_names = [car.name for car in self.cars]
-        self.map_pixmap = QPixmap(self.game_controller.get_map_image())
+        self.map_pixmap = QPixmap(map_image)
         self.game_running = True
         self.game_frozen = False
+        self.game_controller.input_state.clear()
+        self.setFocus()  # player's keys are read from key events of this widget
+        self._start_runner()
         self.update_data()
 
+    def _start_runner(self):
+        if self.runner is not None:
+            self.runner.stop()
+        self.runner = SimulationRunner(self.simulation, self.cars)
+        self.runner.start()
+
     def resume_game(self):
         if self.game_frozen and not self.game_running:
             self.game_frozen = False
             self.game_running = True
+            self._start_runner()
             self.update_data()
         else:
             self.start_game()
@@ -54,6 +131,7 @@ class GamePage(QWidget):
         button_container = QVBoxLayout()
         self.menu_button = QPushButton("Menu")
         self.menu_button.setStyleSheet(BUTTON_STYLE)
+        self.menu_button.setFocusPolicy(Qt.NoFocus)  # keys (e.g. space) go to the game, not to the button
         self.menu_button.clicked.connect(self._stop_game)
         button_container.addWidget(self.menu_button)
         button_container.addSpacerItem(QSpacerItem(0, 0, QSizePolicy.Minimum, QSizePolicy.Expanding))
@@ -94,37 +172,43 @@ class GamePage(QWidget):
         self.setLayout(main_layout)
 
     def _stop_game(self):
+        if not self.game_running:  # e.g. Escape pressed again while game is frozen or after it finished
+            return
         self.game_running = False
         self.game_frozen = True
+        self.runner.stop()
+        self.game_controller.save_replay(self.simulation)
         self.main_window.game_brake(self.cars)
 
     def _finish_game(self):
+        if not self.game_running:
+            return
         self.game_running = False
         self.game_frozen = False
+        self.runner.stop()
+        self.game_controller.save_replay(self.simulation)
         self.main_window.game_finish(self.cars)
 
     def update_data(self):
         if self.game_running:
-            # Fetch updated simulation data
-            time_left = (self.game_controller.map_max_timesteps - self.simulation.current_timestep) / FPS
-            laps = self.cars[-1].get_laps()
+            # Fetch the latest snapshot published by simulation thread
+            snapshot = self.runner.snapshot
+            time_left = (self.simulation.max_timesteps - snapshot.timestep) / FPS
+            laps = list(snapshot.player_laps)
 
-            if len(laps) < self.game_controller.map_laps:
-                # Update the simulation
-                laps.append(self.simulation.current_timestep)
+            if len(laps) < self.cars[-1].max_laps:
+                laps.append(snapshot.timestep)
             laps = map(lambda x: x / FPS, laps)
 
             # Update labels
-            self.time_left_label.setText(f"Time left: {time_left:.2f}")
+            self.time_left_label.setText(f"Time left: {time_left:.2f}" + (f"\nReplay speed: {self.simulation.speed:g}x" if self.is_replay else ""))
             self.laps_label.setText("Laps:\n" + "\n".join(f"{i + 1}: {lap:.2f}" for i, lap in enumerate(laps)))
 
             # Redraw the widget
             self.update()
 
-            if self.simulation.is_finished():
+            if snapshot.finished:
                 self._finish_game()
-            else:
-                self.simulation.step()
 
     def paintEvent(self, event):
         painter = QPainter(self)
@@ -138,23 +222,22 @@ class GamePage(QWidget):
         half_view_width = view_width // 2
         half_view_height = view_height // 2
 
-        cars_info = [car.get_car_draw_info() for car in self.cars]
-        center_x = cars_info[-1].x
-        center_y = cars_info[-1].y
+        cars_info = self.runner.snapshot.interpolated_cars(time.perf_counter())
+        center_x = round(cars_info[-1].x)
+        center_y = round(cars_info[-1].y)
 
         # Ensure the view does not go out of map boundaries
         crop_x = max(0, min(map_rect.width() - view_width, center_x - half_view_width))
         crop_y = max(0, min(map_rect.height() - view_height, center_y - half_view_height))
 
-        # Crop and draw the map
-        cropped_map = self.map_pixmap.copy(crop_x, crop_y, view_width, view_height)
-        painter.drawPixmap(0, 0, cropped_map)
+        # Draw visible part of the map directly from the source rect, no viewport-sized pixmap is allocated per frame
+        painter.drawPixmap(0, 0, self.map_pixmap, crop_x, crop_y, view_width, view_height)
 
         # Draw the cars
-        for car_info, image, name in zip(cars_info, self.cars_images, self.car_names):
-            self.draw_car(painter, car_info, image, name, crop_x, crop_y)
+        for car_info, sprites, name in zip(cars_info, self.cars_sprites, self.car_names):
+            self.draw_car(painter, car_info, sprites, name, crop_x, crop_y)
 
-    def draw_car(self, painter, car_info: CarDrawInfo, car_image, car_name, crop_x: int, crop_y: int):
+    def draw_car(self, painter, car_info: CarDrawInfo, car_sprites: RotatedPixmapCache, car_name, crop_x: int, crop_y: int):
         # Calculate car position relative to the cropped view
         car_x = car_info.x - crop_x
         car_y = car_info.y - crop_y
@@ -182,11 +265,10 @@ class GamePage(QWidget):
         painter.setFont(QFont('Arial', 10, QFont.Bold))
         painter.drawText(text_rect, Qt.AlignCenter, car_name)
 
-        # Move and rotate the painter to draw the car
-        painter.rotate(math.degrees(-car_info.angle_radians))
-
+        # Draw pre-rendered rotation of the car centered at its position
+        car_image = car_sprites.get(car_info.angle_radians)
         painter.setOpacity(pulsing_opacity)  # Adjust opacity based on inactive ratio
-        painter.drawPixmap(-car_height / 2, -car_width / 2, car_height, car_width, car_image)
+        painter.drawPixmap(round(-car_image.width() / 2), round(-car_image.height() / 2), car_image)
 
         # Restore painter state
         painter.restore()
@@ -216,7 +298,26 @@ class GamePage(QWidget):
         return rankings
 
     def keyPressEvent(self, event):
-        if event.key() == Qt.Key_Escape:
+        if event.key() in QT_KEY_NAMES:
+            if not event.isAutoRepeat():
+                self.game_controller.input_state.press(QT_KEY_NAMES[event.key()])
+        elif event.key() == Qt.Key_Escape:
             self._stop_game()
+        elif self.is_replay and event.key() in (Qt.Key_Plus, Qt.Key_Equal):
+            self.simulation.speed = min(self.simulation.speed * 2, 64.0)
+        elif self.is_replay and event.key() == Qt.Key_Minus:
+            self.simulation.speed = max(self.simulation.speed / 2, 1 / 16)
         else:
             super().keyPressEvent(event)
+
+    def keyReleaseEvent(self, event):
+        if event.key() in QT_KEY_NAMES:
+            if not event.isAutoRepeat():
+                self.game_controller.input_state.release(QT_KEY_NAMES[event.key()])
+        else:
+            super().keyReleaseEvent(event)
+
+    def focusOutEvent(self, event):
+        # release events do not come when window is not focused
+        self.game_controller.input_state.clear()
+        super().focusOutEvent(event)
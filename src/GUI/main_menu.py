@@ -1,8 +1,11 @@
+from pathlib import Path
+
 from PySide6.QtGui import QFont, Qt, QPixmap, QPainter
 from PySide6.QtWidgets import QWidget, QVBoxLayout, QFormLayout, QLabel, QComboBox, QPushButton, QSpacerItem, \
-    QSizePolicy
+    QSizePolicy, QFileDialog
 
 from src.GUI.styles import BUTTON_STYLE, MAIN_MENU_BACKGROUND, WidgetBackgroundImage
+from src.game_control.constants import REPLAYS_DIR
 from src.game_control.game_controller import GameController
 
 
@@ -42,6 +45,11 @@ class MainMenuWidget(WidgetBackgroundImage):
         play_button.clicked.connect(self.play_game)
         self.layout().addWidget(play_button, stretch=1)
 
+        replay_button = QPushButton("Watch Replay")
+        replay_button.setStyleSheet(BUTTON_STYLE)
+        replay_button.clicked.connect(self.watch_replay)
+        self.layout().addWidget(replay_button, stretch=1)
+
         # Spacer
         spacer_bottom = QSpacerItem(20, 40, QSizePolicy.Minimum, QSizePolicy.Expanding)
         self.layout().addItem(spacer_bottom)
@@ -54,3 +62,8 @@ class MainMenuWidget(WidgetBackgroundImage):
 
     def play_game(self):
         self.main_menu.play_game()
+
+    def watch_replay(self):
+        file_path, _ = QFileDialog.getOpenFileName(self, "Choose Replay", str(REPLAYS_DIR), "Replays (*.npz)")
+        if file_path:
+            self.main_menu.watch_replay(Path(file_path))
@@ -1,3 +1,5 @@
+from pathlib import Path
+
 from PySide6.QtWidgets import QMainWindow, QStackedWidget
 
 from src.GUI.game import GamePage
@@ -47,6 +49,10 @@ class MainWindow(QMainWindow):
         self.game_page.start_game()
         self.stacked_widget.setCurrentWidget(self.game_page)
 
+    def watch_replay(self, file_path: Path):
+        self.game_page.start_replay(file_path)
+        self.stacked_widget.setCurrentWidget(self.game_page)
+
     def resume_game(self):
         self.game_page.resume_game()
         self.stacked_widget.setCurrentWidget(self.game_page)
@@ -1,8 +1,8 @@
 import dataclasses
 import math
-from libc.math cimport cos, sin, pi
 import cython
 import numpy as np
+from src.car_training.Environments.Car_Physics.Car_Physics cimport Car_Physics
 # from src.car_simulator.car_python import CarDrawInfo
 
 @dataclasses.dataclass
@@ -16,11 +16,8 @@ class CarDrawInfo:
 
 
 cdef class CarCython:
-    cdef unsigned char [:, ::1] map_view
-    cdef float x, y, angle, speed, max_speed, min_speed, acceleration, turn_speed
-    cdef float width, height
-    cdef float distance_center_corner
-    cdef float angle_to_corner
+    cdef Car_Physics physics
+    cdef float acceleration, turn_speed
     cdef float rays_distances_scale_factor
     cdef float ray_input_clip
     cdef float[::1] rays_degrees
@@ -41,29 +38,26 @@ cdef class CarCython:
                  height: float,
                  rays_distances_scale_factor: float,
                  ray_input_clip: float,
-                 rays_degrees: list[float] | tuple[float] | np.ndarray) -> None:
-        self.x = x
-        self.y = y
-        self.angle = math.radians(start_angle)
-        self.speed = 0.0
-        self.max_speed = max_speed
-        self.min_speed = min_speed
+                 rays_degrees: list[float] | tuple[float] | np.ndarray,
+                 wall_normals: np.ndarray | None = None,
+                 coarse_map: np.ndarray | None = None) -> None:
+        # the same physics as training environment, but in radians with exact trig
+        # wall_normals (compute_wall_normals of map_view) make collision resolution O(1)
+        # coarse_map (compute_coarse_map of map_view) lets rays jump over open space
+        self.physics = Car_Physics(
+            map_view, (x, y), math.radians(start_angle), (width, height), 0.0, min_speed, max_speed,
+            use_degrees=False, wall_normals=wall_normals, coarse_map=coarse_map,
+        )
         self.acceleration = acceleration
         self.turn_speed = math.radians(turn_speed)
         self.inactive_steps = inactive_steps if inactive_steps > 0 else 1
         self.rays_degrees = np.array(
             [math.radians(ray) for ray in rays_degrees], dtype=np.float32
         )
-        self.map_view = map_view
-        self.width = width
-        self.height = height
         self.rays_distances_scale_factor = rays_distances_scale_factor
         self.ray_input_clip = ray_input_clip
         self.current_inactive_steps = 0
 
-        self.distance_center_corner = math.sqrt((self.width / 2) ** 2 + (self.height / 2) ** 2)
-        self.angle_to_corner = math.atan2(self.width / 2, self.height / 2)
-
         self.react(0.0, 0.0)
 
     @cython.boundscheck(False)
@@ -73,176 +67,45 @@ cdef class CarCython:
         cdef float[::1] state_here = np.empty(self.rays_degrees.shape[0] + 1, dtype=np.float32)
 
         for i in range(self.rays_degrees.shape[0]):
-            state_here[i] = self._get_ray_distance(rays_degrees_here[i]) / self.rays_distances_scale_factor
+            state_here[i] = self.physics.get_ray_distance(rays_degrees_here[i]) / self.rays_distances_scale_factor
             if state_here[i] > self.ray_input_clip:
                 state_here[i] = self.ray_input_clip
 
-        state_here[state_here.shape[0] - 1] = self.speed / self.max_speed
+        state_here[state_here.shape[0] - 1] = self.physics.speed / self.physics.max_speed
 
         return np.array(state_here, dtype=np.float32, copy=False)
 
     def get_draw_info(self) -> CarDrawInfo:
-        return CarDrawInfo(round_to_int(self.x), round_to_int(self.y), self.angle, self.width, self.height, self.get_inactive_ratio())
+        return CarDrawInfo(round_to_int(self.physics.x), round_to_int(self.physics.y), self.physics.angle, self.physics.width, self.physics.height, self.get_inactive_ratio())
 
     def get_position(self) -> tuple[float, float]:
-        return self.x, self.y
-
-    @cython.boundscheck(False)
-    @cython.wraparound(False)
-    cdef double _get_ray_distance(self, double ray_angle):
-        cdef unsigned char [:, ::1] map_view_here = self.map_view
-        cdef double x = self.x
-        cdef double y = self.y
-        cdef double distance = 0
-        cdef int check_x, check_y
-        cdef double angle = self.angle + ray_angle
-        cdef double sin_angle = sin(angle)
-        cdef double cos_angle = cos(angle)
-
-        check_x = round_to_int(x)
-        check_y = round_to_int(y)
-
-        while check_x >= 0 and check_x < map_view_here.shape[1] and check_y >= 0 and check_y < map_view_here.shape[0] and map_view_here[check_y, check_x] == 0:
-            x += cos_angle
-            y -= sin_angle
-            distance += 1
-            check_x = round_to_int(x)
-            check_y = round_to_int(y)
-
-        return distance
-
+        return self.physics.x, self.physics.y
 
     def react(self, float engine, float steering) -> None:
-        engine = max(-1.0, min(1.0, engine))
         steering = max(-1.0, min(1.0, steering))
-
-        # Wheel traction
-        cdef float traction = self.speed / self.max_speed
-        engine -= traction
-
-        self.speed += engine * self.acceleration
-        self.speed = max(self.min_speed, min(self.max_speed, self.speed))
-        self.angle += steering * self.turn_speed
-        if self.angle > 2 * pi:
-            self.angle -= 2 * pi
-        elif self.angle < 0:
-            self.angle += 2 * pi
+        self.physics.apply_engine(engine, self.acceleration)
+        self.physics.change_angle(steering * self.turn_speed)
 
     def get_speed(self) -> float:
-        return self.speed
+        return self.physics.speed
 
     def stop(self) -> None:
-        self.speed = 0.0
+        self.physics.speed = 0.0
 
     def step(self) -> None:
         if self.current_inactive_steps > 0:
             self.current_inactive_steps -= 1
         else:
-            self.x += self.speed * cos(self.angle)
-            self.y -= self.speed * sin(self.angle)
-            if self._does_collide():
-                self._fix_collision()
+            self.physics.move()
+            if self.physics.does_collide():
+                self.physics.fix_collision()
                 self.current_inactive_steps = self.inactive_steps
-                self.speed = 0.0
+                self.physics.speed = 0.0
                 self.react(0.0, 0.0)
 
     def get_inactive_ratio(self) -> float:
         return self.current_inactive_steps / (<float> self.inactive_steps)
 
-
-    @cython.boundscheck(False)
-    @cython.wraparound(False)
-    cdef void _fix_collision(self):
-        # get angle of the wall by checking many angles around current position of the car
-        cdef float[::1] angles = np.linspace(0, 2 * pi, 90, endpoint=False, dtype=np.float32)
-        cdef unsigned char [::1] collisions = np.empty(angles.shape[0], dtype=np.uint8)
-        cdef float checked_distance = self.distance_center_corner * 1.5
-        cdef int i
-        for i in range(angles.shape[0]):
-            collisions[i] = self._does_collide_one(checked_distance, angles[i])
-
-        # get index of start and end of the longest sequence of collisions
-        cdef int start = 0
-        cdef int end = 0
-        cdef int current_start = 0
-        cdef int current_end = 0
-        cdef int max_length = 0
-        cdef int current_length = 0
-        cdef int current_index
-        for current_index in range(collisions.shape[0] * 2):
-            current_index = current_index % collisions.shape[0]
-            if collisions[current_index] == 1:
-                if current_length == 0:
-                    current_start = current_index
-                current_length += 1
-                current_end = current_index
-            else:
-                if current_length > max_length:
-                    max_length = current_length
-                    start = current_start
-                    end = current_end
-                current_length = 0
-
-        # get angle of the wall
-        cdef float angle_between = angles[end] - angles[start]
-        if angle_between < 0:
-            angle_between += 2 * pi
-        if angle_between > pi:
-            angle_between = 2 * pi - angle_between
-
-        cdef float perpendicular_wall_angle = (angles[start] + angle_between / 2)
-        cdef float wall_angle = perpendicular_wall_angle + pi / 2
-        if wall_angle > 2 * pi:
-            wall_angle -= 2 * pi
-
-        # check if I should set the angle to the wall angle or to the opposite angle
-        cdef float angle_diff = abs(self.angle - wall_angle)
-        if angle_diff > pi / 2 and angle_diff < 3 / 2 * pi:
-            wall_angle -= pi
-        self.angle = wall_angle
-
-        # calculate distance from current car position to the wall
-        cdef float move_distance = 0.2 * self.width # - self.distance_center_corner * cos(angle_between / 2)
-        cdef bint end_trigger = False
-        perpendicular_wall_angle -= pi
-
-        for i in range(10):
-            if not self._does_collide():
-                end_trigger = True
-            self.x += move_distance * cos(perpendicular_wall_angle)
-            self.y -= move_distance * sin(perpendicular_wall_angle)
-
-            if end_trigger:
-                break
-
-        # finished :)
-
-
-
-    cdef bint _does_collide(self):
-        return (self._does_collide_one(self.distance_center_corner, self.angle - self.angle_to_corner) or
-                self._does_collide_one(self.distance_center_corner, self.angle + self.angle_to_corner) or
-                self._does_collide_one(self.distance_center_corner, pi + self.angle - self.angle_to_corner) or
-                self._does_collide_one(self.distance_center_corner, pi + self.angle + self.angle_to_corner) or
-                self._does_collide_one(self.width / 2, self.angle + pi/2) or
-                self._does_collide_one(self.width / 2, self.angle - pi/2) or
-                self._does_collide_one(self.height / 2, self.angle) or
-                self._does_collide_one(self.height / 2, self.angle + pi))
-    @cython.initializedcheck(False)
-    @cython.boundscheck(False)
-    @cython.wraparound(False)
-    cdef bint _does_collide_one(self, double distance, double angle):
-        cdef int check_x, check_y
-        check_x = round_to_int(self.x + distance * cos(angle))
-        check_y = round_to_int(self.y - distance * sin(angle))
-
-        if check_x < 0 or check_x >= self.map_view.shape[1]:
-            return True
-        if check_y < 0 or check_y >= self.map_view.shape[0]:
-            return True
-
-        return self.map_view[check_y, check_x] == 1
-
 cdef inline int round_to_int(double value):
     """
     Round the given value to the nearest integer.
@@ -251,16 +114,35 @@ cdef inline int round_to_int(double value):
 
 def check_crossed_line(line: tuple[tuple[int, int], tuple[int, int]], previous_position: tuple[float, float],
                        current_position: tuple[float, float]) -> bool:
-    cdef float x1, y1, x2, y2
-    cdef float x3, y3, x4, y4
-    cdef float denom, ua, ub
-
-    # Unpack line endpoints
     (x1, y1), (x2, y2) = line
-
-    # Unpack positions
     x3, y3 = previous_position
     x4, y4 = current_position
+    return crossed_line(x1, y1, x2, y2, x3, y3, x4, y4)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def check_crossed_lines(double[:, ::1] lines, double[:, ::1] previous_positions, double[:, ::1] current_positions) -> np.ndarray:
+    """
+    Batched check_crossed_line, all segments are checked in one nogil loop
+    :param lines: (n, 4) - x1, y1, x2, y2 of checked line of each segment
+    :param previous_positions: (n, 2) - x, y
+    :param current_positions: (n, 2) - x, y
+    :return: bool (n,) - True if segment from previous to current position crosses its line
+    """
+    cdef Py_ssize_t n = lines.shape[0]
+    cdef Py_ssize_t i
+    result = np.zeros(n, dtype=np.uint8)
+    cdef unsigned char[::1] result_here = result
+    with nogil:
+        for i in range(n):
+            result_here[i] = crossed_line(
+                lines[i, 0], lines[i, 1], lines[i, 2], lines[i, 3],
+                previous_positions[i, 0], previous_positions[i, 1], current_positions[i, 0], current_positions[i, 1],
+            )
+    return result.view(np.bool_)
+
+cdef inline bint crossed_line(float x1, float y1, float x2, float y2, float x3, float y3, float x4, float y4) noexcept nogil:
+    cdef float denom, ua, ub
 
     # Check if the previous and current positions are the same
     if x3 == x4 and y3 == y4:
@@ -1,13 +1,15 @@
 import dataclasses
+import math
 import time
 from abc import ABC, abstractmethod
 from pathlib import Path
 from typing import Any, Literal
 
-import keyboard
 import numpy as np
 
-from src.car_simulator.car_cython import CarCython, check_crossed_line, CarDrawInfo
+from src.car_simulator.input_state import InputState
+from src.car_simulator.car_cython import CarCython, check_crossed_line, check_crossed_lines, CarDrawInfo
+from src.car_training.Environments_Visualization.Episode_Recorder import Episode_Recorder, Episode
 from src.car_training.Neural_Network.Raw_Numpy.Raw_Numpy_Models.Normal.Normal_model import Normal_model
 
 Line = tuple[tuple[int, int], tuple[int, int]]
@@ -26,6 +28,7 @@ class CarWrapper(ABC):
     time_counter: int
     max_laps: int
     distance: float
+    last_action: tuple[float, float]
 
     def __init__(self, car_init_data: dict[str, Any], end_line: Line, false_end_line: Line, start_before_end_line: bool, max_laps: int, name: str, image: Path):
         self.car = CarCython(**car_init_data)
@@ -41,6 +44,7 @@ class CarWrapper(ABC):
         self.time_counter = 0
         self.max_laps = max_laps
         self.distance = 0.0
+        self.last_action = (0.0, 0.0)
 
     def get_car_draw_info(self) -> CarDrawInfo:
         return self.car.get_draw_info()
@@ -48,6 +52,13 @@ class CarWrapper(ABC):
     def get_car_name(self) -> str:
         return self.name
 
+    def get_pose(self) -> tuple[float, float, float]:
+        """
+        :return: x, y, angle in radians
+        """
+        x, y = self.car.get_position()
+        return x, y, self.car.get_draw_info().angle_radians
+
     def get_car_image(self) -> Path:
         return self.image
 
@@ -59,7 +70,11 @@ class CarWrapper(ABC):
         """
         pass
 
-    def step(self):
+    def step(self, update_laps: bool = True) -> bool:
+        """
+        :param update_laps: False - caller updates laps itself, e.g. GameSimulation checks lines of all cars at once
+        :return: True if the car was active and moved in this step (its laps should be updated)
+        """
         self.time_counter += 1
 
         if self.car.get_inactive_ratio() == 0.0:
@@ -73,10 +88,15 @@ class CarWrapper(ABC):
                     engine = -1.0
             self.car.react(engine, steering)
             self.car.step()
-            self._laps_calculations()
+            if update_laps:
+                self._laps_calculations()
             self.distance += self.car.get_speed()
+            self.last_action = (engine, steering)
+            return True
         else:
             self.car.step()
+            self.last_action = (0.0, 0.0)
+            return False
 
     def get_laps(self) -> list[int]:
         return self._laps.copy()
@@ -86,8 +106,14 @@ class CarWrapper(ABC):
 
     def _laps_calculations(self) -> None:
         new_position = self.car.get_position()
+        self._update_laps(
+            check_crossed_line(self.end_line, self.previous_position, new_position),
+            check_crossed_line(self.false_end_line, self.previous_position, new_position),
+        )
+        self.previous_position = new_position
 
-        if check_crossed_line(self.end_line, self.previous_position, new_position):
+    def _update_laps(self, crossed_end_line: bool, crossed_false_end_line: bool) -> None:
+        if crossed_end_line:
             if self.start_before_end_line:
                 self.start_before_end_line = False
                 self.false_end_line_balance = -1
@@ -98,14 +124,12 @@ class CarWrapper(ABC):
                 self.false_end_line_balance = -1
             elif self.end_line_balance < 0:
                 self.end_line_balance += 1
-        if check_crossed_line(self.false_end_line, self.previous_position, new_position):
+        if crossed_false_end_line:
             if self.false_end_line_balance < 0:
                 self.false_end_line_balance += 1
             elif self.false_end_line_balance == 0:
                 self.false_end_line_balance -= 1
 
-        self.previous_position = new_position
-
     def __gt__(self, other):
         if not isinstance(other, CarWrapper):
             return NotImplemented
@@ -121,23 +145,29 @@ class CarWrapper(ABC):
 
 
 class CarPlayerWrapper(CarWrapper):
+    input_state: InputState
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, input_state: InputState, *args, **kwargs):
+        """
+        :param input_state: keys held by the player, fed by GUI events
+        """
         super().__init__(*args, **kwargs)
+        self.input_state = input_state
         self._previous_steering_action = 0.0
         self._steering_value = 0.0
 
     def react(self) -> tuple[float, float]:
+        keys = self.input_state
         engine = 0.0
         steering = 0.0
-        if keyboard.is_pressed('up') or keyboard.is_pressed('w') or keyboard.is_pressed('space'):
+        if keys.is_pressed('up') or keys.is_pressed('w') or keys.is_pressed('space'):
             engine = 1.0
-        elif keyboard.is_pressed('down') or keyboard.is_pressed('s'):
+        elif keys.is_pressed('down') or keys.is_pressed('s'):
             engine = -1.0
 
-        if keyboard.is_pressed('right') or keyboard.is_pressed('d'):
+        if keys.is_pressed('right') or keys.is_pressed('d'):
             steering = -1.0
-        elif keyboard.is_pressed('left') or keyboard.is_pressed('a'):
+        elif keys.is_pressed('left') or keys.is_pressed('a'):
             steering = 1.0
         if steering != self._previous_steering_action:
             self._steering_value = 0.11
@@ -151,33 +181,53 @@ class CarPlayerWrapper(CarWrapper):
 class CarAIWrapper(CarWrapper):
     model: Normal_model
     random_action_prob: float
+    pending_action: tuple[float, float] | None
 
     def __init__(self,
-                 neural_network_structure: dict[str, Any],
-                 neural_network_params: dict[str, Any],
+                 model: Normal_model,
                  random_action_prob: float,
                  *args,
                  **kwargs):
+        """
+        :param model: network controlling the car, cars with the same weights should get the same model,
+        so GameSimulation evaluates all of them in one batched forward pass
+        :param random_action_prob: probability of random action in each step
+        """
         super().__init__(*args, **kwargs)
-        self.model = Normal_model(**neural_network_structure)
-        self.model.set_parameters(neural_network_params)
+        self.model = model
         self.random_action_prob = random_action_prob
+        self.pending_action = None
 
     def react(self) -> tuple[float, float]:
-        nn_input = np.array(self.car.nn_state().reshape(1, -1), dtype=np.float32)
-
-        if np.random.rand() < self.random_action_prob:
-            nn_output = np.random.uniform(-1.0, 1.0, 4)
-        else:
-            nn_output = self.model.p_forward_pass(nn_input)[0]
-
-        max_index = np.argmax(nn_output[:3])
-        steering = 0.0
-        match max_index:
-            case 1:
-                steering = 1.0
-            case 2:
-                steering = -1.0
+        if self.pending_action is None:
+            react_ai_cars([self])
+        action = self.pending_action
+        self.pending_action = None
+        return action
+
+
+def react_ai_cars(cars: list[CarAIWrapper]) -> None:
+    """
+    Computes actions of AI cars and sets their pending_action, which is returned by their next react()
+    cars with the same model are evaluated in one forward pass on stacked nn_states, so cost per frame
+    depends on number of distinct models rather than number of cars
+    :param cars: AI cars that will react in this step
+    :return:
+    """
+    cars_by_model: dict[int, list[CarAIWrapper]] = {}
+    for car in cars:
+        cars_by_model.setdefault(id(car.model), []).append(car)
+
+    for model_cars in cars_by_model.values():
+        nn_input = np.stack([car.car.nn_state() for car in model_cars])
+        nn_output = model_cars[0].model.p_forward_pass(nn_input)
+
+        random_actions = np.random.rand(len(model_cars)) < np.array([car.random_action_prob for car in model_cars])
+        if random_actions.any():
+            nn_output[random_actions] = np.random.uniform(-1.0, 1.0, (np.count_nonzero(random_actions), nn_output.shape[1]))
+
+        # argmax of the first 3 outputs: 0 - straight, 1 - left, 2 - right
+        steering = np.array([0.0, 1.0, -1.0])[np.argmax(nn_output[:, :3], axis=1)]
 
         # max_index_engine = np.argmax(nn_output[3:])
         # engine = 0.0
@@ -186,9 +236,19 @@ class CarAIWrapper(CarWrapper):
         #         engine = 1.0
         #     case 1:
         #         engine = -1.0
-        engine = nn_output[3]
+        engine = nn_output[:, 3]
 
-        return engine, steering
+        for car, car_engine, car_steering in zip(model_cars, engine.tolist(), steering.tolist()):
+            car.pending_action = (car_engine, car_steering)
+
+
+@dataclasses.dataclass
+class RaceResult:
+    names: list[str]
+    laps: list[list[int]]  # timestep of each finished lap
+    distances: list[float]
+    ranking: list[int]  # indices of cars, the best one first, the same order as ranking page
+    timesteps: int
 
 
 class GameSimulation:
@@ -196,6 +256,7 @@ class GameSimulation:
     cars_players: list[CarWrapper]
     max_timesteps: int
     current_timestep: int
+    recorder: Episode_Recorder | None
 
     def __init__(self,
                  cars_ai: list[CarAIWrapper],
@@ -207,13 +268,180 @@ class GameSimulation:
 
         self.cars_ai = cars_ai
         self.cars_players = cars_players
+        self.recorder = None
+
+        # end_line and false_end_line of each car, (2 * cars, 4), used by batched lap checks
+        cars = self.cars_ai + self.cars_players
+        self._lines = np.array(
+            [(*car.end_line[0], *car.end_line[1]) for car in cars] + [(*car.false_end_line[0], *car.false_end_line[1]) for car in cars],
+            dtype=np.float64,
+        ).reshape(-1, 4)
+
+    def start_recording(self, metadata: dict[str, Any]) -> None:
+        """
+        Starts recording of poses, actions (engine, steering) and rewards (distance driven in step) of all cars
+        :param metadata: json-serializable data saved with episode, e.g. map
+        :return:
+        """
+        cars = self.cars_ai + self.cars_players
+        self.recorder = Episode_Recorder(
+            np.array([car.get_pose() for car in cars]),
+            angle_period=2 * math.pi,
+            metadata={
+                **metadata,
+                "names": [car.name for car in cars],
+                "images": [str(car.image) for car in cars],
+                "dimensions": [(car.get_car_draw_info().width, car.get_car_draw_info().height) for car in cars],
+                "max_laps": cars[0].max_laps,
+            },
+        )
+
+    def save_recording(self, file_path: str) -> None:
+        """
+        Saves recorded episode, laps of all cars are added to its metadata
+        :param file_path: .npz file
+        :return:
+        """
+        self.recorder.metadata["laps"] = [car.get_laps() for car in self.cars_ai + self.cars_players]
+        self.recorder.save(file_path)
 
     def step(self):
-        for car in self.cars_ai:
-            car.step()
-        for car in self.cars_players:
-            car.step()
+        if self.recorder is not None:
+            distances_before = [car.distance for car in self.cars_ai + self.cars_players]
+        # cars that will react in this step (see CarWrapper.step) get their actions from batched forward passes
+        react_ai_cars([car for car in self.cars_ai if car.car.get_inactive_ratio() == 0.0])
+        cars = self.cars_ai + self.cars_players
+        moved = [car.step(update_laps=False) for car in cars]
+        self._update_laps(cars, moved)
         self.current_timestep += 1
 
+        if self.recorder is not None:
+            cars = self.cars_ai + self.cars_players
+            self.recorder.record(
+                np.array([car.get_pose() for car in cars]),
+                np.array([car.last_action for car in cars]),
+                np.array([car.distance for car in cars]) - distances_before,
+            )
+
+    def _update_laps(self, cars: list[CarWrapper], moved: list[bool]) -> None:
+        """
+        Checks end lines and false end lines of all cars that moved in one nogil call,
+        lap state machine of a car (CarWrapper._update_laps) runs only when it crossed one of its lines
+        """
+        previous_positions = np.array([car.previous_position for car in cars], dtype=np.float64)
+        current_positions = np.array([car.car.get_position() for car in cars], dtype=np.float64)
+        crossed = check_crossed_lines(self._lines, np.concatenate([previous_positions] * 2), np.concatenate([current_positions] * 2))
+        crossed = crossed.reshape(2, len(cars)) & np.array(moved, dtype=np.bool_)
+        for i in np.flatnonzero(crossed[0] | crossed[1]):
+            cars[i]._update_laps(bool(crossed[0, i]), bool(crossed[1, i]))
+        for car, car_moved, position in zip(cars, moved, current_positions.tolist()):
+            if car_moved:
+                car.previous_position = tuple(position)
+
+    def is_finished(self) -> bool:
+        # race without players (e.g. AI-only tournament) ends when all AI cars finished
+        cars = self.cars_players if self.cars_players else self.cars_ai
+        return all([car.finished() for car in cars]) or self.current_timestep >= self.max_timesteps
+
+    def run_until_finished(self) -> RaceResult:
+        """
+        Steps simulation as fast as possible until it is finished, without any rendering,
+        e.g. for AI-only tournaments or difficulty calibration
+        :return: results of all cars, players are after AI cars
+        """
+        while not self.is_finished():
+            self.step()
+
+        cars = self.cars_ai + self.cars_players
+        return RaceResult(
+            names=[car.name for car in cars],
+            laps=[car.get_laps() for car in cars],
+            distances=[car.distance for car in cars],
+            ranking=sorted(range(len(cars)), key=lambda i: cars[i], reverse=True),
+            timesteps=self.current_timestep,
+        )
+
+
+class ReplayCar:
+    """
+    Car of ReplaySimulation, it has the same interface as CarWrapper that is used for drawing and ranking
+    """
+    def __init__(self, replay: 'ReplaySimulation', car_id: int, name: str, image: Path, dimensions: tuple[float, float], laps: list[int]):
+        self.replay = replay
+        self.car_id = car_id
+        self.name = name
+        self.image = image
+        self.width, self.height = dimensions
+        self.max_laps = replay.max_laps
+        self._recorded_laps = laps
+        self._laps = []
+        self.distance = 0.0
+
+    def get_car_draw_info(self) -> CarDrawInfo:
+        x, y, angle = self.replay.episode.poses[self.replay.get_frame(), self.car_id]
+        return CarDrawInfo(int(round(x)), int(round(y)), float(angle), self.width, self.height, 0.0)
+
+    def get_laps(self) -> list[int]:
+        return self._laps.copy()
+
+    def finished(self) -> bool:
+        return len(self._laps) >= self.max_laps
+
+    def update(self, distance: float) -> None:
+        self.distance = distance
+        self._laps = [lap for lap in self._recorded_laps if lap <= self.replay.get_frame()]
+
+    def __gt__(self, other):
+        if not isinstance(other, ReplayCar):
+            return NotImplemented
+        # the same order as CarWrapper
+        if len(self._laps) > len(other._laps):
+            return True
+        elif len(self._laps) == len(other._laps):
+            if len(self._laps) == self.max_laps:
+                return self._laps[-1] > other._laps[-1]
+            else:
+                return self.distance > other.distance
+        return False
+
+
+class ReplaySimulation:
+    """
+    Plays episode recorded by GameSimulation, it has the same interface as GameSimulation, so GUI can draw it
+    speed is number of recorded steps per step of replay, it can be changed while playing, e.g. 0.5 or 4.0
+    """
+    cars_ai: list[ReplayCar]
+    cars_players: list[ReplayCar]
+    max_timesteps: int
+    current_timestep: int
+    recorder: None  # replay is not recorded again
+
+    def __init__(self, episode: Episode, speed: float = 1.0):
+        self.recorder = None
+        self.episode = episode
+        self.speed = speed
+        self.max_laps = episode.metadata["max_laps"]
+        self.max_timesteps = episode.steps + 1
+        self.current_timestep = 1
+        self._frame = 0.0
+
+        metadata = episode.metadata
+        self._cumulative_distances = np.cumsum(episode.rewards, axis=0)
+        cars = [
+            ReplayCar(self, i, name, Path(image), tuple(dimensions), laps)
+            for i, (name, image, dimensions, laps) in enumerate(zip(metadata["names"], metadata["images"], metadata["dimensions"], metadata["laps"]))
+        ]
+        self.cars_ai = cars[:-1]
+        self.cars_players = cars[-1:]
+
+    def get_frame(self) -> int:
+        return int(self._frame)
+
+    def step(self):
+        self._frame = min(self._frame + self.speed, self.episode.steps)
+        self.current_timestep = self.get_frame() + 1
+        for car in self.cars_ai + self.cars_players:
+            car.update(float(self._cumulative_distances[self.get_frame() - 1, car.car_id]) if self.get_frame() > 0 else 0.0)
+
     def is_finished(self) -> bool:
-        return all([car.finished() for car in self.cars_players]) or self.current_timestep >= self.max_timesteps
+        return self.get_frame() >= self.episode.steps
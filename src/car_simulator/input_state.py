@@ -0,0 +1,24 @@
+class InputState:
+    """
+    Keys currently held by the player, fed by key press and release events of GUI (e.g. Qt events of GamePage)
+    and read by CarPlayerWrapper without any system calls
+    keys are lowercase names, e.g. "up", "w", "space"
+    it can be read from simulation thread while GUI thread writes it, single set operations are atomic
+    """
+    def __init__(self):
+        self._pressed: set[str] = set()
+
+    def press(self, key: str) -> None:
+        self._pressed.add(key)
+
+    def release(self, key: str) -> None:
+        self._pressed.discard(key)
+
+    def clear(self) -> None:
+        """
+        Releases all keys, e.g. when window loses focus, so release events would not come
+        """
+        self._pressed.clear()
+
+    def is_pressed(self, key: str) -> bool:
+        return key in self._pressed
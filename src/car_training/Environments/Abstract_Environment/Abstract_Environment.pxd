@@ -1,5 +1,8 @@
 # cdef object real_t_numpy
+from src.car_training.Environments.Abstract_Environment.Rollout_Profiling cimport Rollout_Profile
+
 cdef class Abstract_Environment:
+    cdef Rollout_Profile profile  # filled only when built with CAR_PROFILE=1
     cdef int reset(self) noexcept nogil
     cdef float[::1] get_state(self) noexcept nogil
     cdef double react(self, float[::1] outputs) noexcept nogil
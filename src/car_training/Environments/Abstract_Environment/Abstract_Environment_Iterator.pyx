@@ -3,6 +3,7 @@ import math
 import cython
 
 from src.car_training.Environments.Abstract_Environment.Abstract_Environment cimport Abstract_Environment
+from src.car_training.Environments.Abstract_Environment.Rollout_Profiling cimport Rollout_Profile, CAR_PROFILE, car_profile_cycles, add_profile, clear_profile
 from src.car_training.MyMath.cython_debug_helper import cython_debug_call
 
 from src.car_training.Neural_Network.Raw_Numpy.Raw_Numpy_Models.Normal.Normal_model cimport Normal_model
@@ -10,6 +11,7 @@ from typing import List
 
 import numpy as np
 
+PROFILING_ENABLED = bool(CAR_PROFILE)  # True if extension was built with CAR_PROFILE=1
 
 
 cdef class Abstract_Environment_Iterator:
@@ -17,6 +19,8 @@ cdef class Abstract_Environment_Iterator:
     cdef Abstract_Environment self_environment
     cdef int number_of_environments
     cdef bint is_self_alive
+    cdef long long last_steps
+    cdef Rollout_Profile profile  # forward pass and whole loop, environments keep their own counters
 
 
     def __init__(self, environments_list: List[Abstract_Environment]):
@@ -28,6 +32,44 @@ cdef class Abstract_Environment_Iterator:
             self.next_it = Abstract_Environment_Iterator(environments_list[1:])
         self.number_of_environments = len(environments_list)
         self.is_self_alive = True
+        self.last_steps = 0
+
+    def get_last_steps(self) -> int:
+        """
+        Returns number of steps done in all environments during last get_results call, it is a good estimate of evaluation cost
+        :return:
+        """
+        return self.last_steps
+
+    def get_profile(self, include_environments: bool = True) -> dict[str, int]:
+        """
+        Returns profiling counters accumulated by get_results calls since creation or reset_profile,
+        they are all zeros unless extension was built with CAR_PROFILE=1 (see PROFILING_ENABLED)
+        cycles_iterator is time of loop not spent in forward pass and measured environment parts (state copying, recursion, rewards)
+        :param include_environments: if False, only counters of this iterator are returned, e.g. when environments are shared with other iterator
+        :return: dict of counters, cycles are CPU time stamp counter ticks
+        """
+        cdef Rollout_Profile total = self.profile
+        cdef Abstract_Environment_Iterator iterator = self
+        if include_environments:
+            while iterator is not None:
+                add_profile(&total, &iterator.self_environment.profile)
+                iterator = iterator.next_it
+        profile = dict(total)
+        measured_cycles = total.cycles_forward_pass + total.cycles_ray_distance + total.cycles_collision + total.cycles_physics
+        profile["cycles_iterator"] = max(<long long> total.cycles_total - <long long> measured_cycles, 0) if include_environments else 0
+        return profile
+
+    def reset_profile(self) -> None:
+        """
+        Resets profiling counters of this iterator and its environments
+        :return:
+        """
+        cdef Abstract_Environment_Iterator iterator = self
+        clear_profile(&self.profile)
+        while iterator is not None:
+            clear_profile(&iterator.self_environment.profile)
+            iterator = iterator.next_it
 
     def get_results(self, model: Normal_model) -> float:
         """
@@ -39,14 +81,28 @@ cdef class Abstract_Environment_Iterator:
         cdef float[:, ::1] outputs
         cdef int input_rows_number
         cdef double result = 0
+        cdef long long steps = 0
+        cdef unsigned long long cycles_start = 0, forward_pass_start = 0
 
         with nogil:
+            if CAR_PROFILE:
+                cycles_start = car_profile_cycles()
             self.iterate_reset_environments()
 
             while self.iterate_is_alive():
                 input_rows_number = self.iterate_insert_state(input_states)
+                if CAR_PROFILE:
+                    forward_pass_start = car_profile_cycles()
                 outputs = model_cython.forward_pass(input_states[:input_rows_number])
+                if CAR_PROFILE:
+                    self.profile.cycles_forward_pass += car_profile_cycles() - forward_pass_start
                 result += self.iterate_react(outputs)
+                steps += input_rows_number
+
+            if CAR_PROFILE:
+                self.profile.cycles_total += car_profile_cycles() - cycles_start
+                self.profile.steps += steps
+        self.last_steps = steps
         return result
 
     @cython.boundscheck(False)
@@ -91,6 +147,7 @@ cdef class Abstract_Environment_Iterator:
                 memory_rows += input_rows_number
 
                 result += self.iterate_react(outputs)
+        self.last_steps = memory_rows
         # cython_debug_call({
         #     "input_states_memory": np.array(input_states_memory[:memory_rows], dtype=np.float32, copy=False),
         #     "outputs_memory": np.array(outputs_memory[:memory_rows], dtype=np.float32, copy=False),
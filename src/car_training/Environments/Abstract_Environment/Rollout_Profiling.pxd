@@ -0,0 +1,57 @@
+# Compile-time optional profiling of rollouts, enabled by building with CAR_PROFILE=1 (see setup.py)
+# when disabled, CAR_PROFILE is C constant 0, so all "if CAR_PROFILE:" blocks are removed by C compiler
+# counters are plain struct fields of environments and iterators, so they are updated without the GIL,
+# each worker owns its environments, so no synchronization is needed
+
+from libc.string cimport memset
+
+cdef extern from *:
+    """
+    #ifndef CAR_PROFILE
+    #define CAR_PROFILE 0
+    #endif
+    #if CAR_PROFILE && (defined(_MSC_VER))
+    #include <intrin.h>
+    #define car_profile_cycles() ((unsigned long long) __rdtsc())
+    #elif CAR_PROFILE && (defined(__x86_64__) || defined(__i386__))
+    #include <x86intrin.h>
+    #define car_profile_cycles() ((unsigned long long) __rdtsc())
+    #elif CAR_PROFILE
+    #include <time.h>
+    static inline unsigned long long car_profile_cycles(void) {
+        struct timespec now;
+        clock_gettime(CLOCK_MONOTONIC, &now);
+        return (unsigned long long) now.tv_sec * 1000000000ULL + (unsigned long long) now.tv_nsec;
+    }
+    #else
+    #define car_profile_cycles() 0ULL
+    #endif
+    """
+    const bint CAR_PROFILE
+    unsigned long long car_profile_cycles() noexcept nogil  # time stamp counter (nanoseconds on non-x86 CPUs)
+
+ctypedef struct Rollout_Profile:
+    unsigned long long cycles_total  # whole rollout loop, measured by iterator
+    unsigned long long cycles_forward_pass  # measured by iterator
+    unsigned long long cycles_ray_distance  # get_ray_distance calls, measured by environment
+    unsigned long long cycles_collision  # does_collide calls, measured by environment
+    unsigned long long cycles_physics  # car movement in react, measured by environment
+    long long steps
+    long long rays
+    long long ray_march_steps
+    long long collision_checks  # does_collide calls that were not answered from memory
+
+cdef inline void add_profile(Rollout_Profile* target, Rollout_Profile* source) noexcept nogil:
+    target.cycles_total += source.cycles_total
+    target.cycles_forward_pass += source.cycles_forward_pass
+    target.cycles_ray_distance += source.cycles_ray_distance
+    target.cycles_collision += source.cycles_collision
+    target.cycles_physics += source.cycles_physics
+    target.steps += source.steps
+    target.rays += source.rays
+    target.ray_march_steps += source.ray_march_steps
+    target.collision_checks += source.collision_checks
+
+cdef inline void clear_profile(Rollout_Profile* profile) noexcept nogil:
+    # struct constructor without all members would copy uninitialized memory, so all fields are zeroed explicitly
+    memset(profile, 0, sizeof(Rollout_Profile))
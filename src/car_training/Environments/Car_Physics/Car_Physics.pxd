@@ -0,0 +1,43 @@
+ctypedef unsigned char map_view_t
+
+cimport cython
+
+@cython.final
+cdef class Car_Physics:
+    # state, angle is in degrees or radians, depending on use_degrees
+    cdef double x
+    cdef double y
+    cdef double angle
+    cdef double speed
+    cdef double min_speed
+    cdef double max_speed
+    cdef double width
+    cdef double height
+    cdef double distance_center_corner
+    cdef double angle_to_corner
+
+    cdef bint use_degrees  # True - degrees and lookup trig (training), False - radians and exact trig (game)
+    cdef double half_turn  # 180 or pi
+    cdef map_view_t[:, ::1] map_view
+    cdef unsigned char[:, ::1] wall_normals  # see compute_wall_normals, used by fix_collision if has_wall_normals
+    cdef bint has_wall_normals
+    cdef unsigned char[:, ::1] coarse_map  # see compute_coarse_map, used by get_ray_distance if has_coarse_map
+    cdef bint has_coarse_map
+
+    cdef bint does_collide_memory
+    cdef bint is_does_collide_actual
+
+    cdef double angle_sin(self, double angle) noexcept nogil
+    cdef double angle_cos(self, double angle) noexcept nogil
+    cdef void set_state(self, double x, double y, double angle, double speed) noexcept nogil
+    cdef void move(self) noexcept nogil
+    cdef void change_speed(self, double speed_change) noexcept nogil
+    cdef void change_angle(self, double angle_change) noexcept nogil
+    cdef void apply_engine(self, double engine, double acceleration) noexcept nogil
+    cdef double get_ray_distance(self, double ray_angle) noexcept nogil
+    cdef int get_free_steps(self, double x, double y, int check_x, int check_y, double cos_angle, double sin_angle) noexcept nogil
+    cdef bint does_collide(self) noexcept nogil
+    cdef bint does_collide_one(self, double distance, double angle) noexcept nogil
+    cdef double get_wall_direction(self) noexcept nogil
+    cdef double probe_wall_direction(self) noexcept nogil
+    cdef void fix_collision(self) noexcept nogil
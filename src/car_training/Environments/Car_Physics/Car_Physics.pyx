@@ -0,0 +1,357 @@
+import math
+from typing import Tuple, Optional
+
+import cython
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+
+from libc.math cimport sin, cos, pi
+from src.car_training.MyMath.MyMath cimport round_to_int, degree_sin, degree_cos
+
+cdef enum:
+    FIX_COLLISION_ANGLES = 90  # number of directions checked around the car to find the wall in fix_collision
+    WALL_NORMALS_CELL_SIZE = 4  # pixels, wall normals are computed for cells of this size
+    WALL_NORMAL_DIRECTIONS = 255  # quantisation of wall normals, about 1.4 degree
+    NO_WALL_NORMAL = 255
+    COARSE_CELL_SIZE = 16  # pixels, cells of coarse map, rays skip cells without walls
+
+cdef double FREE_STEPS_MARGIN = 1e-6  # pixels, rays skipping coarse cell stop this far from its border
+
+@cython.final
+cdef class Car_Physics:
+    """
+    Car physics shared by training environment (Basic_Car_Environment) and game (CarCython):
+    movement, speed and angle changes, ray casting and collision checks on map_view, all nogil
+    angles are in degrees with lookup trig (use_degrees=True, training) or in radians with exact trig (use_degrees=False, game)
+    """
+    def __init__(self,
+                 map_view: np.ndarray,
+                 start_position: Tuple[float, float],
+                 angle: float,
+                 car_dimensions: Tuple[float, float],
+                 speed: float,
+                 min_speed: float,
+                 max_speed: float,
+                 use_degrees: bool,
+                 wall_normals: Optional[np.ndarray] = None,
+                 coarse_map: Optional[np.ndarray] = None,
+                 ):
+        """
+
+        :param map_view: 2d nparray of the map, 0 is free space, 1 is wall (row, column)
+        :param start_position: tuple of the start position (x, y)
+        :param angle: in degrees or radians, depending on use_degrees, right is 0, top is quarter turn
+        :param car_dimensions: tuple of the car dimensions (width, height)
+        :param speed: start speed
+        :param use_degrees: True - degrees and lookup trig, False - radians and exact trig
+        :param wall_normals: result of compute_wall_normals(map_view), shared by cars on the same map,
+        None - fix_collision probes the map
+        :param coarse_map: result of compute_coarse_map(map_view), shared by cars on the same map,
+        None - rays check every pixel, distances are the same (up to rounding errors), only slower in open space
+        """
+        self.map_view = np.ascontiguousarray(map_view, dtype=np.uint8)
+        self.has_wall_normals = wall_normals is not None
+        if self.has_wall_normals:
+            self.wall_normals = wall_normals
+        self.has_coarse_map = coarse_map is not None
+        if self.has_coarse_map:
+            self.coarse_map = coarse_map
+        self.use_degrees = use_degrees
+        self.half_turn = 180.0 if use_degrees else pi
+        self.min_speed = min_speed
+        self.max_speed = max_speed
+        self.width = car_dimensions[0]
+        self.height = car_dimensions[1]
+        self.distance_center_corner = math.sqrt((self.width / 2) ** 2 + (self.height / 2) ** 2)
+        self.angle_to_corner = math.atan2(self.width / 2, self.height / 2)
+        if use_degrees:
+            self.angle_to_corner = math.degrees(self.angle_to_corner)
+        self.set_state(start_position[0], start_position[1], angle, speed)
+
+    cdef double angle_sin(self, double angle) noexcept nogil:
+        if self.use_degrees:
+            return degree_sin(angle)
+        return sin(angle)
+
+    cdef double angle_cos(self, double angle) noexcept nogil:
+        if self.use_degrees:
+            return degree_cos(angle)
+        return cos(angle)
+
+    cdef void set_state(self, double x, double y, double angle, double speed) noexcept nogil:
+        self.x = x
+        self.y = y
+        self.angle = angle
+        self.speed = speed
+        self.is_does_collide_actual = False
+
+    cdef void move(self) noexcept nogil:
+        """
+        Moves the car by its speed in direction of its angle
+        """
+        self.x += self.speed * self.angle_cos(self.angle)
+        self.y -= self.speed * self.angle_sin(self.angle)
+        self.is_does_collide_actual = False
+
+    cdef void change_speed(self, double speed_change) noexcept nogil:
+        """
+        Changes speed of the car by the given amount, speed is kept in [min_speed, max_speed]
+        """
+        self.speed += speed_change
+        if self.speed < self.min_speed:
+            self.speed = self.min_speed
+        elif self.speed > self.max_speed:
+            self.speed = self.max_speed
+
+    cdef void change_angle(self, double angle_change) noexcept nogil:
+        """
+        Changes angle of the car by the given amount, angle is kept in [0, full turn)
+        """
+        self.angle += angle_change
+        if self.angle < 0:
+            self.angle += 2 * self.half_turn
+        elif self.angle >= 2 * self.half_turn:
+            self.angle -= 2 * self.half_turn
+        self.is_does_collide_actual = False
+
+    cdef void apply_engine(self, double engine, double acceleration) noexcept nogil:
+        """
+        Engine with wheel traction - the faster the car is, the less it accelerates (and the more it slows down without engine)
+        :param engine: in [-1, 1], it is clipped
+        """
+        if engine < -1.0:
+            engine = -1.0
+        elif engine > 1.0:
+            engine = 1.0
+        self.change_speed((engine - self.speed / self.max_speed) * acceleration)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef double get_ray_distance(self, double ray_angle) noexcept nogil:
+        """
+        Distance from the car to the wall in direction ray_angle (relative to the car angle), measured in steps of length 1
+        """
+        cdef map_view_t[:, ::1] map_view_here = self.map_view
+        cdef double x = self.x
+        cdef double y = self.y
+        cdef double distance = 0
+        cdef int check_x, check_y
+        cdef int free_steps
+        cdef double angle = self.angle + ray_angle
+        cdef double sin_angle = self.angle_sin(angle)
+        cdef double cos_angle = self.angle_cos(angle)
+
+        check_x = round_to_int(x)
+        check_y = round_to_int(y)
+
+        while check_x >= 0 and check_x < map_view_here.shape[1] and check_y >= 0 and check_y < map_view_here.shape[0] and map_view_here[check_y, check_x] == 0:
+            if self.has_coarse_map and self.coarse_map[check_y // COARSE_CELL_SIZE, check_x // COARSE_CELL_SIZE] == 0:
+                # jump over the rest of empty coarse cell, position differs from repeated steps only by rounding errors
+                free_steps = self.get_free_steps(x, y, check_x, check_y, cos_angle, sin_angle)
+                x += free_steps * cos_angle
+                y -= free_steps * sin_angle
+                distance += free_steps
+            x += cos_angle
+            y -= sin_angle
+            distance += 1
+            check_x = round_to_int(x)
+            check_y = round_to_int(y)
+
+        return distance
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef int get_free_steps(self, double x, double y, int check_x, int check_y, double cos_angle, double sin_angle) noexcept nogil:
+        """
+        Number of ray steps from (x, y) that surely stay in the same coarse cell
+        pixel of position x is round_to_int(x), so it stays in cell while x + 0.5 is in [cell start, cell end)
+        """
+        cdef int cell_x = check_x // COARSE_CELL_SIZE
+        cdef int cell_y = check_y // COARSE_CELL_SIZE
+        cdef double steps = 1e9
+        cdef double steps_y
+        if cos_angle > 0:
+            steps = ((cell_x + 1) * COARSE_CELL_SIZE - 0.5 - FREE_STEPS_MARGIN - x) / cos_angle
+        elif cos_angle < 0:
+            steps = (x - (cell_x * COARSE_CELL_SIZE - 0.5 + FREE_STEPS_MARGIN)) / -cos_angle
+        # y decreases by sin_angle in each step
+        if sin_angle < 0:
+            steps_y = ((cell_y + 1) * COARSE_CELL_SIZE - 0.5 - FREE_STEPS_MARGIN - y) / -sin_angle
+            if steps_y < steps:
+                steps = steps_y
+        elif sin_angle > 0:
+            steps_y = (y - (cell_y * COARSE_CELL_SIZE - 0.5 + FREE_STEPS_MARGIN)) / sin_angle
+            if steps_y < steps:
+                steps = steps_y
+        if steps < 1:
+            return 0
+        return <int> steps
+
+    cdef bint does_collide(self) noexcept nogil:
+        """
+        Checks corners and middles of sides of the car, result is remembered until the car moves or turns
+        """
+        cdef double half_turn = self.half_turn
+        if not self.is_does_collide_actual:
+            self.does_collide_memory = (self.does_collide_one(self.distance_center_corner, self.angle - self.angle_to_corner) or
+                                        self.does_collide_one(self.distance_center_corner, self.angle + self.angle_to_corner) or
+                                        self.does_collide_one(self.distance_center_corner, half_turn + self.angle - self.angle_to_corner) or
+                                        self.does_collide_one(self.distance_center_corner, half_turn + self.angle + self.angle_to_corner) or
+                                        self.does_collide_one(self.width / 2, self.angle + half_turn / 2) or
+                                        self.does_collide_one(self.width / 2, self.angle - half_turn / 2) or
+                                        self.does_collide_one(self.height / 2, self.angle) or
+                                        self.does_collide_one(self.height / 2, self.angle + half_turn))
+            self.is_does_collide_actual = True
+        return self.does_collide_memory
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef bint does_collide_one(self, double distance, double angle) noexcept nogil:
+        cdef int check_x, check_y
+        check_x = round_to_int(self.x + distance * self.angle_cos(angle))
+        check_y = round_to_int(self.y - distance * self.angle_sin(angle))
+
+        if check_x < 0 or check_x >= self.map_view.shape[1]:
+            return True
+        if check_y < 0 or check_y >= self.map_view.shape[0]:
+            return True
+
+        return self.map_view[check_y, check_x] == 1
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef double get_wall_direction(self) noexcept nogil:
+        """
+        Direction from the car to the wall it hit, O(1) lookup in wall normals if they are available and defined at car position,
+        otherwise the wall is found by probing
+        """
+        cdef int cell_x = <int> (self.x / WALL_NORMALS_CELL_SIZE)
+        cdef int cell_y = <int> (self.y / WALL_NORMALS_CELL_SIZE)
+        cdef unsigned char normal
+        cdef double direction
+        if (self.has_wall_normals and self.x >= 0 and self.y >= 0
+                and cell_x < self.wall_normals.shape[1] and cell_y < self.wall_normals.shape[0]):
+            normal = self.wall_normals[cell_y, cell_x]
+            if normal != NO_WALL_NORMAL:
+                # normal points away from the wall
+                direction = normal * 2 * self.half_turn / WALL_NORMAL_DIRECTIONS + self.half_turn
+                if direction >= 2 * self.half_turn:
+                    direction -= 2 * self.half_turn
+                return direction
+        return self.probe_wall_direction()
+
+    cdef double probe_wall_direction(self) noexcept nogil:
+        """
+        Direction from the car to the wall, the middle of the longest sequence of colliding points on circle around the car
+        """
+        # get angle of the wall by checking many angles around current position of the car
+        cdef double full_turn = 2 * self.half_turn
+        cdef double angle_step = full_turn / FIX_COLLISION_ANGLES
+        cdef unsigned char collisions[FIX_COLLISION_ANGLES]
+        cdef double checked_distance = self.distance_center_corner * 1.5
+        cdef int i
+        for i in range(FIX_COLLISION_ANGLES):
+            collisions[i] = self.does_collide_one(checked_distance, i * angle_step)
+
+        # get index of start and end of the longest sequence of collisions
+        cdef int start = 0
+        cdef int end = 0
+        cdef int current_start = 0
+        cdef int current_end = 0
+        cdef int max_length = 0
+        cdef int current_length = 0
+        cdef int current_index
+        for i in range(FIX_COLLISION_ANGLES * 2):
+            current_index = i % FIX_COLLISION_ANGLES
+            if collisions[current_index] == 1:
+                if current_length == 0:
+                    current_start = current_index
+                current_length += 1
+                current_end = current_index
+            else:
+                if current_length > max_length:
+                    max_length = current_length
+                    start = current_start
+                    end = current_end
+                current_length = 0
+
+        cdef double angle_between = (end - start) * angle_step
+        if angle_between < 0:
+            angle_between += full_turn
+        if angle_between > self.half_turn:
+            angle_between = full_turn - angle_between
+        return start * angle_step + angle_between / 2
+
+    cdef void fix_collision(self) noexcept nogil:
+        """
+        Turns the car along the wall it hit and moves it away from the wall, until it does not collide (at most 10 moves)
+        """
+        cdef double full_turn = 2 * self.half_turn
+        cdef double perpendicular_wall_angle = self.get_wall_direction()
+        cdef double wall_angle = perpendicular_wall_angle + self.half_turn / 2
+        if wall_angle > full_turn:
+            wall_angle -= full_turn
+
+        # check if I should set the angle to the wall angle or to the opposite angle
+        cdef double angle_diff = abs(self.angle - wall_angle)
+        if angle_diff > self.half_turn / 2 and angle_diff < 3 * self.half_turn / 2:
+            wall_angle -= self.half_turn
+        self.angle = wall_angle
+        self.is_does_collide_actual = False
+
+        # move the car away from the wall
+        cdef double move_distance = 0.2 * self.width
+        cdef bint end_trigger = False
+        cdef int i
+        perpendicular_wall_angle -= self.half_turn
+
+        for i in range(10):
+            if not self.does_collide():
+                end_trigger = True
+            self.x += move_distance * self.angle_cos(perpendicular_wall_angle)
+            self.y -= move_distance * self.angle_sin(perpendicular_wall_angle)
+            self.is_does_collide_actual = False
+
+            if end_trigger:
+                break
+
+
+def compute_wall_normals(map_view: np.ndarray) -> np.ndarray:
+    """
+    Computes direction away from the nearest wall for each WALL_NORMALS_CELL_SIZE x WALL_NORMALS_CELL_SIZE cell of the map,
+    it is gradient of signed distance to walls (cell is wall if any of its pixels is wall, outside of the map is wall)
+    computed once per map, so fix_collision does not have to probe the map
+    :param map_view: 2d nparray of the map, 0 is free space, 1 is wall (row, column)
+    :return: uint8 (cells_rows, cells_cols), direction index in [0, WALL_NORMAL_DIRECTIONS) counter-clockwise from right,
+    NO_WALL_NORMAL where direction is not defined (e.g. in the middle between two walls)
+    """
+    walls = np.pad(_any_in_cells(map_view, WALL_NORMALS_CELL_SIZE), 1, constant_values=True)
+
+    signed_distance = distance_transform_edt(~walls) - distance_transform_edt(walls)
+    gradient_y, gradient_x = np.gradient(signed_distance)
+    gradient_y, gradient_x = gradient_y[1:-1, 1:-1], gradient_x[1:-1, 1:-1]
+
+    # y axis of the map points down
+    directions = np.round(np.arctan2(-gradient_y, gradient_x) / (2 * np.pi) * WALL_NORMAL_DIRECTIONS) % WALL_NORMAL_DIRECTIONS
+    normals = directions.astype(np.uint8)
+    normals[np.hypot(gradient_x, gradient_y) < 0.5] = NO_WALL_NORMAL
+    return normals
+
+
+def compute_coarse_map(map_view: np.ndarray) -> np.ndarray:
+    """
+    Coarse level of the map for ray casting, cell is wall if any of its pixels is wall (outside of the map is wall)
+    :param map_view: 2d nparray of the map, 0 is free space, 1 is wall (row, column)
+    :return: uint8 (cells_rows, cells_cols) of COARSE_CELL_SIZE x COARSE_CELL_SIZE cells, 1 - cell contains wall
+    """
+    return _any_in_cells(map_view, COARSE_CELL_SIZE).view(np.uint8)
+
+
+def _any_in_cells(map_view: np.ndarray, cell_size: int) -> np.ndarray:
+    rows = -(-map_view.shape[0] // cell_size)
+    cols = -(-map_view.shape[1] // cell_size)
+    padded = np.ones((rows * cell_size, cols * cell_size), dtype=np.bool_)
+    padded[:map_view.shape[0], :map_view.shape[1]] = map_view
+    return padded.reshape(rows, cell_size, cols, cell_size).any(axis=(1, 3))
@@ -1,13 +1,14 @@
 import math
+import os
 from typing import Optional
 
-import keyboard
 import numpy as np
 import pygame
 import sys
 
 from src.car_training.Environments.Abstract_Environment.Abstract_Environment import Abstract_Environment
 from src.car_training.Environments.general_functions_provider import get_environment_class
+from src.car_training.Environments_Visualization.Episode_Recorder import load_episode
 from src.car_training.Neural_Network.Raw_Numpy.Raw_Numpy_Models.Normal.Normal_model import Normal_model
 from src.car_training.constants import CONSTANTS_DICT
 
@@ -21,15 +22,52 @@ width, height = environment_kwargs["map_view"].shape
 car_image_path = CONSTANTS_DICT["visualization"]["car_image_path"]
 map_image_path = CONSTANTS_DICT["visualization"]["map_image_path"]
 car_dimmensions = CONSTANTS_DICT["environment"]["universal_kwargs"]["car_dimensions"]
+sprite_angles = 360  # number of pre-rendered rotations of car sprite, i.e. 1 degree step
 
 
+class Rotated_Sprite_Cache:
+    """
+    Car sprite scaled to car dimensions and pre-rendered at all quantised angles,
+    so drawing does not call pygame.transform.rotate every frame
+    """
+    def __init__(self, sprite: pygame.Surface, angles: int = sprite_angles) -> None:
+        """
+        :param sprite: already scaled sprite
+        :param angles: number of rotations
+        """
+        self.angle_step = 360 / angles
+        self.sprites = [pygame.transform.rotate(sprite, i * self.angle_step) for i in range(angles)]
+
+    def get(self, angle: float) -> pygame.Surface:
+        """
+        :param angle: in degrees
+        :return: the nearest pre-rendered rotation
+        """
+        return self.sprites[round(angle / self.angle_step) % len(self.sprites)]
+
+
+_car_sprites_caches: dict[tuple[str, int, int], Rotated_Sprite_Cache] = {}
+
+
+def load_car_sprites(image_path: str = car_image_path, car_dimensions: tuple[int, int] = car_dimmensions) -> Rotated_Sprite_Cache:
+    """
+    Cars with the same image and dimensions share one cache, display has to be set before the first call (convert_alpha)
+    :param image_path:
+    :param car_dimensions: width, height
+    :return:
+    """
+    key = (os.path.abspath(image_path), car_dimensions[0], car_dimensions[1])
+    if key not in _car_sprites_caches:
+        sprite = pygame.image.load(image_path).convert_alpha()
+        _car_sprites_caches[key] = Rotated_Sprite_Cache(pygame.transform.scale(sprite, (car_dimensions[1], car_dimensions[0])))
+    return _car_sprites_caches[key]
+
 
 class Car:
     def __init__(self, environment: Abstract_Environment, model: Optional[Normal_model] = None):
         self.environment = environment
         self.model = model
-        self.sprite = pygame.image.load(car_image_path).convert_alpha()
-        self.sprite = pygame.transform.scale(self.sprite, (car_dimmensions[1], car_dimmensions[0]))
+        self.sprites = load_car_sprites()
         self.position = self.environment.get_car_position()
         self.angle = self.environment.get_car_angle()
 
@@ -37,7 +75,7 @@ class Car:
         self.environment.p_reset()
 
     def getDrawPosition(self):
-        rotated_sprite = pygame.transform.rotate(self.sprite, self.angle)
+        rotated_sprite = self.sprites.get(self.angle)
         draw_position = (
             self.position[0] - rotated_sprite.get_width() / 2, self.position[1] - rotated_sprite.get_height() / 2)
         return rotated_sprite, draw_position
@@ -48,7 +86,7 @@ class Car:
 
     def step(self) -> bool:
         """
-        Reacts to keyboard input
+        Reacts to keyboard input (state of keys is kept by pygame from its events)
         :return: true if alive, false if dead
         """
 
@@ -57,9 +95,10 @@ class Car:
             output = self.model.p_forward_pass(state)[0]
         else:
             output = np.zeros(3, dtype=np.float32)
-            if keyboard.is_pressed('left'):
+            keys = pygame.key.get_pressed()
+            if keys[pygame.K_LEFT]:
                 output[1] = 1
-            elif keyboard.is_pressed('right'):
+            elif keys[pygame.K_RIGHT]:
                 output[2] = 1
 
         self.environment.p_react(output)
@@ -102,4 +141,40 @@ def run_basic_environment_visualization(model: Optional[Normal_model] = None):
                 #sys.exit()
 
         if not is_alive:
-            pygame.quit()
\ No newline at end of file
+            pygame.quit()
+
+def play_episode(file_path: str, speed: float = 1.0, fps: int = 150):
+    """
+    Plays episode recorded by Episode_Recorder, it does not run environment nor model
+    :param file_path: .npz file
+    :param speed: steps per frame, e.g. 0.5 - slow motion, 10.0 - fast forward
+    :param fps:
+    :return:
+    """
+    episode = load_episode(file_path)
+
+    clock = pygame.time.Clock()
+    pygame.init()
+    screen = pygame.display.set_mode((width, height))
+    pygame.display.set_caption(file_path)
+
+    sprites = load_car_sprites()
+    game_map = pygame.image.load(episode.metadata.get("map_image_path", map_image_path)).convert()
+    game_map = pygame.transform.scale(game_map, (width, height))
+
+    for frame in np.arange(0, episode.poses.shape[0], speed):
+        clock.tick(fps)
+        screen.blit(game_map, (0, 0))
+        for x, y, angle in episode.poses[int(frame)]:
+            rotated_sprite = sprites.get(float(angle))
+            screen.blit(rotated_sprite, (x - rotated_sprite.get_width() / 2, y - rotated_sprite.get_height() / 2))
+        pygame.display.flip()
+
+        if any(event.type == pygame.QUIT for event in pygame.event.get()):
+            break
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    # python -m src.car_training.Environments_Visualization.Basic_Environment_Visualization <episode .npz file> [speed]
+    play_episode(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 1.0)
@@ -0,0 +1,126 @@
+import dataclasses
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+
+@dataclasses.dataclass
+class Episode:
+    poses: np.ndarray  # float64 (steps + 1, cars, 3) - x, y, angle, the first row is start pose
+    actions: np.ndarray  # float32 (steps, cars, actions_size)
+    rewards: np.ndarray  # float32 (steps, cars)
+    metadata: Dict[str, Any]
+
+    @property
+    def steps(self) -> int:
+        return self.actions.shape[0]
+
+
+class Episode_Recorder:
+    """
+    Records per-step poses, actions and rewards of one or more cars and saves them as compressed columnar npz:
+    poses are stored as float16 deltas (angle deltas are wrapped by angle_period), each delta is computed against
+    already quantized previous pose, so rounding errors do not accumulate over long episodes
+    actions are float16, rewards float32, metadata (e.g. car names, map) is json
+    """
+    def __init__(self, start_poses: np.ndarray, angle_period: float = 360.0, metadata: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Initializes recorder
+        :param start_poses: (cars, 3) - x, y, angle of each car before the first step
+        :param angle_period: 360.0 for degrees, 2 * pi for radians
+        :param metadata: json-serializable dict saved with episode
+        """
+        self.start_poses = np.array(start_poses, dtype=np.float64).reshape(-1, 3)
+        self.angle_period = angle_period
+        self.metadata = {} if metadata is None else metadata
+        self._poses: List[np.ndarray] = []
+        self._actions: List[np.ndarray] = []
+        self._rewards: List[np.ndarray] = []
+
+    def record(self, poses: np.ndarray, actions: np.ndarray, rewards: np.ndarray) -> None:
+        """
+        Records one step of all cars
+        :param poses: (cars, 3) - x, y, angle after step
+        :param actions: (cars, actions_size) - actions taken in step
+        :param rewards: (cars,) - rewards of step
+        :return:
+        """
+        self._poses.append(np.array(poses, dtype=np.float64).reshape(self.start_poses.shape))
+        self._actions.append(np.array(actions, dtype=np.float32).reshape(self.start_poses.shape[0], -1))
+        self._rewards.append(np.array(rewards, dtype=np.float32).reshape(self.start_poses.shape[0]))
+
+    @property
+    def steps(self) -> int:
+        return len(self._poses)
+
+    def to_episode(self) -> Episode:
+        """
+        :return: recorded episode, exactly as it was recorded (not quantized)
+        """
+        cars_number = self.start_poses.shape[0]
+        return Episode(
+            poses=np.concatenate([self.start_poses[np.newaxis], np.array(self._poses).reshape(-1, cars_number, 3)]),
+            actions=np.array(self._actions, dtype=np.float32).reshape(self.steps, cars_number, -1),
+            rewards=np.array(self._rewards, dtype=np.float32).reshape(self.steps, cars_number),
+            metadata=self.metadata,
+        )
+
+    def save(self, file_path: str) -> None:
+        """
+        Saves episode atomically (temporary file is replaced), parent directory is created
+        :param file_path: .npz file
+        :return:
+        """
+        episode = self.to_episode()
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            np.savez_compressed(
+                file,
+                version=np.array(FORMAT_VERSION),
+                angle_period=np.array(self.angle_period),
+                start_poses=self.start_poses,
+                pose_deltas=_encode_deltas(episode.poses, self.angle_period),
+                actions=episode.actions.astype(np.float16),
+                rewards=episode.rewards,
+                metadata=np.array(json.dumps(self.metadata)),
+            )
+        os.replace(tmp_path, file_path)
+
+
+def load_episode(file_path: str) -> Episode:
+    """
+    Loads episode saved by Episode_Recorder, poses are decoded (cumulative sum of deltas)
+    angles are continuous (not wrapped), so interpolation between frames is safe
+    :param file_path:
+    :return:
+    """
+    with np.load(file_path) as data:
+        if int(data["version"]) != FORMAT_VERSION:
+            raise ValueError(f"Unsupported episode format version {int(data['version'])} in {file_path}")
+        start_poses = data["start_poses"]
+        poses = np.empty((data["pose_deltas"].shape[0] + 1, *start_poses.shape), dtype=np.float64)
+        poses[0] = start_poses
+        np.cumsum(data["pose_deltas"].astype(np.float64), axis=0, out=poses[1:])
+        poses[1:] += start_poses
+        return Episode(
+            poses=poses,
+            actions=data["actions"].astype(np.float32),
+            rewards=data["rewards"],
+            metadata=json.loads(str(data["metadata"])),
+        )
+
+
+def _encode_deltas(poses: np.ndarray, angle_period: float) -> np.ndarray:
+    deltas = np.empty((poses.shape[0] - 1, *poses.shape[1:]), dtype=np.float16)
+    reconstructed = poses[0].copy()
+    for step in range(deltas.shape[0]):
+        delta = poses[step + 1] - reconstructed
+        delta[:, 2] = (delta[:, 2] + angle_period / 2) % angle_period - angle_period / 2
+        deltas[step] = delta
+        reconstructed += deltas[step]  # decoder sees float16 delta, so next delta corrects its rounding error
+    return deltas
@@ -0,0 +1,104 @@
+import copy
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional, Dict, Any
+
+import numpy as np
+
+from src.car_training.Environments.general_functions_provider import get_environment_class
+from src.car_training.Environments_Visualization.Episode_Recorder import Episode_Recorder
+from src.car_training.Neural_Network.Raw_Numpy.Raw_Numpy_Models.Normal.Normal_model import Normal_model
+from src.car_training.constants import CONSTANTS_DICT
+
+# the same environment as in Basic_Environment_Visualization
+environment_name = CONSTANTS_DICT["environment"]["name"]
+environment_kwargs = {
+    **CONSTANTS_DICT["environment"]["universal_kwargs"],
+    **CONSTANTS_DICT["environment"]["changeable_validation_kwargs_list"][0],
+}
+
+
+def record_episode(model: Normal_model, kwargs: Optional[Dict[str, Any]] = None) -> Episode_Recorder:
+    """
+    Runs one episode headlessly at full simulation speed, no pygame is used
+    :param model: model controlling the car
+    :param kwargs: environment kwargs, default - the same as in visualization
+    :return: recorder with poses (x, y, angle in degrees), outputs of model and rewards of each step
+    """
+    environment = get_environment_class(environment_name)(**(environment_kwargs if kwargs is None else kwargs))
+    recorder = Episode_Recorder(
+        np.array([(*environment.get_car_position(), environment.get_car_angle())]),
+        angle_period=360.0,
+        metadata={"environment": environment_name, "map_image_path": CONSTANTS_DICT["visualization"]["map_image_path"]},
+    )
+    is_alive = True
+    while is_alive:
+        state = np.array(environment.p_get_state(), dtype=np.float32).reshape(1, -1)
+        outputs = model.p_forward_pass(state)[0]
+        reward = environment.p_react(outputs)
+        recorder.record(np.array([(*environment.get_car_position(), environment.get_car_angle())]), outputs, reward)
+        is_alive = environment.p_is_alive()
+    return recorder
+
+
+class Trajectory_Preview:
+    """
+    Preview of the best individual during training, which does not stop training:
+    episode is recorded in background thread and saved to file (see Episode_Recorder), it can be played later or in separate viewer process
+    """
+    def __init__(self, log_directory: str, preview_mode: str, neural_network_kwargs: Dict[str, Any]) -> None:
+        """
+        :param log_directory: episodes are saved in log_directory/episodes
+        :param preview_mode: "file" - only save episode, "viewer" - save and play it in separate process,
+        "inline" - old blocking pygame window, "none" - no preview
+        :param neural_network_kwargs: kwargs of Normal_model used by background thread
+        """
+        if preview_mode not in ("file", "viewer", "inline", "none"):
+            raise ValueError(f"Unknown preview mode: {preview_mode}")
+        self.directory = os.path.join(log_directory, "episodes")
+        self.preview_mode = preview_mode
+        self._model = Normal_model(**neural_network_kwargs)  # used only by background thread, previews are done one by one
+        self._executor: Optional[ThreadPoolExecutor] = None  # started by the first preview, stopped by wait()
+        self._last_future: Optional[Future] = None
+
+    def preview(self, model: Normal_model, generation: int) -> None:
+        """
+        Schedules preview of model, returns immediately (unless preview_mode is "inline")
+        :param model: its parameters are copied, so it can be changed by algorithm afterwards
+        :param generation: used in file name
+        :return:
+        """
+        if self.preview_mode == "none":
+            return
+        if self.preview_mode == "inline":
+            from src.car_training.Environments_Visualization.Basic_Environment_Visualization import run_basic_environment_visualization
+            run_basic_environment_visualization(model)
+            return
+
+        if self._last_future is not None and self._last_future.done():
+            self._last_future.result()  # raises exception of previous preview
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        self._last_future = self._executor.submit(self._record_and_save, copy.deepcopy(model.get_parameters()), generation)
+
+    def wait(self) -> None:
+        """
+        Waits for the last preview and stops background thread (a new one is started by the next preview),
+        so threads do not pile up when many runs share one process
+        :return:
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._last_future is not None:
+            self._last_future.result()
+
+    def _record_and_save(self, params: Dict[str, Any], generation: int) -> None:
+        self._model.set_parameters(params)
+        file_path = os.path.join(self.directory, f"episode_{generation:06d}.npz")
+        record_episode(self._model).save(file_path)
+
+        if self.preview_mode == "viewer":
+            from src.car_training.Environments_Visualization.Basic_Environment_Visualization import play_episode
+            multiprocessing.Process(target=play_episode, args=(file_path,), daemon=True).start()
@@ -0,0 +1,167 @@
+import os
+import pickle
+import re
+import random
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class Checkpointer:
+    """
+    Periodic, atomic checkpoints of algorithm state, written by background thread so they do not block generations
+    population (2D array, rows are individuals) is saved as compressed npz, every full_every_n_saves save is full,
+    others store only rows changed since the last full checkpoint
+    other state (fitnesses, mutation controller, logs, rng state, ...) is pickled in the calling thread, so it is consistent
+    """
+    CONSTANTS_FILE = "constants_dict.pkl"
+    _FILE_PATTERN = re.compile(r"checkpoint_(\d+)_(full|delta)\.npz")
+
+    def __init__(self, directory: str, algorithm_name: str, constants_dict: Dict[str, Any], full_every_n_saves: int = 10) -> None:
+        """
+        Initializes checkpointer, nothing is written until first save
+        :param directory: directory of checkpoints, one per run
+        :param algorithm_name: name used by get_policy_search_class, it is needed to resume
+        :param constants_dict: constants of run, saved once, so run can be resumed without current constants.py
+        :param full_every_n_saves: how often full checkpoint is written, the rest are deltas
+        """
+        self.directory = directory
+        self.algorithm_name = algorithm_name
+        self.constants_dict = constants_dict
+        self.full_every_n_saves = full_every_n_saves
+
+        self._saves_number = 0
+        self._base_population: Optional[np.ndarray] = None
+        self._base_generation = -1
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._last_future: Optional[Future] = None
+
+    def save(self, generation: int, population: np.ndarray, state: Dict[str, Any]) -> None:
+        """
+        Schedules checkpoint, returns immediately, exceptions of previous save are raised here
+        :param generation: last finished generation
+        :param population: 2D array, it is copied
+        :param state: pickle-able dict, it is pickled here
+        :return:
+        """
+        self._raise_previous_error()
+        state_bytes = pickle.dumps({**state, "algorithm_name": self.algorithm_name}, protocol=pickle.HIGHEST_PROTOCOL)
+        population = np.array(population, copy=True)
+
+        is_full = self._base_population is None or self._base_population.shape != population.shape or self._saves_number % self.full_every_n_saves == 0
+        self._saves_number += 1
+        first_save = self._last_future is None
+        if is_full:
+            self._base_population = population
+            self._base_generation = generation
+        self._last_future = self._executor.submit(self._write, generation, population, self._base_population, self._base_generation, is_full, state_bytes, first_save)
+
+    def wait(self) -> None:
+        """
+        Waits until all scheduled checkpoints are written
+        :return:
+        """
+        if self._last_future is not None:
+            self._last_future.result()
+
+    def _raise_previous_error(self) -> None:
+        if self._last_future is not None and self._last_future.done():
+            self._last_future.result()
+
+    def _write(self,
+               generation: int,
+               population: np.ndarray,
+               base_population: np.ndarray,
+               base_generation: int,
+               is_full: bool,
+               state_bytes: bytes,
+               first_save: bool) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        if first_save:
+            _atomic_write(os.path.join(self.directory, self.CONSTANTS_FILE), lambda file: pickle.dump(self.constants_dict, file, protocol=pickle.HIGHEST_PROTOCOL))
+
+        arrays = {
+            "generation": np.array(generation),
+            "base_generation": np.array(base_generation),
+            "state": np.frombuffer(state_bytes, dtype=np.uint8),
+        }
+        if is_full:
+            arrays["population"] = population
+        else:
+            changed_rows = np.flatnonzero(np.any(population != base_population, axis=1))
+            arrays["changed_rows"] = changed_rows
+            arrays["rows"] = population[changed_rows]
+
+        kind = "full" if is_full else "delta"
+        _atomic_write(os.path.join(self.directory, f"checkpoint_{generation:08d}_{kind}.npz"), lambda file: np.savez_compressed(file, **arrays))
+
+        # older checkpoints are not needed after new full one
+        if is_full:
+            for file_generation, _, file_path in _list_checkpoints(self.directory):
+                if file_generation < generation:
+                    os.remove(file_path)
+
+
+def load_latest_checkpoint(directory: str) -> Tuple[int, np.ndarray, Dict[str, Any]]:
+    """
+    Loads the newest checkpoint from directory
+    :param directory: directory of Checkpointer
+    :return: generation, population, state
+    """
+    checkpoints = _list_checkpoints(directory)
+    if not checkpoints:
+        raise FileNotFoundError(f"No checkpoints in {directory}")
+    generation, kind, file_path = checkpoints[-1]
+    with np.load(file_path) as data:
+        state = pickle.loads(data["state"].tobytes())
+        if kind == "full":
+            population = data["population"]
+        else:
+            base_generation = int(data["base_generation"])
+            with np.load(os.path.join(directory, f"checkpoint_{base_generation:08d}_full.npz")) as base_data:
+                population = base_data["population"]
+            population[data["changed_rows"]] = data["rows"]
+    return generation, population, state
+
+
+def load_checkpoint_constants(directory: str) -> Dict[str, Any]:
+    """
+    Loads constants_dict saved with checkpoints
+    :param directory: directory of Checkpointer
+    :return:
+    """
+    with open(os.path.join(directory, Checkpointer.CONSTANTS_FILE), "rb") as file:
+        return pickle.load(file)
+
+
+def get_rng_state() -> Dict[str, Any]:
+    """
+    :return: state of numpy global and python random generators
+    """
+    return {"numpy": np.random.get_state(), "python": random.getstate()}
+
+
+def set_rng_state(rng_state: Dict[str, Any]) -> None:
+    np.random.set_state(rng_state["numpy"])
+    random.setstate(rng_state["python"])
+
+
+def _list_checkpoints(directory: str) -> List[Tuple[int, str, str]]:
+    if not os.path.isdir(directory):
+        return []
+    checkpoints = []
+    for file_name in os.listdir(directory):
+        match = Checkpointer._FILE_PATTERN.fullmatch(file_name)
+        if match:
+            checkpoints.append((int(match.group(1)), match.group(2), os.path.join(directory, file_name)))
+    return sorted(checkpoints)
+
+
+def _atomic_write(file_path: str, write_function) -> None:
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        write_function(file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, file_path)
@@ -2,7 +2,6 @@ import os
 import pickle
 import random
 import time
-from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List, Type
 
 import numpy as np
@@ -11,9 +10,16 @@ import pandas as pd
 from src.car_training.Environments.Abstract_Environment.Abstract_Environment import Abstract_Environment
 from src.car_training.Environments.Abstract_Environment.Abstract_Environment_Iterator import Abstract_Environment_Iterator
 from src.car_training.Environments.general_functions_provider import get_environment_class
-from src.car_training.Environments_Visualization.Basic_Environment_Visualization import run_basic_environment_visualization
+from src.car_training.Environments_Visualization.Trajectory_Preview import Trajectory_Preview
+from src.car_training.Evolutionary_Algorithms.Checkpoints.Checkpointer import Checkpointer, load_latest_checkpoint, \
+    get_rng_state, set_rng_state
+from src.car_training.Evolutionary_Algorithms.Metrics.Run_Metrics import Run_Metrics, NO_METRICS
 from src.car_training.Evolutionary_Algorithms.Mutation_Controllers.mutation_controllers_functions import \
     get_mutation_controller_by_name, Abstract_Mutation_Controller
+from src.car_training.Evolutionary_Algorithms.Population_Evaluation.Steady_State_Population import \
+    Steady_State_Population, run_steady_state
+from src.car_training.Evolutionary_Algorithms.Population_Evaluation.Worker_Pool import Worker_Pool
+from src.car_training.Neural_Network.Raw_Numpy.Parameters_Layout import Parameters_Layout
 from src.car_training.Neural_Network.Raw_Numpy.Raw_Numpy_Models.Normal.Normal_model import Normal_model
 
 
@@ -39,6 +45,8 @@ class Evolutionary_Mutate_Population:
         # self.L2 = constants_dict["Evolutionary_Mutate_Population"]["L2"]
         self.save_logs_every_n_epochs = constants_dict["Evolutionary_Mutate_Population"]["save_logs_every_n_epochs"]
         self.max_evaluations = constants_dict["Evolutionary_Mutate_Population"]["max_evaluations"]
+        self.steady_state = constants_dict["Evolutionary_Mutate_Population"]["steady_state"]
+        self.checkpoint_every_n_epochs = constants_dict["Evolutionary_Mutate_Population"]["checkpoint_every_n_epochs"]
         base_log_dir = constants_dict["Evolutionary_Mutate_Population"]["logs_path"]
 
         self.training_environments_kwargs = [
@@ -60,6 +68,9 @@ class Evolutionary_Mutate_Population:
 
         # file handling
         self.log_directory = base_log_dir + "/" + "EvMuPop" + str(int(time.time())) + "/"
+        self.checkpointer = Checkpointer(self.log_directory + "checkpoints", "Evolutionary_Mutate_Population", constants_dict)
+        self.start_generation = 0
+        self.log_list = []
         # os.makedirs(self.log_directory, exist_ok=True)
 
         #self.logger = Timestamp_Logger(file_path=self.log_directory + "log.txt", log_mode='w', log_moment='a', separator='\t')
@@ -67,6 +78,9 @@ class Evolutionary_Mutate_Population:
             constants_dict["Evolutionary_Mutate_Population"]["mutation_controller"]["name"]
         )(**constants_dict["Evolutionary_Mutate_Population"]["mutation_controller"]["kwargs"])
         self.neural_network_kwargs = constants_dict["neural_network"]
+        self.worker_pool = Worker_Pool(self.max_threads)
+        self.metrics = Run_Metrics("Evolutionary_Mutate_Population", self.log_directory, constants_dict["metrics"]["sink"], self.worker_pool)
+        self.trajectory_preview = Trajectory_Preview(self.log_directory, constants_dict["visualization"]["preview_mode"], self.neural_network_kwargs)
         self.population = [
             Immutable_Individual(self.neural_network_kwargs,
                        self.environment_class,
@@ -79,16 +93,62 @@ class Evolutionary_Mutate_Population:
             for _ in range(self.population_size)
         ]
         self.best_individual = self.population[0].copy()
+        self.layout = Parameters_Layout(self.best_individual.neural_network.get_parameters())
 
+    def load_checkpoint(self, directory: str) -> None:
+        """
+        Loads state saved by checkpointer, run() continues from the next generation
+        (mutations are drawn in worker threads, so continuation is not bit-exact)
+        :param directory: checkpoints directory of interrupted run
+        :return:
+        """
+        generation, population, state = load_latest_checkpoint(directory)
+        self.mutation_controller = state["mutation_controller"]
+        self.population = [
+            self._individual_from_vector(vector, fitness, episode_length)
+            for vector, fitness, episode_length in zip(population, state["fitnesses"], state["episode_lengths"])
+        ]
+        self.best_individual = self._individual_from_vector(state["best_vector"], state["best_fitness"], state["best_episode_length"])
+        self.log_list = state["log_list"]
+        set_rng_state(state["rng_state"])
+        self.start_generation = generation + 1
+        self.checkpointer.directory = directory
+
+    def _save_checkpoint(self, generation: int, individuals: List['Immutable_Individual']) -> None:
+        self.checkpointer.save(generation, np.stack([self.layout.flatten(individual.neural_network.get_parameters()) for individual in individuals]), {
+            "fitnesses": np.array([individual.get_fitness() for individual in individuals]),
+            "episode_lengths": np.array([individual.episode_length for individual in individuals]),
+            "best_vector": self.layout.flatten(self.best_individual.neural_network.get_parameters()),
+            "best_fitness": self.best_individual.get_fitness(),
+            "best_episode_length": self.best_individual.episode_length,
+            "mutation_controller": self.mutation_controller,
+            "log_list": self.log_list,
+            "rng_state": get_rng_state(),
+        })
+
+    def _individual_from_vector(self, vector: np.ndarray, fitness: float, episode_length: int) -> 'Immutable_Individual':
+        individual = Immutable_Individual(self.neural_network_kwargs, self.environment_class, self.training_environments_kwargs, self.mutation_controller)
+        individual.neural_network.set_parameters(self.layout.unflatten(vector))
+        individual.fitness = float(fitness)
+        individual.is_fitness_calculated = True
+        individual.episode_length = int(episode_length)
+        return individual
 
     def run(self) -> pd.DataFrame:
         """
-        Runs evolutionary algorithm
+        Runs evolutionary algorithm, threads of worker pool are stopped when it ends (also on error),
+        so they do not pile up when many runs share one process, e.g. in metaparams_tests
         :return: pd.DataFrame with logs
         """
+        with self.worker_pool:
+            if self.steady_state:
+                return self._run_steady_state()
+            return self._run_generations()
+
+    def _run_generations(self) -> pd.DataFrame:
         quantile = [0.25, 0.5, 0.75, 0.9, 0.99]
         quantile_labels = [f"quantile_{q}" for q in quantile]
-        log_list = []
+        log_list = self.log_list
 
         # with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
         #     futures = [
@@ -96,23 +156,24 @@ class Evolutionary_Mutate_Population:
         #         for individual in self.population
         #     ]
         #     results = [future.result() for future in futures]
+        self.metrics.lap(None)
 
-        for generation in range(self.epochs):
+        for generation in range(self.start_generation, self.epochs):
             print(f"Generation {generation}")
 
             time_start = time.perf_counter()
             # multi-threading
-            with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-                futures = [
-                    executor.submit(individual.copy_mutate_and_evaluate)
-                    for individual in self.population
-                ]
-                mutated_population = [future.result() for future in futures]
+            mutated_population = self.worker_pool.map(
+                lambda individual: individual.copy_mutate_and_evaluate(self.metrics),
+                self.population,
+                [individual.episode_length for individual in self.population]
+            )
             # mutated_population = [
             #     individual.copy_mutate_and_evaluate()
             #     for individual in self.population
             # ]
             # end of multi-threading
+            self.metrics.lap(None)
             time_end = time.perf_counter()
             print(f"Time: {time_end - time_start}, mean time: {(time_end - time_start) / self.population_size / 2}, mean time using one thread: {(time_end - time_start) / self.population_size / 2 * self.max_threads}")
 
@@ -153,6 +214,8 @@ class Evolutionary_Mutate_Population:
 
 
 
+            self.metrics.lap("sorting")
+
             fitnesses = np.array([individual.get_fitness() for individual in self.population])
             self.mutation_controller.commit_iteration(fitnesses)
             quantile_results = np.quantile(fitnesses, quantile)
@@ -163,8 +226,7 @@ class Evolutionary_Mutate_Population:
             evaluations = self.population_size * (2 + generation)
 
             if generation % self.save_logs_every_n_epochs == 0:
-                model = self.best_individual.neural_network
-                run_basic_environment_visualization(model)
+                self.trajectory_preview.preview(self.best_individual.neural_network, generation)
                 log_list.append(
                     {
                         "generation": generation,
@@ -175,15 +237,97 @@ class Evolutionary_Mutate_Population:
                     }
                 )
 
+            if self.checkpoint_every_n_epochs > 0 and generation % self.checkpoint_every_n_epochs == 0:
+                self._save_checkpoint(generation, self.population)
+            self.metrics.lap("logging")
+            self.metrics.end_generation(generation, mean_fitness=fitnesses.mean(), best_fitness=self.best_individual.get_fitness())
+
             # print(evaluations, self.max_evaluations)
             if evaluations >= self.max_evaluations:
                 break
 
             # print(self.mutation_controller)
+        self.checkpointer.wait()
+        self.trajectory_preview.wait()
+        self.metrics.close()
         log_data_frame = pd.DataFrame(log_list)
 
         return log_data_frame
 
+    def _run_steady_state(self) -> pd.DataFrame:
+        """
+        Runs steady-state version - each thread takes random parent, mutates it and inserts child into sorted population
+        (worst individual is removed), threads wait for each other only at milestones
+        logs and mutation controller commits are done every population_size children, it is treated as one generation
+        :return: pd.DataFrame with logs
+        """
+        quantile = [0.25, 0.5, 0.75, 0.9, 0.99]
+        quantile_labels = [f"quantile_{q}" for q in quantile]
+        log_list = self.log_list
+
+        fitnesses = self.worker_pool.map(lambda individual: individual.get_fitness(), self.population)
+        population = Steady_State_Population(self.population, fitnesses, self.population_size)
+        if population.best()[1] > self.best_individual.get_fitness():
+            self.best_individual = population.best()[0].copy()
+        time_start = time.perf_counter()
+
+        def create_child(evaluation_number: int) -> tuple[Immutable_Individual, float]:
+            child = population.sample().copy_mutate_and_evaluate(self.metrics)
+            return child, child.get_fitness()
+
+        def on_milestone(children_number: int) -> None:
+            nonlocal time_start
+            generation = self.start_generation + children_number // self.population_size - 1
+            evaluations = self.population_size * (1 + self.start_generation) + children_number
+            time_end = time.perf_counter()
+            print(f"Generation {generation}")
+            print(f"Time: {time_end - time_start}, mean time: {(time_end - time_start) / self.population_size}, mean time using one thread: {(time_end - time_start) / self.population_size * self.max_threads}")
+            time_start = time_end
+            self.metrics.lap(None)  # milestones are called one at a time, so they can use laps
+
+            individuals, fitnesses = population.snapshot()
+            if fitnesses[0] > self.best_individual.get_fitness():
+                self.best_individual = individuals[0].copy()
+            self.metrics.lap("sorting")
+
+            self.mutation_controller.commit_iteration(fitnesses)
+            quantile_results = np.quantile(fitnesses, quantile)
+            quantile_text = ", ".join([f"{quantile}: {quantile_results[i]}" for i, quantile in enumerate(quantile)])
+            print(f"Mean fitness: {fitnesses.mean()}, best fitness: {self.best_individual.get_fitness()}")
+            print(f"Quantiles: {quantile_text}\n\n")
+
+            if generation % self.save_logs_every_n_epochs == 0:
+                self.trajectory_preview.preview(self.best_individual.neural_network, generation)
+                log_list.append(
+                    {
+                        "generation": generation,
+                        "mean_fitness": fitnesses.mean(),
+                        "best_fitness": self.best_individual.get_fitness(),
+                        "evaluations": evaluations,
+                        **{label: value for label, value in zip(quantile_labels, quantile_results)}
+                    }
+                )
+
+            if self.checkpoint_every_n_epochs > 0 and generation % self.checkpoint_every_n_epochs == 0:
+                self._save_checkpoint(generation, individuals)
+            self.metrics.lap("logging")
+            self.metrics.end_generation(generation, mean_fitness=fitnesses.mean(), best_fitness=self.best_individual.get_fitness())
+
+        run_steady_state(
+            population,
+            create_child,
+            self.worker_pool,
+            min((self.epochs - self.start_generation) * self.population_size, self.max_evaluations - self.population_size * (1 + self.start_generation)),
+            self.population_size,
+            on_milestone
+        )
+        self.population = population.snapshot()[0]
+        self.checkpointer.wait()
+        self.trajectory_preview.wait()
+        self.metrics.close()
+
+        return pd.DataFrame(log_list)
+
 
 class Immutable_Individual:
     def __init__(self,
@@ -217,10 +361,12 @@ class Immutable_Individual:
 
         self.fitness = 0.0
         self.is_fitness_calculated = False
+        self.episode_length = 0  # steps in all environments during last evaluation, predicted cost of children
 
     def get_fitness(self) -> float:
         if not self.is_fitness_calculated:
             self.fitness = self.environment_iterator.get_results(self.neural_network)
+            self.episode_length = self.environment_iterator.get_last_steps()
             self.is_fitness_calculated = True
             # self.param_tree_self.params = self.neural_network.get_parameters()
             # self.param_tree_self.fitness = self.fitness
@@ -236,13 +382,13 @@ class Immutable_Individual:
         new_individual.neural_network.set_parameters(self.neural_network.get_parameters())
         new_individual.fitness = self.get_fitness()
         new_individual.is_fitness_calculated = self.is_fitness_calculated
+        new_individual.episode_length = self.episode_length
         return new_individual
 
-    def copy_mutate_and_evaluate(self) -> 'Individual':
+    def copy_mutate_and_evaluate(self, metrics: Run_Metrics = NO_METRICS) -> 'Individual':
         """
         Copies, mutates and evaluates individual
-        :param mutation_factor:
-        :param mutation_threshold: None or float - if not None, then it uses scaled mutation
+        :param metrics: metrics of run, copying with mutation and evaluation are measured as separate phases
         :return:
         """
         # if self.use_safe_mutation and (self.safe_mutation_factors is None or self.safe_mutation_factors_age >= self.safe_mutation_factor_max_age):
@@ -250,13 +396,17 @@ class Immutable_Individual:
         #     self.is_fitness_calculated = True
         #     self.safe_mutation_factors = self.neural_network.get_safe_mutation(inputs, outputs)
         #     self.safe_mutation_factors_age = 0
-        new_individual = self.copy()
+        with metrics.phase("mutation"):
+            new_individual = self.copy()
 
-        # new_individual.parent = self
-        new_individual.mutation_controller.mutate(new_individual, self)
-        new_individual.is_fitness_calculated = False
+            # new_individual.parent = self
+            new_individual.mutation_controller.mutate(new_individual, self)
+            new_individual.is_fitness_calculated = False
 
-        new_individual.get_fitness()
+        with metrics.phase("evaluation"):
+            new_individual.get_fitness()
+        metrics.count("evaluations", 1)
+        metrics.count("env_steps", new_individual.episode_length)
         # self.children.append(new_individual)
 
         return new_individual
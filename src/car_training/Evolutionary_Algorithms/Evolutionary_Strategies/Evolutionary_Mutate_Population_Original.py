@@ -2,7 +2,6 @@ import os
 import pickle
 import random
 import time
-from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List, Type
 
 import numpy as np
@@ -11,9 +10,10 @@ import pandas as pd
 from src.car_training.Environments.Abstract_Environment.Abstract_Environment import Abstract_Environment
 from src.car_training.Environments.Abstract_Environment.Abstract_Environment_Iterator import Abstract_Environment_Iterator
 from src.car_training.Environments.general_functions_provider import get_environment_class
-from src.car_training.Environments_Visualization.Basic_Environment_Visualization import run_basic_environment_visualization
+from src.car_training.Environments_Visualization.Trajectory_Preview import Trajectory_Preview
 from src.car_training.Evolutionary_Algorithms.Mutation_Controllers.mutation_controllers_functions import \
     get_mutation_controller_by_name, Abstract_Mutation_Controller
+from src.car_training.Evolutionary_Algorithms.Population_Evaluation.Worker_Pool import Worker_Pool
 from src.car_training.Neural_Network.Raw_Numpy.Raw_Numpy_Models.Normal.Normal_model import Normal_model
 
 
@@ -65,6 +65,8 @@ class Evolutionary_Mutate_Population_Original:
             constants["mutation_controller"]["name"]
         )(**constants["mutation_controller"]["kwargs"])
         self.neural_network_kwargs = constants_dict["neural_network"]
+        self.trajectory_preview = Trajectory_Preview(self.log_directory, constants_dict["visualization"]["preview_mode"], self.neural_network_kwargs)
+        self.worker_pool = Worker_Pool(self.max_threads)
         self.population = [
             Immutable_Individual(self.neural_network_kwargs,
                        self.environment_class,
@@ -81,9 +83,14 @@ class Evolutionary_Mutate_Population_Original:
 
     def run(self) -> pd.DataFrame:
         """
-        Runs evolutionary algorithm
+        Runs evolutionary algorithm, threads of worker pool are stopped when it ends (also on error),
+        so they do not pile up when many runs share one process, e.g. in metaparams_tests
         :return: pd.DataFrame with logs
         """
+        with self.worker_pool:
+            return self._run_generations()
+
+    def _run_generations(self) -> pd.DataFrame:
         quantile = [0.25, 0.5, 0.75, 0.9, 0.99]
         quantile_labels = [f"quantile_{q}" for q in quantile]
         log_list = []
@@ -102,12 +109,10 @@ class Evolutionary_Mutate_Population_Original:
             best_individuals = self.population[:self.best_base_N]
 
             # multi-threading
-            with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-                futures = [
-                    executor.submit(np.random.choice(best_individuals).copy_mutate_and_evaluate)
-                    for _ in range(self.population_size)
-                ]
-                mutated_population = [future.result() for future in futures]
+            mutated_population = self.worker_pool.map(
+                lambda parent: parent.copy_mutate_and_evaluate(),
+                [np.random.choice(best_individuals) for _ in range(self.population_size)]
+            )
             # mutated_population = [
             #     individual.copy_mutate_and_evaluate()
             #     for individual in self.population
@@ -144,8 +149,7 @@ class Evolutionary_Mutate_Population_Original:
             evaluations = self.population_size * (2 + generation)
 
             if generation % self.save_logs_every_n_epochs == 0:
-                model = self.best_individual.neural_network
-                run_basic_environment_visualization(model)
+                self.trajectory_preview.preview(self.best_individual.neural_network, generation)
                 log_list.append(
                     {
                         "generation": generation,
@@ -161,6 +165,7 @@ class Evolutionary_Mutate_Population_Original:
                 break
 
             # print(self.mutation_controller)
+        self.trajectory_preview.wait()
         log_data_frame = pd.DataFrame(log_list)
 
         return log_data_frame
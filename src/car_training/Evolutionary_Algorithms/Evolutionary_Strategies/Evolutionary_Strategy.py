@@ -1,8 +1,8 @@
 import copy
 import os
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
-from typing import Dict, Any, Tuple, List, Mapping, Type
+from typing import Dict, Any, Tuple, List, Mapping, Optional, Type
 
 import numpy as np
 import pandas as pd
@@ -11,6 +11,12 @@ from src.car_training.Environments.Abstract_Environment.Abstract_Environment imp
 from src.car_training.Environments.Abstract_Environment.Abstract_Environment_Iterator import Abstract_Environment_Iterator
 from src.car_training.Environments.general_functions_provider import get_environment_class
 from src.car_training.Environments_Visualization.Basic_Environment_Visualization import run_basic_environment_visualization
+from src.car_training.Evolutionary_Algorithms.Checkpoints.Checkpointer import Checkpointer, load_latest_checkpoint, \
+    get_rng_state, set_rng_state
+from src.car_training.Evolutionary_Algorithms.Metrics.Run_Metrics import Run_Metrics, NO_METRICS
+from src.car_training.Evolutionary_Algorithms.Population_Evaluation.Population_Evaluator import Population_Evaluator
+from src.car_training.Evolutionary_Algorithms.Population_Evaluation.Worker_Pool import Worker_Pool
+from src.car_training.Neural_Network.Raw_Numpy.Parameters_Layout import Parameters_Layout
 from src.car_training.Neural_Network.Raw_Numpy.Raw_Numpy_Models.Normal.Normal_model import Normal_model
 
 
@@ -34,6 +40,11 @@ class Evolutionary_Strategy:
         self.epochs = constants_dict["Evolutionary_Strategy"]["epochs"]
         self.sigma_change = constants_dict["Evolutionary_Strategy"]["sigma_change"]
         self.learning_rate = constants_dict["Evolutionary_Strategy"]["learning_rate"]
+        self.mirrored_sampling = constants_dict["Evolutionary_Strategy"]["mirrored_sampling"]
+        self.fitness_shaping = constants_dict["Evolutionary_Strategy"]["fitness_shaping"]
+        self.engine = constants_dict["Evolutionary_Strategy"]["engine"]
+        self.split_environments = constants_dict["Evolutionary_Strategy"]["split_environments"]
+        self.checkpoint_every_n_epochs = constants_dict["Evolutionary_Strategy"]["checkpoint_every_n_epochs"]
         self.stats_every_n_epochs = constants_dict["Evolutionary_Strategy"]["save_logs_every_n_epochs"]
         self.max_evaluations = constants_dict["Evolutionary_Strategy"]["max_evaluations"]
         self.max_threads = os.cpu_count() if constants_dict["Evolutionary_Strategy"]["max_threads"] <= 0 else constants_dict["Evolutionary_Strategy"]["max_threads"]
@@ -57,32 +68,73 @@ class Evolutionary_Strategy:
 
         # file handling
         self.log_directory = base_log_dir + "/" + "EvSt" + str(int(time.time())) + "/"
+        self.checkpointer = Checkpointer(self.log_directory + "checkpoints", "Evolutionary_Strategy", constants_dict)
+        self.start_generation = 0
+        self.log_list = []
         # os.makedirs(self.log_directory, exist_ok=True)
 
         # self.logger = Timestamp_Logger(file_path=self.log_directory + "log.txt", log_mode='w', log_moment='a', separator='\t')
 
         self.neural_network_kwargs = constants_dict["neural_network"]
+        self.worker_pool = Worker_Pool(self.max_threads)
+        self.metrics = Run_Metrics("Evolutionary_Strategy", self.log_directory, constants_dict["metrics"]["sink"], self.worker_pool)
         self.individual = Individual(self.neural_network_kwargs, self.environment_class, self.training_environments_kwargs)
+        if self.engine == "batched":
+            self.population_evaluator = Population_Evaluator(self.neural_network_kwargs, self.environment_class, self.training_environments_kwargs, self.worker_pool, self.split_environments, self.metrics)
+        elif self.engine != "streaming":
+            raise ValueError(f"Unknown Evolutionary_Strategy engine: {self.engine}")
+        self.layout = Parameters_Layout(self.individual.neural_network.get_parameters())
 
-
-
+    def load_checkpoint(self, directory: str) -> None:
+        """
+        Loads state saved by checkpointer, run() continues from the next generation, it is bit-exact continuation
+        :param directory: checkpoints directory of interrupted run
+        :return:
+        """
+        generation, population, state = load_latest_checkpoint(directory)
+        self.individual.neural_network.set_parameters(self.layout.unflatten(population[0]))
+        self.individual.is_fitness_calculated = False
+        self.log_list = state["log_list"]
+        set_rng_state(state["rng_state"])
+        self.start_generation = generation + 1
+        self.checkpointer.directory = directory
+
+    def _save_checkpoint(self, generation: int) -> None:
+        self.checkpointer.save(generation, self.layout.flatten(self.individual.neural_network.get_parameters())[np.newaxis, :], {
+            "log_list": self.log_list,
+            "rng_state": get_rng_state(),
+        })
 
     def run(self) -> pd.DataFrame:
         """
-        Runs evolutionary algorithm
+        Runs evolutionary algorithm, threads of worker pool are stopped when it ends (also on error),
+        so they do not pile up when many runs share one process, e.g. in metaparams_tests
         :return:
         """
-        log_list = []
+        with self.worker_pool:
+            return self._run_generations()
+
+    def _run_generations(self) -> pd.DataFrame:
+        log_list = self.log_list
+        self.metrics.lap(None)
 
-        for generation in range(self.epochs):
+        for generation in range(self.start_generation, self.epochs):
             print(f"Generation {generation}")
 
             time_start = time.perf_counter()
-            fitnesses = self.individual.evolutionary_strategy_one_epoch(self.permutations, self.sigma_change, self.learning_rate, self.max_threads)
+            if self.engine == "batched":
+                fitnesses = self._batched_one_epoch()
+            else:
+                fitnesses = self.individual.evolutionary_strategy_one_epoch(self.permutations, self.sigma_change, self.learning_rate, self.worker_pool, self.mirrored_sampling, self.fitness_shaping, self.metrics)
             time_end = time.perf_counter()
 
             print(f"Time: {time_end - time_start}, mean time: {(time_end - time_start) / self.permutations}, mean time using one thread: {(time_end - time_start) / self.permutations * self.max_threads}")
 
+            self.individual.get_fitness()  # main individual is evaluated once per generation, later calls are cached
+            self.metrics.lap("evaluation")
+            self.metrics.count("evaluations", 1)
+            self.metrics.count("env_steps", self.individual.environment_iterator.get_last_steps())
+
             quantile = [0.25, 0.5, 0.75, 0.9, 0.99]
             quantile_results = np.quantile(fitnesses, quantile)
             quantile_text = ", ".join([f"{quantile}: {quantile_results[i]}" for i, quantile in enumerate(quantile)])
@@ -104,14 +156,69 @@ class Evolutionary_Strategy:
                 )
             print("Evolutionary strategy")
 
+            if self.checkpoint_every_n_epochs > 0 and generation % self.checkpoint_every_n_epochs == 0:
+                self._save_checkpoint(generation)
+            self.metrics.lap("logging")
+            self.metrics.end_generation(generation, mean_fitness=fitnesses.mean(), best_fitness=max(fitnesses), main_fitness=self.individual.get_fitness())
+
             if evaluations >= self.max_evaluations:
                 break
 
             # print(self.mutation_controller)
+        self.checkpointer.wait()
+        self.metrics.close()
         log_data_frame = pd.DataFrame(log_list)
 
         return log_data_frame
 
+    def _batched_one_epoch(self) -> np.ndarray:
+        """
+        One step of evolutionary strategy using Population_Evaluator, all perturbations are evaluated as one population matrix,
+        with mirrored_sampling rows are +noise and -noise pairs, so half of noise vectors is needed
+        :return: fitnesses of all perturbations, mirrored ones are in the second half
+        """
+        layout = self.population_evaluator.layout
+        base_vector = layout.flatten(self.individual.neural_network.get_parameters())
+        signs = (1.0, -1.0) if self.mirrored_sampling else (1.0,)
+        noise_number = max(self.permutations // len(signs), 1)
+
+        noise = np.random.standard_normal((noise_number, layout.size)).astype(np.float32)
+        population = np.concatenate([base_vector + sign * self.sigma_change * noise for sign in signs])
+        self.metrics.lap("mutation")
+        fitnesses = self.population_evaluator.evaluate(population)
+        self.metrics.lap(None)
+        del population
+
+        shaped_fitnesses = shape_fitnesses(fitnesses, self.fitness_shaping)
+        noise_weights = shaped_fitnesses.reshape(len(signs), noise_number).T @ np.array(signs)
+        multiply_factor = self.learning_rate / (fitnesses.shape[0] * self.sigma_change)
+        base_vector += (multiply_factor * (noise_weights @ noise)).astype(np.float32)
+
+        self.individual.neural_network.set_parameters(layout.unflatten(base_vector))
+        self.individual.is_fitness_calculated = False
+        self.metrics.lap("sorting")
+        return fitnesses
+
+
+def shape_fitnesses(fitnesses: np.ndarray, fitness_shaping: str) -> np.ndarray:
+    """
+    Transforms raw fitnesses into weights used in gradient estimation
+    :param fitnesses: raw fitnesses
+    :param fitness_shaping: "z_score" - (f - mean) / std, "centered_rank" - ranks scaled to [-0.5, 0.5], insensitive to outliers
+    :return: shaped fitnesses, they sum to 0
+    """
+    if fitness_shaping == "centered_rank":
+        if fitnesses.shape[0] < 2:
+            return np.zeros_like(fitnesses, dtype=float)
+        ranks = np.empty(fitnesses.shape[0], dtype=float)
+        ranks[np.argsort(fitnesses, kind="stable")] = np.arange(fitnesses.shape[0])
+        return ranks / (fitnesses.shape[0] - 1) - 0.5
+    elif fitness_shaping == "z_score":
+        std = np.std(fitnesses)
+        return (fitnesses - np.mean(fitnesses)) / (std if std != 0 else 1.0)
+    else:
+        raise ValueError(f"Unknown fitness shaping: {fitness_shaping}")
+
 
 class Individual:
     def __init__(self,
@@ -140,6 +247,7 @@ class Individual:
 
         self.fitness = 0.0
         self.is_fitness_calculated = False
+        self._thread_local_data = threading.local()
 
     def get_fitness(self) -> float:
         if not self.is_fitness_calculated:
@@ -184,72 +292,87 @@ class Individual:
 
         return new_individual
 
-    def evolutionary_strategy_one_epoch(self, number_of_individuals: int, sigma_change: float, alpha_learning_rate: float, num_of_processes: int) -> np.ndarray:
+    def evolutionary_strategy_one_epoch(self,
+                                        number_of_individuals: int,
+                                        sigma_change: float,
+                                        alpha_learning_rate: float,
+                                        worker_pool: Worker_Pool,
+                                        mirrored_sampling: bool = True,
+                                        fitness_shaping: str = "z_score",
+                                        metrics: Optional[Run_Metrics] = None) -> np.ndarray:
         """
         It performs one step of evolutionary strategy, modifies self inplace
-        :param number_of_individuals:
-        :param sigma_change:
+        Perturbations are never kept in memory - only (seed, fitness) pairs are stored, noise is regenerated from seeds
+        when gradient is estimated, so memory does not grow with number_of_individuals
+        :param number_of_individuals: number of evaluated perturbations
+        :param sigma_change: sigma of perturbations
         :param alpha_learning_rate:
-        :param num_of_processes:
+        :param worker_pool: pool used for evaluation, each of its threads keeps one evaluator between epochs
+        :param mirrored_sampling: if True, each seed is evaluated as +noise and -noise (antithetic pair)
+        :param fitness_shaping: "z_score" or "centered_rank", see shape_fitnesses
+        :param metrics: metrics of run, main thread uses lap(), workers measure noise generation and evaluation with phase()
         :return: fitnesses of all mutated individuals
         """
-
+        metrics = metrics if metrics is not None else NO_METRICS
+        self_params = self.neural_network.get_parameters()
+        layout = Parameters_Layout(self_params)
+        base_vector = layout.flatten(self_params)
+        signs = (1.0, -1.0) if mirrored_sampling else (1.0,)
+        seeds_number = max(number_of_individuals // len(signs), 1)
+        seeds = np.random.randint(0, 2**31 - 1, size=seeds_number)
+        metrics.lap("mutation")
         # multi-threading
-        print("start_collecting")
-        params = [self.neural_network.get_parameters() for _ in range(number_of_individuals)]
-        with ThreadPoolExecutor(max_workers=num_of_processes) as executor:
-            futures = [
-                executor.submit(self.copy_mutate_and_evaluate, sigma_change, params[i])
-                for i in range(number_of_individuals)
-            ]
-            individuals_mutated = [future.result() for future in futures]
-        print("end_collecting")
-        # params = self.neural_network.get_parameters()
-        # individuals_mutated = [self.copy_mutate_and_evaluate(sigma_change, params[i]) for i in range(number_of_individuals)]
+        fitnesses = np.array(worker_pool.map(
+            lambda seed_and_sign: self._evaluate_perturbation(layout, base_vector, seed_and_sign[0], seed_and_sign[1] * sigma_change, metrics),
+            [(int(seed), sign) for seed in seeds for sign in signs]
+        ), dtype=float)
         # end of multi-threading
+        metrics.lap(None)
+
+        fitnesses_normalized = shape_fitnesses(fitnesses, fitness_shaping)
+        seeds_weights = fitnesses_normalized.reshape(seeds_number, len(signs)) @ np.array(signs)
+        multiply_factor = alpha_learning_rate / (fitnesses.shape[0] * sigma_change)
 
-        print("Start NN proceeding")
-        fitnesses = np.array([individual.get_fitness() for individual in individuals_mutated], dtype=float)
-        fitnesses_normalized = (fitnesses - np.mean(fitnesses)) / (np.std(fitnesses) if np.std(fitnesses) != 0 else 1.0)
-        multiply_factor = alpha_learning_rate / (number_of_individuals * sigma_change)
-        change_amount = fitnesses_normalized * multiply_factor
-        other_policies_params = [individual.neural_network.get_parameters() for individual in individuals_mutated]
-        self_policy_params = self.neural_network.get_parameters()
-        self._actualise_policy_dict_params(self_policy_params, other_policies_params, change_amount, [])
-        self.neural_network.set_parameters(self_policy_params)
-        print("End NN proceeding")
+        gradient = np.zeros(layout.size, dtype=np.float64)
+        for seed, weight in zip(seeds, seeds_weights):
+            gradient += weight * self._get_noise(int(seed), layout.size)
+        base_vector += (multiply_factor * gradient).astype(np.float32)
+        self.neural_network.set_parameters(layout.unflatten(base_vector))
 
         self.is_fitness_calculated = False
+        metrics.lap("sorting")
 
         return fitnesses
 
-    def _actualise_policy_dict_params(self, main_policy: Dict[str, Any], other_policies: List[Dict[str, Any]], change_amount: np.ndarray, key_list: List[str]) -> None:
+    def _evaluate_perturbation(self, layout: Parameters_Layout, base_vector: np.ndarray, seed: int, scale: float, metrics: Run_Metrics) -> float:
         """
-        Actualises policy dictionary parameters
-        :param main_policy: current main policy part of params
-        :param other_policies: list of other policies
-        :param change_amount: fitnesses * multiply_factor
-        :param key_list: list of keys to get to the parameter
-        :return:
+        Evaluates base_vector + scale * noise(seed), uses one model and environments per thread
+        :param layout: parameters layout of self.neural_network
+        :param base_vector: flat parameters of self, not modified
+        :param seed: seed of noise
+        :param scale: sigma with sign of perturbation
+        :param metrics: metrics of run
+        :return: fitness
         """
-        for key, value in main_policy.items():
-            key_list.append(key)
-            if isinstance(value, dict):
-                self._actualise_policy_dict_params(value, other_policies, change_amount, key_list)
-            elif isinstance(value, np.ndarray):
-                param_array_double = value.astype(np.float64)
-                for i in range(len(change_amount)):
-                    param_array_double += change_amount[i] * self._get_element_from_dict(other_policies[i], key_list)
-                main_policy[key] = param_array_double.astype(np.float32)
-            key_list.pop()
-
-    def _get_element_from_dict(self, dictionary: Dict[str, Any], key_list: List[str]) -> Any:
-        """
-        Gets element from dictionary by key list
-        :param dictionary:
-        :param key_list:
-        :return:
+        if not hasattr(self._thread_local_data, "evaluator"):
+            self._thread_local_data.evaluator = Individual(self.neural_network_params, self.environment_class, self.environments_kwargs)
+        evaluator = self._thread_local_data.evaluator
+        with metrics.phase("mutation"):
+            perturbed_vector = base_vector + scale * self._get_noise(seed, layout.size)
+            evaluator.neural_network.set_parameters(layout.unflatten(perturbed_vector))
+        evaluator.is_fitness_calculated = False
+        with metrics.phase("evaluation"):
+            fitness = evaluator.get_fitness()
+        metrics.count("evaluations", 1)
+        metrics.count("env_steps", evaluator.environment_iterator.get_last_steps())
+        return fitness
+
+    @staticmethod
+    def _get_noise(seed: int, size: int) -> np.ndarray:
+        """
+        Generates standard normal noise, the same seed always gives the same noise
+        :param seed:
+        :param size:
+        :return: float32 vector
         """
-        for key in key_list:
-            dictionary = dictionary[key]
-        return dictionary
+        return np.random.default_rng(seed).standard_normal(size, dtype=np.float32)
@@ -2,14 +2,21 @@ from typing import Any, List, Dict, Type
 import numpy as np
 from src.car_training.Environments.Abstract_Environment.Abstract_Environment import Abstract_Environment
 from src.car_training.Environments.Abstract_Environment.Abstract_Environment_Iterator import Abstract_Environment_Iterator
+from src.car_training.Neural_Network.Raw_Numpy.Parameters_Layout import Parameters_Layout
 from src.car_training.Neural_Network.Raw_Numpy.Raw_Numpy_Models.Normal.Normal_model import Normal_model
 
 import os
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 
 from src.car_training.Environments.general_functions_provider import get_environment_class
+from src.car_training.Evolutionary_Algorithms.Checkpoints.Checkpointer import Checkpointer, load_latest_checkpoint, \
+    get_rng_state, set_rng_state
+from src.car_training.Evolutionary_Algorithms.Metrics.Run_Metrics import Run_Metrics, NO_METRICS
+from src.car_training.Evolutionary_Algorithms.Population_Evaluation.Steady_State_Population import \
+    Steady_State_Population, run_steady_state
+from src.car_training.Evolutionary_Algorithms.Population_Evaluation.Worker_Pool import Worker_Pool
 
 
 class GESMR:
@@ -35,6 +42,8 @@ class GESMR:
         self.individual_ratio_breed = gesmr_dict["individual_ratio_breed"]
         self.mutation_ratio_breed = gesmr_dict["mutation_ratio_breed"]
         self.mutation_ratio_mutate = gesmr_dict["mutation_ratio_mutate"]
+        self.steady_state = gesmr_dict["steady_state"]
+        self.checkpoint_every_n_epochs = gesmr_dict["checkpoint_every_n_epochs"]
 
         self.save_logs_every_n_epochs = gesmr_dict["save_logs_every_n_epochs"]
         base_log_dir = gesmr_dict["logs_path"]
@@ -59,9 +68,14 @@ class GESMR:
         # file handling
         self.log_directory = base_log_dir + "/" + "GESMR" + str(int(time.time())) + "/"
         os.makedirs(self.log_directory, exist_ok=True)
+        self.checkpointer = Checkpointer(self.log_directory + "checkpoints", "GESMR", constants_dict)
+        self.start_generation = 0
+        self.log_list = []
 
         #self.logger = Timestamp_Logger(file_path=self.log_directory + "log.txt", log_mode='w', log_moment='a', separator='\t')
         self.neural_network_kwargs = constants_dict["neural_network"]
+        self.worker_pool = Worker_Pool(self.max_threads)
+        self.metrics = Run_Metrics("GESMR", self.log_directory, constants_dict["metrics"]["sink"], self.worker_pool)
         self.population = [
             GESMR_Immutable_Individual(self.neural_network_kwargs,
                        self.environment_class,
@@ -71,6 +85,46 @@ class GESMR:
         self.mutation_population = []
         self.best_individual = self.population[0]
         self.mutations = self._init_mutations(self.mut_range, self.k_groups)
+        self.layout = Parameters_Layout(self.best_individual.neural_network.get_parameters())
+
+    def load_checkpoint(self, directory: str) -> None:
+        """
+        Loads state saved by checkpointer, run() continues from the next generation
+        (mutations are drawn in worker threads, so continuation is not bit-exact)
+        :param directory: checkpoints directory of interrupted run
+        :return:
+        """
+        generation, population, state = load_latest_checkpoint(directory)
+        self.population = [
+            self._individual_from_vector(vector, fitness, episode_length)
+            for vector, fitness, episode_length in zip(population, state["fitnesses"], state["episode_lengths"])
+        ]
+        self.best_individual = self._individual_from_vector(state["best_vector"], state["best_fitness"], state["best_episode_length"])
+        self.mutations = state["mutations"]
+        self.log_list = state["log_list"]
+        set_rng_state(state["rng_state"])
+        self.start_generation = generation + 1
+        self.checkpointer.directory = directory
+
+    def _save_checkpoint(self, generation: int, individuals: List['GESMR_Immutable_Individual']) -> None:
+        self.checkpointer.save(generation, np.stack([self.layout.flatten(individual.neural_network.get_parameters()) for individual in individuals]), {
+            "fitnesses": np.array([individual.get_fitness() for individual in individuals]),
+            "episode_lengths": np.array([individual.episode_length for individual in individuals]),
+            "best_vector": self.layout.flatten(self.best_individual.neural_network.get_parameters()),
+            "best_fitness": self.best_individual.get_fitness(),
+            "best_episode_length": self.best_individual.episode_length,
+            "mutations": self.mutations,
+            "log_list": self.log_list,
+            "rng_state": get_rng_state(),
+        })
+
+    def _individual_from_vector(self, vector: np.ndarray, fitness: float, episode_length: int) -> 'GESMR_Immutable_Individual':
+        individual = GESMR_Immutable_Individual(self.neural_network_kwargs, self.environment_class, self.training_environments_kwargs)
+        individual.neural_network.set_parameters(self.layout.unflatten(vector))
+        individual.fitness = float(fitness)
+        individual.is_fitness_calculated = True
+        individual.episode_length = int(episode_length)
+        return individual
 
     @staticmethod
     def _init_mutations(mut_range: tuple[float, float], size: int) -> np.ndarray:
@@ -83,24 +137,41 @@ class GESMR:
         mutation_factors = np.linspace(mut_range[0], mut_range[1], size)
         return mutation_factors
 
+    def _update_mutations(self, deltas_per_mutation: np.ndarray) -> None:
+        """
+        Breeds new mutation factors from the ones that gave the biggest improvements over parents
+        :param deltas_per_mutation: best (clipped to >= 0) child - parent fitness difference for each mutation factor
+        :return:
+        """
+        sorted_mutations = np.array(self.mutations[np.argsort(deltas_per_mutation)[::-1]])
+        sorted_mutations = sorted_mutations[:int(self.k_groups * self.mutation_ratio_breed)]
+        mutations = np.random.choice(sorted_mutations, self.k_groups)
+        mutations = mutations * (self.mutation_ratio_mutate ** np.random.uniform(-1,1, self.k_groups))
+        mutations = np.clip(mutations, self.mut_range[0], self.mut_range[1])
+        mutations[0] = sorted_mutations[0]
+        self.mutations = mutations
+
 
     def run(self) -> pd.DataFrame:
         """
-        Runs evolutionary algorithm
+        Runs evolutionary algorithm, threads of worker pool are stopped when it ends (also on error),
+        so they do not pile up when many runs share one process, e.g. in metaparams_tests
         :return: pd.DataFrame with logs
         """
+        with self.worker_pool:
+            if self.steady_state:
+                return self._run_steady_state()
+            return self._run_generations()
+
+    def _run_generations(self) -> pd.DataFrame:
         quantile = [0.25, 0.5, 0.75, 0.9, 0.99]
         quantile_labels = [f"quantile_{q}" for q in quantile]
-        log_list = []
-        with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-            futures = [
-                executor.submit(individual.get_fitness)
-                for individual in self.population
-            ]
-            _ = [future.result() for future in futures]
+        log_list = self.log_list
+        self.worker_pool.map(lambda individual: individual.get_fitness(), self.population)
         self.population = sorted(self.population, key=lambda individual: individual.get_fitness(), reverse=True)
+        self.metrics.lap(None)
 
-        for generation in range(self.epochs):
+        for generation in range(self.start_generation, self.epochs):
             print(f"Generation {generation}")
             print(f"mutations: {', '.join([f'{mutation:.3f}' for mutation in sorted(self.mutations)])}")
 
@@ -109,33 +180,29 @@ class GESMR:
                 (np.random.choice(individuals_to_choose_from), self.mutations[i // self.group_size])
                 for i in range(self.population_size)
             ]
+            self.metrics.lap("mutation")
 
 
             time_start = time.perf_counter()
             # multi-threading
-            with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-                futures = [
-                    executor.submit(mutation_tuple[0].copy_mutate_and_evaluate, mutation_tuple[1])
-                    for mutation_tuple in mutation_tuples
-                ]
-                mutated_population = [future.result() for future in futures]
+            mutated_population = self.worker_pool.map(
+                lambda mutation_tuple: mutation_tuple[0].copy_mutate_and_evaluate(mutation_tuple[1], self.metrics),
+                mutation_tuples,
+                [mutation_tuple[0].episode_length for mutation_tuple in mutation_tuples]
+            )
             # mutated_population = [
             #     individual.copy_mutate_and_evaluate()
             #     for individual in self.population
             # ]
             # end of multi-threading
+            self.metrics.lap(None)
             time_end = time.perf_counter()
             print(f"Time: {time_end - time_start}, mean time: {(time_end - time_start) / self.population_size / 2}, mean time using one thread: {(time_end - time_start) / self.population_size / 2 * self.max_threads}")
 
             deltas = np.array([individual.get_fitness() for individual in mutated_population]) - np.array([mutation_tuple[0].get_fitness() for mutation_tuple in mutation_tuples])
             deltas = np.clip(deltas, 0, None)
             deltas_per_mutation = np.array([np.max(deltas[i * self.group_size: (i + 1) * self.group_size]) for i in range(self.k_groups)])
-            sorted_mutations = np.array(self.mutations[np.argsort(deltas_per_mutation)[::-1]])
-            sorted_mutations = sorted_mutations[:int(self.k_groups * self.mutation_ratio_breed)]
-            self.mutations = np.random.choice(sorted_mutations, self.k_groups)
-            self.mutations = self.mutations * (self.mutation_ratio_mutate ** np.random.uniform(-1,1, self.k_groups))
-            self.mutations = np.clip(self.mutations, self.mut_range[0], self.mut_range[1])
-            self.mutations[0] = sorted_mutations[0]
+            self._update_mutations(deltas_per_mutation)
 
             best_individual = max(self.population, key=lambda individual: individual.get_fitness())
 
@@ -148,6 +215,8 @@ class GESMR:
                 key=lambda individual: individual.get_fitness(),
                 reverse=True
             )[:self.population_size]
+            self.metrics.count("cache_hits", self.population_size - len({id(mutation_tuple[0]) for mutation_tuple in mutation_tuples}))  # individuals that were not chosen as parents
+            self.metrics.lap("sorting")
 
             fitnesses = np.array([individual.get_fitness() for individual in self.population])
             quantile_results = np.quantile(fitnesses, quantile)
@@ -167,11 +236,92 @@ class GESMR:
                     }
                 )
 
+            if self.checkpoint_every_n_epochs > 0 and generation % self.checkpoint_every_n_epochs == 0:
+                self._save_checkpoint(generation, self.population)
+            self.metrics.lap("logging")
+            self.metrics.end_generation(generation, mean_fitness=fitnesses.mean(), best_fitness=self.best_individual.get_fitness())
+
             # print(self.mutation_controller)
+        self.checkpointer.wait()
+        self.metrics.close()
         log_data_frame = pd.DataFrame(log_list)
 
         return log_data_frame
 
+    def _run_steady_state(self) -> pd.DataFrame:
+        """
+        Runs steady-state version - each thread takes parent from the best part of population, mutates it with mutation factor
+        of its group and inserts child into sorted population, threads wait for each other only at milestones
+        every population_size children mutation factors are updated and logs are done, it is treated as one generation
+        :return: pd.DataFrame with logs
+        """
+        quantile = [0.25, 0.5, 0.75, 0.9, 0.99]
+        quantile_labels = [f"quantile_{q}" for q in quantile]
+        log_list = self.log_list
+
+        fitnesses = self.worker_pool.map(lambda individual: individual.get_fitness(), self.population)
+        population = Steady_State_Population(self.population, fitnesses, self.population_size)
+        if population.best()[1] > self.best_individual.get_fitness():
+            self.best_individual = population.best()[0]
+        deltas_lock = threading.Lock()
+        deltas_per_mutation = np.zeros(self.k_groups)
+        time_start = time.perf_counter()
+
+        def create_child(evaluation_number: int) -> tuple[GESMR_Immutable_Individual, float]:
+            group = evaluation_number % self.k_groups
+            parent = population.sample(self.individual_ratio_breed)
+            child = parent.copy_mutate_and_evaluate(self.mutations[group], self.metrics)  # milestones do not run during evaluations
+            with deltas_lock:
+                deltas_per_mutation[group] = max(deltas_per_mutation[group], child.get_fitness() - parent.get_fitness())
+            return child, child.get_fitness()
+
+        def on_milestone(children_number: int) -> None:
+            nonlocal time_start
+            generation = self.start_generation + children_number // self.population_size - 1
+            time_end = time.perf_counter()
+            print(f"Generation {generation}")
+            print(f"Time: {time_end - time_start}, mean time: {(time_end - time_start) / self.population_size}, mean time using one thread: {(time_end - time_start) / self.population_size * self.max_threads}")
+            time_start = time_end
+            self.metrics.lap(None)  # milestones are called one at a time, so they can use laps
+
+            with deltas_lock:
+                self._update_mutations(deltas_per_mutation.copy())
+                deltas_per_mutation[:] = 0
+            print(f"mutations: {', '.join([f'{mutation:.3f}' for mutation in sorted(self.mutations)])}")
+
+            individuals, fitnesses = population.snapshot()
+            if fitnesses[0] > self.best_individual.get_fitness():
+                self.best_individual = individuals[0]
+            self.metrics.lap("sorting")
+
+            quantile_results = np.quantile(fitnesses, quantile)
+            quantile_text = ", ".join([f"{quantile}: {quantile_results[i]}" for i, quantile in enumerate(quantile)])
+            print(f"Mean fitness: {fitnesses.mean()}, best fitness: {self.best_individual.get_fitness()}")
+            print(f"Quantiles: {quantile_text}\n\n")
+
+            if generation % self.save_logs_every_n_epochs == 0:
+                log_list.append(
+                    {
+                        "generation": generation,
+                        "mean_fitness": fitnesses.mean(),
+                        "best_fitness": self.best_individual.get_fitness(),
+                        "evaluations": self.population_size * (1 + self.start_generation) + children_number,
+                        **{label: value for label, value in zip(quantile_labels, quantile_results)}
+                    }
+                )
+
+            if self.checkpoint_every_n_epochs > 0 and generation % self.checkpoint_every_n_epochs == 0:
+                self._save_checkpoint(generation, individuals)
+            self.metrics.lap("logging")
+            self.metrics.end_generation(generation, mean_fitness=fitnesses.mean(), best_fitness=self.best_individual.get_fitness())
+
+        run_steady_state(population, create_child, self.worker_pool, (self.epochs - self.start_generation) * self.population_size, self.population_size, on_milestone)
+        self.population = population.snapshot()[0]
+        self.checkpointer.wait()
+        self.metrics.close()
+
+        return pd.DataFrame(log_list)
+
 
 class GESMR_Immutable_Individual:
     def __init__(self,
@@ -196,10 +346,12 @@ class GESMR_Immutable_Individual:
 
         self.fitness = 0.0
         self.is_fitness_calculated = False
+        self.episode_length = 0  # steps in all environments during last evaluation, predicted cost of children
 
     def get_fitness(self) -> float:
         if not self.is_fitness_calculated:
             self.fitness = self.environment_iterator.get_results(self.neural_network)
+            self.episode_length = self.environment_iterator.get_last_steps()
             self.is_fitness_calculated = True
             # self.param_tree_self.params = self.neural_network.get_parameters()
             # self.param_tree_self.fitness = self.fitness
@@ -212,21 +364,27 @@ class GESMR_Immutable_Individual:
         new_individual.neural_network.set_parameters(self.neural_network.get_parameters())
         new_individual.fitness = self.get_fitness()
         new_individual.is_fitness_calculated = self.is_fitness_calculated
+        new_individual.episode_length = self.episode_length
         return new_individual
 
-    def copy_mutate_and_evaluate(self, mutation_factor: float) -> 'GESMR_Immutable_Individual':
+    def copy_mutate_and_evaluate(self, mutation_factor: float, metrics: Run_Metrics = NO_METRICS) -> 'GESMR_Immutable_Individual':
         """
         Copies, mutates and evaluates individual
         :param mutation_factor:
+        :param metrics: metrics of run, copying with mutation and evaluation are measured as separate phases
         """
-        new_individual = self._copy()
-
-        new_individual_params = new_individual.neural_network.get_parameters()
-        GESMR_Immutable_Individual._permute(new_individual_params, mutation_factor)
-        new_individual.neural_network.set_parameters(new_individual_params)
-        new_individual.is_fitness_calculated = False
-
-        new_individual.get_fitness()
+        with metrics.phase("mutation"):
+            new_individual = self._copy()
+
+            new_individual_params = new_individual.neural_network.get_parameters()
+            GESMR_Immutable_Individual._permute(new_individual_params, mutation_factor)
+            new_individual.neural_network.set_parameters(new_individual_params)
+            new_individual.is_fitness_calculated = False
+
+        with metrics.phase("evaluation"):
+            new_individual.get_fitness()
+        metrics.count("evaluations", 1)
+        metrics.count("env_steps", new_individual.episode_length)
 
         return new_individual
 
@@ -2,17 +2,18 @@ import os
 import pickle
 import random
 import time
-from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any
 
 import numpy as np
 import pandas as pd
 
 from src.car_training.Environments.general_functions_provider import get_environment_class
-from src.car_training.Environments_Visualization.Basic_Environment_Visualization import run_basic_environment_visualization
+from src.car_training.Environments_Visualization.Trajectory_Preview import Trajectory_Preview
 from src.car_training.Evolutionary_Algorithms._depracated_Individual import Individual
+from src.car_training.Evolutionary_Algorithms.Metrics.Run_Metrics import Run_Metrics
 from src.car_training.Evolutionary_Algorithms.Mutation_Controllers.mutation_controllers_functions import \
     get_mutation_controller_by_name, Abstract_Mutation_Controller
+from src.car_training.Evolutionary_Algorithms.Population_Evaluation.Worker_Pool import Worker_Pool
 
 
 class Param_Les_Ev_Mut_Pop:
@@ -64,15 +65,24 @@ class Param_Les_Ev_Mut_Pop:
         self.self_dict = self_dict
 
         self.best_individual = None
+        self.worker_pool = Worker_Pool(self.max_threads)
+        self.metrics = Run_Metrics("Param_Les_Ev_Mut_Pop", self.log_directory, constants_dict["metrics"]["sink"], self.worker_pool)
+        self.trajectory_preview = Trajectory_Preview(self.log_directory, constants_dict["visualization"]["preview_mode"], constants_dict["neural_network"])
 
 
     def run(self) -> pd.DataFrame:
         """
-        Runs evolutionary algorithm
+        Runs evolutionary algorithm, threads of worker pool are stopped when it ends (also on error),
+        so they do not pile up when many runs share one process, e.g. in metaparams_tests
         :return: pd.DataFrame with logs
         """
+        with self.worker_pool:
+            return self._run_generations()
+
+    def _run_generations(self) -> pd.DataFrame:
         log_list = []
         single_populations: dict[int, Single_Population] = {}
+        self.metrics.lap(None)
 
         for generation in range(self.epochs):
             print(f"Generation {generation}")
@@ -98,7 +108,8 @@ class Param_Les_Ev_Mut_Pop:
                 # print("fdsa")
 
             print(f"Population: {real_level} pop size: {single_populations[real_level].population_size}")
-            single_populations[real_level].generation()
+            current_population = single_populations[real_level]
+            current_population.generation()
 
             if not self.best_individual or single_populations[real_level].best_individual.get_fitness() > self.best_individual.get_fitness():
                 self.best_individual = single_populations[real_level].best_individual.copy()
@@ -123,17 +134,21 @@ class Param_Les_Ev_Mut_Pop:
             # if i != real_level and single_populations[i].mean_fitness < single_populations[real_level].mean_fitness:
                 single_populations.pop(i)
                 print(f"\n\n\nRemoved level {i}\n\n\n")
+            self.metrics.lap("sorting")
 
 
             if generation % self.save_logs_every_n_epochs == 0:
-                model = self.best_individual.neural_network
-                run_basic_environment_visualization(model)
+                self.trajectory_preview.preview(self.best_individual.neural_network, generation)
                 log_list.append(
                     {
                         "generation": generation,
                         "best_fitness": self.best_individual.get_fitness(),
                     }
                 )
+            self.metrics.lap("logging")
+            self.metrics.end_generation(generation, mean_fitness=current_population.mean_fitness, best_fitness=self.best_individual.get_fitness())
+        self.trajectory_preview.wait()
+        self.metrics.close()
         log_data_frame = pd.DataFrame(log_list)
 
         return log_data_frame
@@ -150,21 +165,21 @@ class Param_Les_Ev_Mut_Pop:
                        mutation_controller)
             for _ in range(size)
         ]
-        max_threads = self.self_dict["max_threads"]
-        return Single_Population(population, mutation_controller, max_threads)
+        return Single_Population(population, mutation_controller, self.worker_pool, self.metrics)
 
 
 class Single_Population:
     quantile_values = (0.25, 0.5, 0.75)
 
-    def __init__(self, population: list[Individual], mutation_controller: Abstract_Mutation_Controller, threads_num: int):
+    def __init__(self, population: list[Individual], mutation_controller: Abstract_Mutation_Controller, worker_pool: Worker_Pool, metrics: Run_Metrics):
         self.population = population
         self.population_size = len(population)
         self.mutation_controller = mutation_controller
         self.best_individual = population[0].copy()
         self.median_individual = self.best_individual
         self.quantiles = np.array([0.0 for _ in self.quantile_values])
-        self.threads_num = threads_num
+        self.worker_pool = worker_pool
+        self.metrics = metrics
         self.mean_fitness = 0.0
 
     def add_individuals(self, new_individuals: list[Individual]):
@@ -187,22 +202,19 @@ class Single_Population:
         self.quantiles = np.quantile(fitnesses, (0.25, 0.5, 0.75))
 
     def generation(self):
+        self.metrics.lap("mutation")  # e.g. creating new population
         time_start = time.perf_counter()
         # multi-threading
-        with ThreadPoolExecutor(max_workers=self.threads_num) as executor:
-            futures = [
-                executor.submit(individual.copy_mutate_and_evaluate)
-                for individual in self.population
-            ]
-            mutated_population = [future.result() for future in futures]
+        mutated_population = self.worker_pool.map(lambda individual: individual.copy_mutate_and_evaluate(self.metrics), self.population)
         # mutated_population = [
         #     individual.copy_mutate_and_evaluate()
         #     for individual in self.population
         # ]
         # end of multi-threading
+        self.metrics.lap(None)
         time_end = time.perf_counter()
         print(
-            f"Time: {time_end - time_start}, mean time: {(time_end - time_start) / self.population_size}, mean time using one thread: {(time_end - time_start) / self.population_size * self.threads_num}")
+            f"Time: {time_end - time_start}, mean time: {(time_end - time_start) / self.population_size}, mean time using one thread: {(time_end - time_start) / self.population_size * self.worker_pool.max_threads}")
 
         previous_best_fitness = self.best_individual.get_fitness()
         self.mutation_controller.commit_iteration(previous_best_fitness)
@@ -1,21 +1,25 @@
 import os
 import time
-from concurrent.futures import ThreadPoolExecutor
-from typing import Dict, Any, Type, List
+from typing import Dict, Any
 
 import numpy as np
 import pandas as pd
 
-from src.car_training.Environments.Abstract_Environment.Abstract_Environment import Abstract_Environment
-from src.car_training.Environments.Abstract_Environment.Abstract_Environment_Iterator import Abstract_Environment_Iterator
 from src.car_training.Environments.general_functions_provider import get_environment_class
 from src.car_training.Environments_Visualization.Basic_Environment_Visualization import run_basic_environment_visualization
+from src.car_training.Evolutionary_Algorithms.Checkpoints.Checkpointer import Checkpointer, load_latest_checkpoint, \
+    get_rng_state, set_rng_state
+from src.car_training.Evolutionary_Algorithms.Metrics.Run_Metrics import Run_Metrics
+from src.car_training.Evolutionary_Algorithms.Population_Evaluation.Population_Evaluator import Population_Evaluator
+from src.car_training.Evolutionary_Algorithms.Population_Evaluation.Worker_Pool import Worker_Pool
 from src.car_training.Neural_Network.Raw_Numpy.Raw_Numpy_Models.Normal.Normal_model import Normal_model
 
 
 class Differential_Evolution:
     """
     Differential Evolution - https://en.wikipedia.org/wiki/Differential_evolution
+    Population is kept as one matrix (rows are flat parameters, see Parameters_Layout), whole generation is created,
+    evaluated and selected at once
     """
     def __init__(self, constants_dict: Dict[str, Any]) -> None:
         """
@@ -33,6 +37,8 @@ class Differential_Evolution:
         self.diff_weight = constants_dict["Differential_Evolution"]["diff_weight"]
         self.save_logs_every_n_epochs = constants_dict["Differential_Evolution"]["save_logs_every_n_epochs"]
         self.max_evaluations = constants_dict["Differential_Evolution"]["max_evaluations"]
+        self.split_environments = constants_dict["Differential_Evolution"]["split_environments"]
+        self.checkpoint_every_n_epochs = constants_dict["Differential_Evolution"]["checkpoint_every_n_epochs"]
         self.max_threads = os.cpu_count() if constants_dict["Differential_Evolution"]["max_threads"] <= 0 else constants_dict["Differential_Evolution"]["max_threads"]
         base_log_dir = constants_dict["Differential_Evolution"]["logs_path"]
 
@@ -54,189 +60,141 @@ class Differential_Evolution:
 
         # file handling
         self.log_directory = base_log_dir + "/" + "DiffEv" + str(int(time.time())) + "/"
+        self.checkpointer = Checkpointer(self.log_directory + "checkpoints", "Differential_Evolution", constants_dict)
+        self.start_generation = 0
+        self.log_list = []
         # os.makedirs(self.log_directory, exist_ok=True)
 
         #self.logger = Timestamp_Logger(file_path=self.log_directory + "log.txt", log_mode='w', log_moment='a', separator='\t')
 
         self.neural_network_kwargs = constants_dict["neural_network"]
-        self.population = [
-            Individual(self.neural_network_kwargs, self.environment_class, self.training_environments_kwargs)
-            for _ in range(self.population_size)
-        ]
-
-        with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-            futures = [executor.submit(individual.get_fitness) for individual in self.population]
-
-            results = [future.result() for future in futures]
-
-        self.best_individual = max(self.population, key=lambda individual: individual.get_fitness()).copy()
+        self.worker_pool = Worker_Pool(self.max_threads)
+        self.metrics = Run_Metrics("Differential_Evolution", self.log_directory, constants_dict["metrics"]["sink"], self.worker_pool)
+        self.population_evaluator = Population_Evaluator(self.neural_network_kwargs, self.environment_class, self.training_environments_kwargs, self.worker_pool, self.split_environments, self.metrics)
+        self.population = self.population_evaluator.random_population(self.population_size)
+        self.fitnesses = None  # population is evaluated at the beginning of run, unless checkpoint is loaded
+        self.episode_lengths = None  # used as predicted cost of children
+        self.best_vector = None
+        self.best_fitness = -np.inf
+
+    def load_checkpoint(self, directory: str) -> None:
+        """
+        Loads state saved by checkpointer, run() continues from the next generation, it is bit-exact continuation
+        :param directory: checkpoints directory of interrupted run
+        :return:
+        """
+        generation, self.population, state = load_latest_checkpoint(directory)
+        self.fitnesses = state["fitnesses"]
+        self.episode_lengths = state["episode_lengths"]
+        self.best_vector = state["best_vector"]
+        self.best_fitness = state["best_fitness"]
+        self.log_list = state["log_list"]
+        set_rng_state(state["rng_state"])
+        self.start_generation = generation + 1
+        self.checkpointer.directory = directory
+
+    def _save_checkpoint(self, generation: int) -> None:
+        self.checkpointer.save(generation, self.population, {
+            "fitnesses": self.fitnesses,
+            "episode_lengths": self.episode_lengths,
+            "best_vector": self.best_vector,
+            "best_fitness": self.best_fitness,
+            "log_list": self.log_list,
+            "rng_state": get_rng_state(),
+        })
 
 
     def run(self) -> pd.DataFrame:
         """
-        Runs evolutionary algorithm
+        Runs evolutionary algorithm, threads of worker pool are stopped when it ends (also on error),
+        so they do not pile up when many runs share one process, e.g. in metaparams_tests
         :return:
         """
-        log_list = []
-        for generation in range(self.epochs):
+        with self.worker_pool:
+            return self._run_generations()
+
+    def _run_generations(self) -> pd.DataFrame:
+        log_list = self.log_list
+        if self.fitnesses is None:
+            self.fitnesses = self.population_evaluator.evaluate(self.population)
+            self.episode_lengths = self.population_evaluator.last_episode_lengths
+            best_id = int(np.argmax(self.fitnesses))
+            self.best_vector = self.population[best_id].copy()
+            self.best_fitness = self.fitnesses[best_id]
+        self.metrics.lap(None)  # initial evaluation is measured by workers, it is counted in the first generation
+
+        for generation in range(self.start_generation, self.epochs):
             print(f"Generation {generation}")
 
             time_start = time.perf_counter()
-            # multi-threading
-            with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-                futures = []
-                for i in range(self.population_size):
-                    base_id, id1, id2 = np.random.choice(self.population_size, 3, replace=False)
-                    base_params = self.best_individual.neural_network.get_parameters()  # self.population[base_id].neural_network.get_parameters()
-                    id1_params = self.population[id1].neural_network.get_parameters()
-                    id2_params = self.population[id2].neural_network.get_parameters()
-                    futures.append(executor.submit(self.population[i].differential_evolution_one_epoch, base_params, id1_params, id2_params, self.cross_prob, self.diff_weight))
-
-                results = [future.result() for future in futures]
-            # for i in range(self.crosses_per_poch):
-            #     self.__perform_cross(indecies_randomized[i * 2], indecies_randomized[i * 2 + 1])
-            # end of multi-threading
+            trials = self._create_trials()
+            self.metrics.lap("mutation")
+            trials_fitnesses = self.population_evaluator.evaluate(trials, self.episode_lengths)
+            self.metrics.lap(None)
+            accepted = trials_fitnesses > self.fitnesses
+            self.population = np.where(accepted[:, np.newaxis], trials, self.population)
+            self.fitnesses = np.where(accepted, trials_fitnesses, self.fitnesses)
+            self.episode_lengths = np.where(accepted, self.population_evaluator.last_episode_lengths, self.episode_lengths)
             time_end = time.perf_counter()
-            print(f"Time: {time_end - time_start}, mean time: {(time_end - time_start) / self.population_size / 2}, mean time using one thread: {(time_end - time_start) / self.population_size / 2 * self.max_threads}")
+            print(f"Time: {time_end - time_start}, mean time: {(time_end - time_start) / self.population_size}, mean time using one thread: {(time_end - time_start) / self.population_size * self.max_threads}")
 
-            for individual in self.population:
-                if individual.get_fitness() > self.best_individual.get_fitness():
-                    self.best_individual = individual.copy()
+            best_id = int(np.argmax(self.fitnesses))
+            if self.fitnesses[best_id] > self.best_fitness:
+                self.best_vector = self.population[best_id].copy()
+                self.best_fitness = self.fitnesses[best_id]
+            self.metrics.lap("sorting")
 
-            fitnesses = np.array([individual.get_fitness() for individual in self.population])
+            fitnesses = self.fitnesses
             quantile = [0.25, 0.5, 0.75, 0.9, 0.99]
             quantile_results = np.quantile(fitnesses, quantile)
             quantile_text = ", ".join([f"{quantile}: {quantile_results[i]}" for i, quantile in enumerate(quantile)])
-            print(f"Mean fitness: {fitnesses.mean()}, best fitness: {self.best_individual.get_fitness()}")
+            print(f"Mean fitness: {fitnesses.mean()}, best fitness: {self.best_fitness}, accepted trials: {np.count_nonzero(accepted)}")
             print(f"Quantiles: {quantile_text}\n\n")
 
             evaluations = (generation + 2) * self.population_size
 
             if generation % self.save_logs_every_n_epochs == 0:
-                # model = self.best_individual.neural_network
+                # model = self.get_best_model()
                 # run_basic_environment_visualization(model)
                 log_list.append({
                     "generation": generation,
                     "mean_fitness": fitnesses.mean(),
-                    "best_fitness": self.best_individual.get_fitness(),
+                    "best_fitness": self.best_fitness,
                     "evaluations": evaluations,
                 })
 
+            if self.checkpoint_every_n_epochs > 0 and generation % self.checkpoint_every_n_epochs == 0:
+                self._save_checkpoint(generation)
+            self.metrics.lap("logging")
+            self.metrics.end_generation(generation, mean_fitness=fitnesses.mean(), best_fitness=self.best_fitness)
+
             if evaluations > self.max_evaluations:
                 break
 
+        self.checkpointer.wait()
+        self.metrics.close()
         return pd.DataFrame(log_list)
 
-
-class Individual:
-    def __init__(self,
-                 neural_network_params: Dict[str, Any],
-                 environment_class: Type[Abstract_Environment],
-                 environments_list_kwargs: List[Dict[str, Any]]) -> None:
-        """
-        Initializes Individual
-        :param neural_network_params: parameters for neural network
-        :param environment_class: class of environment
-        :param environments_list_kwargs: list of kwargs for environments
-        :param mutation_factor: float
-        :param parent: parent of individual
-        :param use_safe_mutation: bool - if True, then uses scaled mutation
-        :param L1_factor: float - shrinks parameters by constant factor
-        :param L2_factor: float - shrinks parameters using also parameters value
-        """
-        self.neural_network = Normal_model(**neural_network_params)
-
-        self.neural_network_params = neural_network_params
-        self.environment_class = environment_class
-        self.environments_kwargs = environments_list_kwargs
-
-        self.environments = [environment_class(**kwargs) for kwargs in environments_list_kwargs]
-        self.environment_iterator = Abstract_Environment_Iterator(self.environments)
-
-        self.fitness = 0.0
-        self.is_fitness_calculated = False
-
-    def get_fitness(self) -> float:
-        if not self.is_fitness_calculated:
-            self.fitness = self.environment_iterator.get_results(self.neural_network)
-            self.is_fitness_calculated = True
-        return self.fitness
-
-    def copy(self) -> 'Individual':
-        new_individual = Individual(self.neural_network_params,
-                                    self.environment_class,
-                                    self.environments_kwargs)
-        new_individual.neural_network.set_parameters(self.neural_network.get_parameters())
-        new_individual.fitness = self.fitness
-        new_individual.is_fitness_calculated = self.is_fitness_calculated
-        return new_individual
-
-    def mutate(self, factor: float):
-        params = self.neural_network.get_parameters()
-        self._permute_params(params, factor)
-        self.neural_network.set_parameters(params)
-        self.is_fitness_calculated = False
-
-    def _permute_params(self, params: dict[str, Any], factor: float) -> None:
-        for key in params:
-            if isinstance(params[key], np.ndarray):
-                params[key] += np.random.normal(0, factor, params[key].shape)
-            elif isinstance(params[key], dict):
-                self._permute_params(params[key], factor)
-
-    def differential_evolution_one_epoch(self,
-                                         base_params: Dict[str, Any],
-                                         individual_1_params: Dict[str, Any],
-                                         individual_2_params: Dict[str, Any],
-                                         cross_prob: float,
-                                         diff_weight: float) -> bool:
-        """
-        Performs one step of differential evolution, modifies self inplace, if modification is better than base individual, returns True, otherwise False
-        :param base_params:
-        :param individual_1_params:
-        :param individual_2_params:
-        :param cross_prob:
-        :param diff_weight:
-        :return: True if change accepted, False otherwise
+    def get_best_model(self) -> Normal_model:
         """
-        original_params = self.neural_network.get_parameters()
-        original_fitness = self.get_fitness()
-
-        new_params = self.neural_network.get_parameters()
-        self._diff_evolution_iteration(new_params, base_params, individual_1_params, individual_2_params, cross_prob, diff_weight)
-
-        self.neural_network.set_parameters(new_params)
-        self.is_fitness_calculated = False
-
-        if self.get_fitness() > original_fitness:
-            return True
-        else:
-            self.neural_network.set_parameters(original_params)
-            self.is_fitness_calculated = True
-            self.fitness = original_fitness
-            return False
-
-    def _diff_evolution_iteration(self,
-                                   self_params: Dict[str, Any],
-                                    base_params: Dict[str, Any],
-                                    individual_1_params: Dict[str, Any],
-                                    individual_2_params: Dict[str, Any],
-                                    cross_prob: float,
-                                    diff_weight: float) -> None:
-        """
-        Performs Differential Evolution on np.array, iterates fthrwo params
-        :param self_params:
-        :param base_params:
-        :param individual_1_params:
-        :param individual_2_params:
-        :param cross_prob:
-        :param diff_weight:
+        Creates model with parameters of the best individual found so far
         :return:
         """
-        for key, value in self_params.items():
-            if isinstance(value, dict):
-                self._diff_evolution_iteration(value, base_params[key], individual_1_params[key], individual_2_params[key], cross_prob, diff_weight)
-            elif isinstance(value, np.ndarray):
-                cross_mask = np.random.rand(*value.shape) < cross_prob
-                self_params[key][cross_mask] = base_params[key][cross_mask] + diff_weight * (individual_1_params[key][cross_mask] - individual_2_params[key][cross_mask])
+        model = Normal_model(**self.neural_network_kwargs)
+        model.set_parameters(self.population_evaluator.layout.unflatten(self.best_vector))
+        return model
 
+    def _create_trials(self) -> np.ndarray:
+        """
+        Creates trial vectors for whole population at once (DE/best/1/bin):
+        v = best + diff_weight * (x_b - x_c), binomial crossover with cross_prob, at least one gene comes from v
+        :return: trials matrix, the same shape as self.population
+        """
+        rows, cols = self.population.shape
+        ids_b = np.random.randint(0, rows, size=rows)
+        ids_c = (ids_b + np.random.randint(1, rows, size=rows)) % rows  # always different from ids_b
+
+        mutants = self.best_vector + self.diff_weight * (self.population[ids_b] - self.population[ids_c])
+        cross_mask = np.random.rand(rows, cols) < self.cross_prob
+        cross_mask[np.arange(rows), np.random.randint(0, cols, size=rows)] = True
+        return np.where(cross_mask, mutants, self.population).astype(np.float32, copy=False)
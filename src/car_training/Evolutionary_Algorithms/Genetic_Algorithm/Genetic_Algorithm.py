@@ -1,22 +1,24 @@
 import os
-import random
 import time
-from concurrent.futures import ThreadPoolExecutor
-from typing import Dict, Any, List, Type
+from typing import Dict, Any
 
 import numpy as np
 import pandas as pd
 
-from src.car_training.Environments.Abstract_Environment.Abstract_Environment import Abstract_Environment
-from src.car_training.Environments.Abstract_Environment.Abstract_Environment_Iterator import Abstract_Environment_Iterator
 from src.car_training.Environments.general_functions_provider import get_environment_class
 from src.car_training.Environments_Visualization.Basic_Environment_Visualization import run_basic_environment_visualization
+from src.car_training.Evolutionary_Algorithms.Checkpoints.Checkpointer import Checkpointer, load_latest_checkpoint, \
+    get_rng_state, set_rng_state
+from src.car_training.Evolutionary_Algorithms.Metrics.Run_Metrics import Run_Metrics
+from src.car_training.Evolutionary_Algorithms.Population_Evaluation.Population_Evaluator import Population_Evaluator
+from src.car_training.Evolutionary_Algorithms.Population_Evaluation.Worker_Pool import Worker_Pool
 from src.car_training.Neural_Network.Raw_Numpy.Raw_Numpy_Models.Normal.Normal_model import Normal_model
 
 
 class Genetic_Algorithm:
     """
     Genetic Algorithm - sees neural network as set of genes, cross and mutate them
+    Population is kept as one matrix (rows are flat parameters, see Parameters_Layout), all crosses of generation are done at once
     """
     def __init__(self, constants_dict: Dict[str, Any]) -> None:
         """
@@ -35,6 +37,8 @@ class Genetic_Algorithm:
         # self.new_individual_every_n_epochs = constants_dict["Genetic_Algorithm"]["new_individual_every_n_epochs"]
         self.save_logs_every_n_epochs = constants_dict["Genetic_Algorithm"]["save_logs_every_n_epochs"]
         self.max_evaluations = constants_dict["Genetic_Algorithm"]["max_evaluations"]
+        self.split_environments = constants_dict["Genetic_Algorithm"]["split_environments"]
+        self.checkpoint_every_n_epochs = constants_dict["Genetic_Algorithm"]["checkpoint_every_n_epochs"]
         self.max_threads = os.cpu_count() if constants_dict["Genetic_Algorithm"]["max_threads"] <= 0 else constants_dict["Genetic_Algorithm"]["max_threads"]
         base_log_dir = constants_dict["Genetic_Algorithm"]["logs_path"]
 
@@ -56,174 +60,152 @@ class Genetic_Algorithm:
 
         # file handling
         self.log_directory = base_log_dir + "/" + "GeAl" + str(int(time.time())) + "/"
+        self.checkpointer = Checkpointer(self.log_directory + "checkpoints", "Genetic_Algorithm", constants_dict)
+        self.start_generation = 0
+        self.log_list = []
         # os.makedirs(self.log_directory, exist_ok=True)
 
         #self.logger = Timestamp_Logger(file_path=self.log_directory + "log.txt", log_mode='w', log_moment='a', separator='\t')
 
         self.neural_network_kwargs = constants_dict["neural_network"]
-        self.population = [
-            Individual(self.neural_network_kwargs, self.environment_class, self.training_environments_kwargs)
-            for _ in range(self.population_size)
-        ]
-        self.best_individual = self.population[0].copy()
+        self.worker_pool = Worker_Pool(self.max_threads)
+        self.metrics = Run_Metrics("Genetic_Algorithm", self.log_directory, constants_dict["metrics"]["sink"], self.worker_pool)
+        self.population_evaluator = Population_Evaluator(self.neural_network_kwargs, self.environment_class, self.training_environments_kwargs, self.worker_pool, self.split_environments, self.metrics)
+        self.population = self.population_evaluator.random_population(self.population_size)
+        self.fitnesses = None  # population is evaluated at the beginning of run, unless checkpoint is loaded
+        self.episode_lengths = None  # used as predicted cost of children
+        self.best_vector = None
+        self.best_fitness = -np.inf
+
+    def load_checkpoint(self, directory: str) -> None:
+        """
+        Loads state saved by checkpointer, run() continues from the next generation, it is bit-exact continuation
+        :param directory: checkpoints directory of interrupted run
+        :return:
+        """
+        generation, self.population, state = load_latest_checkpoint(directory)
+        self.fitnesses = state["fitnesses"]
+        self.episode_lengths = state["episode_lengths"]
+        self.best_vector = state["best_vector"]
+        self.best_fitness = state["best_fitness"]
+        self.log_list = state["log_list"]
+        set_rng_state(state["rng_state"])
+        self.start_generation = generation + 1
+        self.checkpointer.directory = directory
+
+    def _save_checkpoint(self, generation: int) -> None:
+        self.checkpointer.save(generation, self.population, {
+            "fitnesses": self.fitnesses,
+            "episode_lengths": self.episode_lengths,
+            "best_vector": self.best_vector,
+            "best_fitness": self.best_fitness,
+            "log_list": self.log_list,
+            "rng_state": get_rng_state(),
+        })
 
 
     def run(self) -> pd.DataFrame:
         """
-        Runs evolutionary algorithm
+        Runs evolutionary algorithm, threads of worker pool are stopped when it ends (also on error),
+        so they do not pile up when many runs share one process, e.g. in metaparams_tests
         :return:
         """
-        log_list = []
-
-        for generation in range(self.epochs):
+        with self.worker_pool:
+            return self._run_generations()
+
+    def _run_generations(self) -> pd.DataFrame:
+        log_list = self.log_list
+        if self.fitnesses is None:
+            self.fitnesses = self.population_evaluator.evaluate(self.population)
+            self.episode_lengths = self.population_evaluator.last_episode_lengths
+            best_id = int(np.argmax(self.fitnesses))
+            self.best_vector = self.population[best_id].copy()
+            self.best_fitness = self.fitnesses[best_id]
+        self.metrics.lap(None)  # initial evaluation is measured by workers, it is counted in the first generation
+
+        for generation in range(self.start_generation, self.epochs):
             print(f"Generation {generation}")
 
-            # if generation % self.new_individual_every_n_epochs == 0:
-            #     self.population[random.randint(0, self.population_size - 1)] = Individual(self.neural_network_kwargs, self.environment_class, self.training_environments_kwargs)
-
             indecies_randomized = np.random.permutation(self.population_size)
+            parents_indecies_1 = indecies_randomized[0:self.crosses_per_epoch * 2:2]
+            parents_indecies_2 = indecies_randomized[1:self.crosses_per_epoch * 2:2]
+            self.metrics.lap("mutation")
 
             time_start = time.perf_counter()
-            # multi-threading
-            with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-                futures = [
-                    executor.submit(self._perform_cross, indecies_randomized[i * 2], indecies_randomized[i * 2 + 1])
-                    for i in range(self.crosses_per_epoch)
-                ]
-                results = [future.result() for future in futures]
-            # for i in range(self.crosses_per_epoch):
-            #     self.__perform_cross(indecies_randomized[i * 2], indecies_randomized[i * 2 + 1])
-            # end of multi-threading
+            self._perform_crosses(parents_indecies_1, parents_indecies_2)
             time_end = time.perf_counter()
             print(f"Time: {time_end - time_start}, mean time: {(time_end - time_start) / self.crosses_per_epoch / 2}, mean time using one thread: {(time_end - time_start) / self.crosses_per_epoch / 2 * self.max_threads}")
 
-            for individual in self.population:
-                if individual.get_fitness() > self.best_individual.get_fitness():
-                    self.best_individual = individual.copy()
+            best_id = int(np.argmax(self.fitnesses))
+            if self.fitnesses[best_id] > self.best_fitness:
+                self.best_vector = self.population[best_id].copy()
+                self.best_fitness = self.fitnesses[best_id]
+            self.metrics.lap("sorting")
 
-            fitnesses = np.array([individual.get_fitness() for individual in self.population])
+            fitnesses = self.fitnesses
             quantile = [0.25, 0.5, 0.75, 0.9, 0.99]
             quantile_results = np.quantile(fitnesses, quantile)
             quantile_text = ", ".join([f"{quantile}: {quantile_results[i]}" for i, quantile in enumerate(quantile)])
-            print(f"Mean fitness: {fitnesses.mean()}, best fitness: {self.best_individual.get_fitness()}")
+            print(f"Mean fitness: {fitnesses.mean()}, best fitness: {self.best_fitness}")
             print(f"Quantiles: {quantile_text}\n\n")
 
             evaluations = self.population_size + (1 + generation) * self.crosses_per_epoch * 2
 
             if generation % self.save_logs_every_n_epochs == 0:
-                # model = self.best_individual.neural_network
+                # model = self.get_best_model()
                 # run_basic_environment_visualization(model)
                 log_list.append({
                     "generation": generation,
                     "evaluations": evaluations,
                     "mean_fitness": fitnesses.mean(),
-                    "best_fitness": self.best_individual.get_fitness(),
+                    "best_fitness": self.best_fitness,
                 })
 
+            if self.checkpoint_every_n_epochs > 0 and generation % self.checkpoint_every_n_epochs == 0:
+                self._save_checkpoint(generation)
+            self.metrics.lap("logging")
+            self.metrics.end_generation(generation, mean_fitness=fitnesses.mean(), best_fitness=self.best_fitness)
+
             if evaluations >= self.max_evaluations:
                 break
 
+        self.checkpointer.wait()
+        self.metrics.close()
         return pd.DataFrame(log_list)
 
-
-    def _perform_cross(self, parent_index_1: int, parent_index_2: int) -> None:
+    def get_best_model(self) -> Normal_model:
         """
-        Performs crosses, changes population in place
-        :param parent_index_1: index of first parent
-        :param parent_index_2: index of second parent
+        Creates model with parameters of the best individual found so far
+        :return:
         """
-        new_individual_1, new_individual_2 = self.population[parent_index_1].generate_crossed_scattered_individuals(self.population[parent_index_2])
-        new_individual_1.mutate(self.mutation_factor)
-        new_individual_2.mutate(self.mutation_factor)
-
-        better_individual = new_individual_1 if new_individual_1.get_fitness() > new_individual_2.get_fitness() else new_individual_2
-        worse_parent_index = parent_index_1 if self.population[parent_index_1].get_fitness() < self.population[parent_index_2].get_fitness() else parent_index_2
-        self.population[worse_parent_index] = better_individual
+        model = Normal_model(**self.neural_network_kwargs)
+        model.set_parameters(self.population_evaluator.layout.unflatten(self.best_vector))
+        return model
 
-
-class Individual:
-    def __init__(self,
-                 neural_network_params: Dict[str, Any],
-                 environment_class: Type[Abstract_Environment],
-                 environments_list_kwargs: List[Dict[str, Any]]) -> None:
-        """
-        Initializes Individual
-        :param neural_network_params: parameters for neural network
-        :param environment_class: class of environment
-        :param environments_list_kwargs: list of kwargs for environments
-        :param mutation_factor: float
-        :param parent: parent of individual
-        :param use_safe_mutation: bool - if True, then uses scaled mutation
-        :param L1_factor: float - shrinks parameters by constant factor
-        :param L2_factor: float - shrinks parameters using also parameters value
+    def _perform_crosses(self, parents_indecies_1: np.ndarray, parents_indecies_2: np.ndarray) -> None:
         """
-        self.neural_network = Normal_model(**neural_network_params)
-
-        self.neural_network_params = neural_network_params
-        self.environment_class = environment_class
-        self.environments_kwargs = environments_list_kwargs
-
-        self.environments = [environment_class(**kwargs) for kwargs in environments_list_kwargs]
-        self.environment_iterator = Abstract_Environment_Iterator(self.environments)
-
-        self.fitness = 0.0
-        self.is_fitness_calculated = False
-
-    def get_fitness(self) -> float:
-        if not self.is_fitness_calculated:
-            self.fitness = self.environment_iterator.get_results(self.neural_network)
-            self.is_fitness_calculated = True
-        return self.fitness
-
-    def copy(self) -> 'Individual':
-        new_individual = Individual(self.neural_network_params,
-                                    self.environment_class,
-                                    self.environments_kwargs)
-        new_individual.neural_network.set_parameters(self.neural_network.get_parameters())
-        new_individual.fitness = self.fitness
-        new_individual.is_fitness_calculated = self.is_fitness_calculated
-        return new_individual
-
-    def mutate(self, factor: float):
-        params = self.neural_network.get_parameters()
-        self._permute_params(params, factor)
-        self.neural_network.set_parameters(params)
-        self.is_fitness_calculated = False
-
-    def _permute_params(self, params: dict[str, Any], factor: float) -> None:
-        for key in params:
-            if isinstance(params[key], np.ndarray):
-                params[key] += np.random.normal(0, factor, params[key].shape)
-            elif isinstance(params[key], dict):
-                self._permute_params(params[key], factor)
-
-    def generate_crossed_scattered_individuals(self, other: 'Individual') -> tuple['Individual', 'Individual']:
+        Performs all crosses of generation at once, changes population in place
+        each pair creates two children (scattered cross - one mask for all pairs, then mutation), they are evaluated as one batch,
+        better child replaces worse parent
+        :param parents_indecies_1: indecies of first parents, pairs are disjoint
+        :param parents_indecies_2: indecies of second parents
         """
-        Generates two new individuals, which are scattered cross of two individuals
-        :param other: other individual
-        :return: two new individuals
-        """
-        self_policy_params = self.neural_network.get_parameters()
-        other_policy_params = other.neural_network.get_parameters()
-        self._cross_scattered_policy(self_policy_params, other_policy_params)
-        new_individual1 = Individual(self.neural_network_params, self.environment_class, self.environments_kwargs)
-        new_individual1.neural_network.set_parameters(self_policy_params)
-        new_individual2 = Individual(self.neural_network_params, self.environment_class, self.environments_kwargs)
-        new_individual2.neural_network.set_parameters(other_policy_params)
-        return new_individual1, new_individual2
-
-    def _cross_scattered_policy(self, params1: Dict[str, Any], params2: Dict[str, Any]) -> None:
-        """
-        changes params_to_change so that on random places it swapes params1 and params2
-        :param params1: first policy part of params
-        :param params2: second policy part of params
-        """
-        for key, value in params1.items():
-            if isinstance(value, dict):
-                self._cross_scattered_policy(value, params2[key])
-            elif isinstance(value, np.ndarray):
-                mask = np.random.randint(0, 2, value.shape, dtype=np.bool_)
-                params_2_mask_copy = np.array(params2[key][mask])
-                params2[key][mask] = value[mask]
-                params1[key][mask] = params_2_mask_copy
-
+        parents_1 = self.population[parents_indecies_1]
+        parents_2 = self.population[parents_indecies_2]
+        mask = np.random.randint(0, 2, parents_1.shape, dtype=np.bool_)
+        children = np.concatenate([np.where(mask, parents_2, parents_1), np.where(mask, parents_1, parents_2)])
+        children += self.mutation_factor * np.random.standard_normal(children.shape).astype(np.float32)
+        self.metrics.lap("mutation")
+
+        predicted_costs = np.maximum(self.episode_lengths[parents_indecies_1], self.episode_lengths[parents_indecies_2])
+        children_fitnesses = self.population_evaluator.evaluate(children, np.concatenate([predicted_costs, predicted_costs])).reshape(2, -1)
+        self.metrics.lap(None)
+        children_episode_lengths = self.population_evaluator.last_episode_lengths.reshape(2, -1)
+        better_child = np.argmax(children_fitnesses, axis=0)
+        pairs = np.arange(parents_indecies_1.shape[0])
+        worse_parents_indecies = np.where(self.fitnesses[parents_indecies_1] < self.fitnesses[parents_indecies_2], parents_indecies_1, parents_indecies_2)
+
+        self.population[worse_parents_indecies] = children.reshape(2, pairs.shape[0], -1)[better_child, pairs]
+        self.fitnesses[worse_parents_indecies] = children_fitnesses[better_child, pairs]
+        self.episode_lengths[worse_parents_indecies] = children_episode_lengths[better_child, pairs]
+        self.metrics.count("cache_hits", self.population_size - 2 * parents_indecies_1.shape[0])  # individuals that were not crossed
@@ -0,0 +1,165 @@
+import contextlib
+import csv
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, ContextManager
+
+from src.car_training.Evolutionary_Algorithms.Population_Evaluation.Worker_Pool import Worker_Pool
+
+PHASES = ("mutation", "evaluation", "sorting", "logging")
+COUNTERS = ("evaluations", "env_steps", "cache_hits")
+_NULL_PHASE = contextlib.nullcontext()
+
+
+class Run_Metrics:
+    """
+    Per-generation metrics of algorithm run with the same schema for all algorithms, rows are streamed to jsonl or csv file
+    after each generation, so they can be watched during run
+    row: algorithm, generation, wall_time, total_evaluations, evaluations, env_steps, steps_per_second, cache_hits,
+    time_mutation, time_evaluation, time_sorting, time_logging, worker_utilisation and values given to end_generation
+    phase times are summed over threads that spent time in phase (thread-seconds), e.g. evaluation done by 8 threads for 1s gives 8,
+    main loop measures its own parts with lap(), code run by workers with phase()
+    the first generation also contains initial evaluation of population (if algorithm does it)
+    cache_hits - individuals that took no part in evaluations of the generation (neither evaluated nor parent of evaluated child)
+    and kept their stored fitness, e.g. individuals not crossed in Genetic_Algorithm, it is 0 in algorithms that evaluate
+    child of every individual and in steady-state mode
+    when disabled, phase() returns shared null context and other methods return immediately
+    """
+    def __init__(self, algorithm_name: str, log_directory: str, sink: str, worker_pool: Optional[Worker_Pool] = None) -> None:
+        """
+        Initializes metrics, file is created on first row
+        :param algorithm_name: saved in each row
+        :param log_directory: file is log_directory/metrics.<sink>
+        :param sink: "jsonl", "csv" or "none" - disabled
+        :param worker_pool: pool of algorithm, used for worker utilisation
+        """
+        if sink not in ("jsonl", "csv", "none"):
+            raise ValueError(f"Unknown metrics sink: {sink}")
+        self.algorithm_name = algorithm_name
+        self.enabled = sink != "none"
+        self.sink = sink
+        self.file_path = os.path.join(log_directory, f"metrics.{sink}")
+        self.worker_pool = worker_pool
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._csv_writer = None
+        self._total_evaluations = 0
+        self._reset_generation()
+
+    def phase(self, name: str) -> ContextManager:
+        """
+        Measures time of code block, can be used in many threads at once
+        :param name: one of PHASES
+        :return: context manager
+        """
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def lap(self, name: Optional[str]) -> None:
+        """
+        Adds time since previous lap (or start of generation) to phase, it should be called only by one thread at a time -
+        thread of main loop or steady-state milestone
+        :param name: one of PHASES, None - time is not counted, e.g. main loop waited for workers, that measure their time by themselves
+        :return:
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if name is not None:
+            self._add_phase_time(name, now - self._last_lap)
+        self._last_lap = now
+
+    def count(self, name: str, value: float) -> None:
+        """
+        Adds value to counter of current generation, thread safe
+        :param name: one of COUNTERS
+        :param value:
+        :return:
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] += value
+
+    def end_generation(self, generation: int, **values: Any) -> None:
+        """
+        Writes row of finished generation and resets counters
+        :param generation:
+        :param values: additional values, e.g. mean_fitness, best_fitness, they should be the same in each row
+        :return:
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            now = time.perf_counter()
+            wall_time = now - self._generation_start
+            self._total_evaluations += self._counters["evaluations"]
+            busy_seconds = self.worker_pool.busy_seconds if self.worker_pool is not None else 0.0
+            row = {
+                "algorithm": self.algorithm_name,
+                "generation": generation,
+                "wall_time": wall_time,
+                "total_evaluations": self._total_evaluations,
+                **{name: self._counters[name] for name in COUNTERS},
+                "steps_per_second": self._counters["env_steps"] / wall_time if wall_time > 0 else 0.0,
+                **{f"time_{name}": self._phases[name] for name in PHASES},
+                "worker_utilisation": (busy_seconds - self._busy_seconds_start) / (wall_time * self.worker_pool.max_threads)
+                    if self.worker_pool is not None and wall_time > 0 else None,
+                **{key: _to_builtin(value) for key, value in values.items()},
+            }
+            self._write(row)
+            self._reset_generation()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _add_phase_time(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self._phases[name] += seconds
+
+    def _reset_generation(self) -> None:
+        self._counters = {name: 0 for name in COUNTERS}
+        self._phases = {name: 0.0 for name in PHASES}
+        self._generation_start = time.perf_counter()
+        self._last_lap = self._generation_start
+        self._busy_seconds_start = self.worker_pool.busy_seconds if self.worker_pool is not None else 0.0
+
+    def _write(self, row: Dict[str, Any]) -> None:
+        if self._file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.file_path)), exist_ok=True)
+            self._file = open(self.file_path, "w", newline="")
+            if self.sink == "csv":
+                self._csv_writer = csv.DictWriter(self._file, fieldnames=list(row.keys()))
+                self._csv_writer.writeheader()
+        if self.sink == "csv":
+            self._csv_writer.writerow(row)
+        else:
+            self._file.write(json.dumps(row) + "\n")
+        self._file.flush()
+
+
+NO_METRICS = Run_Metrics("", "", "none")  # shared disabled metrics, default of optional metrics parameters
+
+
+class _Phase:
+    def __init__(self, metrics: Run_Metrics, name: str) -> None:
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args: Any) -> None:
+        self.metrics._add_phase_time(self.name, time.perf_counter() - self.start)
+
+
+def _to_builtin(value: Any) -> Any:
+    # numpy scalars are not json serializable
+    return value.item() if hasattr(value, "item") else value
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from threading import Lock
 from typing import Any, Type
 
 
@@ -23,6 +24,23 @@ class Abstract_Mutation_Controller(ABC):
         Tells the mutation controller that the iteration is over
         """
 
+    def __getstate__(self) -> dict[str, Any]:
+        """
+        Locks can not be pickled, they are recreated in __setstate__, it allows to save controller in checkpoints
+        """
+        state = self.__dict__.copy()
+        lock_names = [name for name, value in state.items() if isinstance(value, type(Lock()))]
+        for name in lock_names:
+            del state[name]
+        state["_lock_names"] = lock_names
+        return state
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        state = dict(state)
+        for name in state.pop("_lock_names", []):
+            state[name] = Lock()
+        self.__dict__.update(state)
+
 
 def get_mutation_controller_by_name(name: str) -> Type[Abstract_Mutation_Controller]:
     """
@@ -0,0 +1,166 @@
+import threading
+from typing import Dict, Any, List, Optional, Tuple, Type
+
+import numpy as np
+
+from src.car_training.Environments.Abstract_Environment.Abstract_Environment import Abstract_Environment
+from src.car_training.Environments.Abstract_Environment.Abstract_Environment_Iterator import Abstract_Environment_Iterator
+from src.car_training.Evolutionary_Algorithms.Metrics.Run_Metrics import Run_Metrics, NO_METRICS
+from src.car_training.Evolutionary_Algorithms.Population_Evaluation.Worker_Pool import Worker_Pool
+from src.car_training.Neural_Network.Raw_Numpy.Parameters_Layout import Parameters_Layout
+from src.car_training.Neural_Network.Raw_Numpy.Raw_Numpy_Models.Normal.Normal_model import Normal_model
+
+
+class Population_Evaluator:
+    """
+    Evaluates whole population kept as one matrix (rows are flat parameters of individuals, see Parameters_Layout)
+    Rows are dispatched in chunks, one chunk per thread of worker_pool, each thread keeps its own worker (model + environments)
+    in threading.local, so no model or environment is created per individual or per generation
+    episode lengths of last evaluation are kept, they can be passed back as predicted costs, so long rollouts are scheduled first
+    """
+    def __init__(self,
+                 neural_network_kwargs: Dict[str, Any],
+                 environment_class: Type[Abstract_Environment],
+                 environments_kwargs: List[Dict[str, Any]],
+                 worker_pool: Worker_Pool,
+                 split_environments: bool = False,
+                 metrics: Optional[Run_Metrics] = None) -> None:
+        """
+        Initializes Population_Evaluator
+        :param neural_network_kwargs: kwargs of Normal_model
+        :param environment_class: class of environment
+        :param environments_kwargs: list of kwargs for environments, fitness is sum of results from all of them
+        :param worker_pool: pool used for evaluation, usually owned by algorithm
+        :param split_environments: if True, each environment of individual is separate task, so one long individual can be
+        spread across threads, at the cost of not stacking environments in one forward pass
+        :param metrics: metrics of run, evaluation time, evaluations and env steps are counted
+        """
+        self.neural_network_kwargs = neural_network_kwargs
+        self.environment_class = environment_class
+        self.environments_kwargs = environments_kwargs
+        self.worker_pool = worker_pool
+        self.split_environments = split_environments
+        self.metrics = metrics if metrics is not None else NO_METRICS
+        self.last_episode_lengths = np.zeros(0, dtype=np.int64)
+
+        self._thread_local = threading.local()
+        self.layout = Parameters_Layout(Normal_model(**neural_network_kwargs).get_parameters())
+
+        # workers are created here, not lazily in threads, creating model draws from global numpy generator,
+        # so doing it in the middle of run would make it irreproducible (e.g. after resuming from checkpoint)
+        self._workers_lock = threading.Lock()
+        self._spare_workers = [_Evaluation_Worker(neural_network_kwargs, environment_class, environments_kwargs) for _ in range(worker_pool.max_threads)]
+        self._workers = list(self._spare_workers)
+
+    def random_population(self, population_size: int) -> np.ndarray:
+        """
+        Creates population matrix of freshly initialized models
+        :param population_size:
+        :return: float32 matrix (population_size, layout.size)
+        """
+        population = np.empty((population_size, self.layout.size), dtype=np.float32)
+        model = Normal_model(**self.neural_network_kwargs)
+        for i in range(population_size):
+            self.layout.flatten(model.get_parameters(), out=population[i])
+            model.create_new_model()
+        return population
+
+    def evaluate(self, population: np.ndarray, predicted_costs: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Evaluates all rows of population, sets self.last_episode_lengths (sum of steps in all environments of each row)
+        :param population: matrix (individuals, layout.size)
+        :param predicted_costs: optional predicted cost of each row, e.g. episode length of its parent, the longest are scheduled first
+        :return: float64 vector of fitnesses, in the same order as rows
+        """
+        population = np.atleast_2d(population)
+        if not self.split_environments:
+            results = self.worker_pool.map(
+                lambda row: self._timed(self._get_worker().evaluate, self.layout.unflatten(row)),
+                population,
+                predicted_costs
+            )
+            results = np.array(results, dtype=np.float64).reshape(population.shape[0], 2)
+        else:
+            environments_number = len(self.environments_kwargs)
+            results = self.worker_pool.map(
+                lambda task: self._timed(self._get_worker().evaluate_environment, self.layout.unflatten(population[task[0]]), task[1]),
+                [(row, environment_id) for row in range(population.shape[0]) for environment_id in range(environments_number)],
+                None if predicted_costs is None else np.repeat(np.asarray(predicted_costs, dtype=float) / environments_number, environments_number)
+            )
+            results = np.array(results, dtype=np.float64).reshape(population.shape[0], environments_number, 2).sum(axis=1)
+
+        self.last_episode_lengths = results[:, 1].astype(np.int64)
+        self.metrics.count("evaluations", population.shape[0])
+        self.metrics.count("env_steps", int(self.last_episode_lengths.sum()))
+        return results[:, 0]
+
+    def evaluate_params(self, params: Dict[str, Any]) -> float:
+        """
+        Evaluates one individual given as parameters dictionary
+        :param params: nested dict, e.g. Normal_model.get_parameters()
+        :return: fitness
+        """
+        return float(self.evaluate(self.layout.flatten(params))[0])
+
+    def get_profiles(self) -> List[Dict[str, int]]:
+        """
+        Returns rollout profiling counters of each worker, they are zeros unless environments were built with CAR_PROFILE=1
+        :return: list of dicts, see Abstract_Environment_Iterator.get_profile
+        """
+        with self._workers_lock:
+            return [worker.get_profile() for worker in self._workers]
+
+    def _timed(self, function, *args: Any) -> Tuple[float, int]:
+        with self.metrics.phase("evaluation"):
+            return function(*args)
+
+    def _get_worker(self) -> '_Evaluation_Worker':
+        if not hasattr(self._thread_local, "worker"):
+            with self._workers_lock:
+                if self._spare_workers:
+                    self._thread_local.worker = self._spare_workers.pop()
+                else:
+                    self._thread_local.worker = _Evaluation_Worker(self.neural_network_kwargs, self.environment_class, self.environments_kwargs)
+                    self._workers.append(self._thread_local.worker)
+        return self._thread_local.worker
+
+
+class _Evaluation_Worker:
+    def __init__(self,
+                 neural_network_kwargs: Dict[str, Any],
+                 environment_class: Type[Abstract_Environment],
+                 environments_kwargs: List[Dict[str, Any]]) -> None:
+        self.neural_network = Normal_model(**neural_network_kwargs)
+        self.environments = [environment_class(**kwargs) for kwargs in environments_kwargs]
+        self.environment_iterator = Abstract_Environment_Iterator(self.environments)
+
+        self.single_environment_iterators = [Abstract_Environment_Iterator([environment]) for environment in self.environments]
+
+    def evaluate(self, params: Dict[str, Any]) -> Tuple[float, int]:
+        """
+        :return: fitness, steps in all environments
+        """
+        self.neural_network.set_parameters(params)
+        fitness = self.environment_iterator.get_results(self.neural_network)
+        return fitness, self.environment_iterator.get_last_steps()
+
+    def evaluate_environment(self, params: Dict[str, Any], environment_id: int) -> Tuple[float, int]:
+        """
+        :return: result in one environment, steps in this environment
+        """
+        self.neural_network.set_parameters(params)
+        iterator = self.single_environment_iterators[environment_id]
+        fitness = iterator.get_results(self.neural_network)
+        return fitness, iterator.get_last_steps()
+
+    def get_profile(self) -> Dict[str, int]:
+        """
+        :return: profiling counters of all rollouts of this worker, environments are shared by iterators, so they are counted once
+        """
+        profile = self.environment_iterator.get_profile()
+        for iterator in self.single_environment_iterators:
+            for key, value in iterator.get_profile(include_environments=False).items():
+                profile[key] += value
+        loop_cycles = profile["cycles_total"] - profile["cycles_forward_pass"] - profile["cycles_ray_distance"] - profile["cycles_collision"] - profile["cycles_physics"]
+        profile["cycles_iterator"] = max(loop_cycles, 0)
+        return profile
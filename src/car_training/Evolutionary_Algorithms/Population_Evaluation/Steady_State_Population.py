@@ -0,0 +1,125 @@
+import bisect
+import random
+import threading
+import time
+from typing import Any, Callable, List, Tuple
+
+import numpy as np
+
+from src.car_training.Evolutionary_Algorithms.Population_Evaluation.Worker_Pool import Worker_Pool
+
+
+class Steady_State_Population:
+    """
+    Thread safe population kept sorted by fitness (best first), used by steady-state (asynchronous) loops:
+    workers take parents and insert evaluated children at any time, there is no generation barrier
+    """
+    def __init__(self, individuals: List[Any], fitnesses: List[float], max_size: int) -> None:
+        """
+        Initializes population
+        :param individuals: initial individuals, already evaluated
+        :param fitnesses: their fitnesses
+        :param max_size: population size, after insert the worst individual is removed
+        """
+        order = np.argsort(fitnesses)[::-1]
+        self._negative_fitnesses = [-float(fitnesses[i]) for i in order]  # ascending, so bisect can be used
+        self._individuals = [individuals[i] for i in order]
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def sample(self, best_ratio: float = 1.0) -> Any:
+        """
+        Returns random individual from the best part of population
+        :param best_ratio: part of population to choose from, e.g. 0.5 - best half
+        :return:
+        """
+        with self._lock:
+            return self._individuals[random.randrange(max(int(len(self._individuals) * best_ratio), 1))]
+
+    def insert(self, individual: Any, fitness: float) -> bool:
+        """
+        Inserts individual in its place, removes the worst one if population is too big
+        :param individual:
+        :param fitness:
+        :return: True if individual is the new best one
+        """
+        with self._lock:
+            position = bisect.bisect_right(self._negative_fitnesses, -fitness)
+            self._negative_fitnesses.insert(position, -fitness)
+            self._individuals.insert(position, individual)
+            if len(self._individuals) > self.max_size:
+                self._negative_fitnesses.pop()
+                self._individuals.pop()
+            return position == 0
+
+    def best(self) -> Tuple[Any, float]:
+        with self._lock:
+            return self._individuals[0], -self._negative_fitnesses[0]
+
+    def snapshot(self) -> Tuple[List[Any], np.ndarray]:
+        """
+        :return: individuals and fitnesses, best first
+        """
+        with self._lock:
+            return list(self._individuals), -np.array(self._negative_fitnesses)
+
+
+def run_steady_state(population: Steady_State_Population,
+                     create_child: Callable[[int], Tuple[Any, float]],
+                     worker_pool: Worker_Pool,
+                     max_evaluations: int,
+                     milestone_every_n_evaluations: int,
+                     on_milestone: Callable[[int], None]) -> None:
+    """
+    Runs steady-state loop: each thread repeatedly creates and evaluates child and inserts it into population,
+    so no thread waits for the slowest evaluation of generation
+    :param population: shared population
+    :param create_child: function(evaluation_number) -> (child, fitness), it should take parent from population itself
+    :param worker_pool: pool of algorithm, all its threads are used
+    :param max_evaluations: loop stops after this number of children
+    :param milestone_every_n_evaluations: on_milestone is called each time this number of children is inserted
+    :param on_milestone: function(evaluations), called in order of milestones, when exactly this number of children is inserted
+    and no evaluation is in flight, so it sees consistent population and can change state used by create_child
+    (e.g. mutation controller). Evaluations after milestone are started when it returns, so threads wait only for
+    evaluations started before milestone, not for the whole generation
+    :return:
+    """
+    condition = threading.Condition()
+    counters = {"started": 0, "finished": 0, "next_milestone": milestone_every_n_evaluations, "stopped": False}
+
+    def worker() -> None:
+        try:
+            while True:
+                with condition:
+                    while counters["started"] >= counters["next_milestone"] and counters["started"] < max_evaluations and not counters["stopped"]:
+                        condition.wait()
+                    if counters["started"] >= max_evaluations or counters["stopped"]:
+                        return
+                    evaluation_number = counters["started"]
+                    counters["started"] += 1
+
+                time_start = time.perf_counter()
+                child, fitness = create_child(evaluation_number)
+                population.insert(child, fitness)
+                worker_pool.add_busy_time(time.perf_counter() - time_start)
+
+                with condition:
+                    counters["finished"] += 1
+                    finished = counters["finished"]
+                    is_milestone = finished == counters["next_milestone"]  # then all started evaluations are finished
+                if is_milestone:
+                    on_milestone(finished)
+                    with condition:
+                        counters["next_milestone"] += milestone_every_n_evaluations
+                        condition.notify_all()
+        except BaseException:
+            with condition:
+                counters["stopped"] = True  # other threads would wait for milestone forever
+                condition.notify_all()
+            raise
+
+    # multi-threading
+    futures = [worker_pool.submit(worker) for _ in range(worker_pool.max_threads)]
+    for future in futures:
+        future.result()
+    # end of multi-threading
@@ -0,0 +1,106 @@
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Callable, Deque, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+
+class Worker_Pool:
+    """
+    Long-lived thread pool owned by one run of algorithm, reused by all generations (instead of new ThreadPoolExecutor per generation)
+    threads live as long as the pool, so threading.local data (e.g. model and environments of a thread) is kept between generations
+    """
+    def __init__(self, max_threads: int) -> None:
+        """
+        Initializes pool, threads are started lazily
+        :param max_threads: number of threads
+        """
+        self.max_threads = max_threads
+        self.busy_seconds = 0.0  # time spent by threads on map items (and added by add_busy_time), used for worker utilisation
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def submit(self, function: Callable[..., Any], *args: Any) -> Future:
+        return self._get_executor().submit(function, *args)
+
+    def map(self, function: Callable[[Any], Any], items: Iterable[Any], costs: Optional[Sequence[float]] = None) -> List[Any]:
+        """
+        Calls function on all items, there is one future per thread, not per item
+        items are dealt round-robin to per-thread queues (longest first if costs are given), thread that runs out of work
+        steals the cheapest remaining item from other queues, so generation time approaches total work / threads
+        :param function: function(item) -> result
+        :param items:
+        :param costs: optional predicted cost of each item, e.g. previous episode length of parent
+        :return: results in the same order as items
+        """
+        items = list(items)
+        if len(items) == 0:
+            return []
+        order = np.arange(len(items)) if costs is None else np.argsort(-np.asarray(costs, dtype=float), kind="stable")
+        threads_number = min(self.max_threads, len(items))
+        queues = [collections.deque(order[i::threads_number].tolist()) for i in range(threads_number)]
+        results: List[Any] = [None] * len(items)
+        futures = [self.submit(self._process_queues, function, items, results, queues, i) for i in range(threads_number)]
+        for future in futures:
+            future.result()
+        return results
+
+    def add_busy_time(self, seconds: float) -> None:
+        """
+        Adds time of work done in functions passed to submit, map measures it by itself
+        :param seconds:
+        :return:
+        """
+        with self._lock:
+            self.busy_seconds += seconds
+
+    def close(self) -> None:
+        """
+        Stops threads, pool can still be used later, then new threads are started
+        :return:
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    def __enter__(self) -> 'Worker_Pool':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_threads)
+            return self._executor
+
+    def _process_queues(self,
+                        function: Callable[[Any], Any],
+                        items: List[Any],
+                        results: List[Any],
+                        queues: List[Deque[int]],
+                        own_queue_id: int) -> None:
+        own_queue = queues[own_queue_id]
+        time_start = time.perf_counter()
+        while True:
+            try:
+                index = own_queue.popleft()
+            except IndexError:
+                index = Worker_Pool._steal(queues, own_queue_id)
+                if index is None:
+                    break
+            results[index] = function(items[index])
+        self.add_busy_time(time.perf_counter() - time_start)
+
+    @staticmethod
+    def _steal(queues: List[Deque[int]], own_queue_id: int) -> Optional[int]:
+        for offset in range(1, len(queues)):
+            try:
+                return queues[(own_queue_id + offset) % len(queues)].pop()
+            except IndexError:
+                continue
+        return None
@@ -3,6 +3,7 @@ from typing import Any, List, Dict, Type, Tuple, Optional
 
 import numpy as np
 
+from src.car_training.Evolutionary_Algorithms.Metrics.Run_Metrics import Run_Metrics, NO_METRICS
 from src.car_training.Evolutionary_Algorithms.Mutation_Controllers.mutation_controllers_functions import \
     Abstract_Mutation_Controller
 from src.car_training.MyMath import MyMath
@@ -99,11 +100,10 @@ class Individual:
         self.is_fitness_calculated = False
         return id_mut_contr
 
-    def copy_mutate_and_evaluate(self) -> 'Individual':
+    def copy_mutate_and_evaluate(self, metrics: Run_Metrics = NO_METRICS) -> 'Individual':
         """
         Copies, mutates and evaluates individual
-        :param mutation_factor:
-        :param mutation_threshold: None or float - if not None, then it uses scaled mutation
+        :param metrics: metrics of run, copying with mutation and evaluation are measured as separate phases
         :return:
         """
         # if self.use_safe_mutation and (self.safe_mutation_factors is None or self.safe_mutation_factors_age >= self.safe_mutation_factor_max_age):
@@ -111,18 +111,22 @@ class Individual:
         #     self.is_fitness_calculated = True
         #     self.safe_mutation_factors = self.neural_network.get_safe_mutation(inputs, outputs)
         #     self.safe_mutation_factors_age = 0
-        new_individual = self.copy()
-
-        # mutation factor change
-        # tmp_change_rate = 0.2
-        # mutation_factor_change = np.random.normal(0, tmp_change_rate)
-        # if mutation_factor_change > 0:
-        #     mutation_factor_change /= 1 - tmp_change_rate
-        # mutation_factor_change += 1
-        # new_individual.mutation_factor = self.mutation_factor * mutation_factor_change
-
-        id_in_controller = new_individual.mutate()
-        new_fitness = new_individual.get_fitness()
+        with metrics.phase("mutation"):
+            new_individual = self.copy()
+
+            # mutation factor change
+            # tmp_change_rate = 0.2
+            # mutation_factor_change = np.random.normal(0, tmp_change_rate)
+            # if mutation_factor_change > 0:
+            #     mutation_factor_change /= 1 - tmp_change_rate
+            # mutation_factor_change += 1
+            # new_individual.mutation_factor = self.mutation_factor * mutation_factor_change
+
+            id_in_controller = new_individual.mutate()
+        with metrics.phase("evaluation"):
+            new_fitness = new_individual.get_fitness()
+        metrics.count("evaluations", 1)
+        metrics.count("env_steps", new_individual.environment_iterator.get_last_steps())
 
         if new_fitness > self.get_fitness():
             self.mutation_controller.mutation_better_than_parent(id_in_controller, self.fitness, new_fitness)
@@ -22,4 +22,21 @@ def get_policy_search_class(name: str):
             from src.car_training.Evolutionary_Algorithms.Genetic_Algorithm.Differential_Evolution import Differential_Evolution
             return Differential_Evolution
         case _:
-            raise ValueError(f"Unknown policy search class name: {name}")
\ No newline at end of file
+            raise ValueError(f"Unknown policy search class name: {name}")
+
+
+def resume_policy_search(checkpoints_directory: str):
+    """
+    Creates policy search algorithm from checkpoints of interrupted run, constants of that run are used
+    :param checkpoints_directory: e.g. <logs_path>/DiffEv1712345678/checkpoints
+    :return: algorithm, call run() to continue
+    """
+    from src.car_training.Evolutionary_Algorithms.Checkpoints.Checkpointer import load_checkpoint_constants, load_latest_checkpoint
+    constants_dict = load_checkpoint_constants(checkpoints_directory)
+    _, _, state = load_latest_checkpoint(checkpoints_directory)
+    policy_search_class = get_policy_search_class(state["algorithm_name"])
+    if not hasattr(policy_search_class, "load_checkpoint"):
+        raise ValueError(f"{state['algorithm_name']} does not support checkpoints")
+    policy_search_algorithm = policy_search_class(constants_dict)
+    policy_search_algorithm.load_checkpoint(checkpoints_directory)
+    return policy_search_algorithm
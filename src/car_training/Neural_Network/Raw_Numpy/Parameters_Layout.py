@@ -0,0 +1,57 @@
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+
+class Parameters_Layout:
+    """
+    Describes how nested parameters dictionary (as returned by Normal_model.get_parameters()) maps to one flat float32 vector,
+    so many individuals can be kept as one population matrix (rows are individuals)
+    """
+    def __init__(self, template_params: Dict[str, Any]) -> None:
+        """
+        Builds layout from template parameters, order of keys is the same as in template
+        :param template_params: nested dict of np.ndarray, e.g. Normal_model.get_parameters()
+        """
+        self.entries: List[Tuple[Tuple[str, ...], Tuple[int, ...], int, int]] = []  # key path, shape, start, end
+        self.size = 0
+        self._collect_entries(template_params, ())
+
+    def _collect_entries(self, params: Dict[str, Any], key_path: Tuple[str, ...]) -> None:
+        for key, value in params.items():
+            if isinstance(value, dict):
+                self._collect_entries(value, key_path + (key,))
+            elif isinstance(value, np.ndarray):
+                self.entries.append((key_path + (key,), value.shape, self.size, self.size + value.size))
+                self.size += value.size
+
+    def flatten(self, params: Dict[str, Any], out: np.ndarray | None = None) -> np.ndarray:
+        """
+        Flattens parameters dictionary to one vector
+        :param params: nested dict of np.ndarray with the same structure as template
+        :param out: optional float32 vector of size self.size, filled in place
+        :return: float32 vector
+        """
+        if out is None:
+            out = np.empty(self.size, dtype=np.float32)
+        for key_path, _, start, end in self.entries:
+            value = params
+            for key in key_path:
+                value = value[key]
+            out[start:end] = value.ravel()
+        return out
+
+    def unflatten(self, vector: np.ndarray) -> Dict[str, Any]:
+        """
+        Creates parameters dictionary from flat vector, arrays are C-contiguous float32 copies, so they can be passed to set_parameters
+        :param vector: vector of size self.size
+        :return: nested dict of np.ndarray
+        """
+        vector = np.array(vector, dtype=np.float32, copy=True)
+        params: Dict[str, Any] = {}
+        for key_path, shape, start, end in self.entries:
+            current = params
+            for key in key_path[:-1]:
+                current = current.setdefault(key, {})
+            current[key_path[-1]] = vector[start:end].reshape(shape)
+        return params
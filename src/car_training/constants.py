@@ -125,6 +125,8 @@ CONSTANTS_DICT = {
         # "new_individual_every_n_epochs": 2,
         "save_logs_every_n_epochs": 10,
         "max_threads": 0,
+        "split_environments": False,  # True - each environment of individual is separate task, helps when few long rollouts dominate generation
+        "checkpoint_every_n_epochs": 50,  # 0 - no checkpoints, they are saved in <logs_path>/<run>/checkpoints
         "logs_path": r"C:\Piotr\AIProjects\Evolutionary_Cars\logs",
     },
     "Differential_Evolution": {
@@ -135,6 +137,8 @@ CONSTANTS_DICT = {
         "diff_weight": 0.8,
         "save_logs_every_n_epochs": 50,
         "max_threads": 0,
+        "split_environments": False,  # True - each environment of individual is separate task, helps when few long rollouts dominate generation
+        "checkpoint_every_n_epochs": 50,  # 0 - no checkpoints, they are saved in <logs_path>/<run>/checkpoints
         "logs_path": r"C:\Piotr\AIProjects\Evolutionary_Cars\logs",
     },
     "Evolutionary_Mutate_Population": {
@@ -162,7 +166,9 @@ CONSTANTS_DICT = {
             },
         },
         "max_threads": 8,
+        "steady_state": False,  # True - no generation barrier, threads insert children into sorted population as soon as they are evaluated
         "save_logs_every_n_epochs": 50,
+        "checkpoint_every_n_epochs": 50,  # 0 - no checkpoints, they are saved in <logs_path>/<run>/checkpoints
         "logs_path": r"C:\Piotr\AIProjects\Evolutionary_Cars\logs",
     },
     "Evolutionary_Mutate_Population_Original": {
@@ -190,7 +196,9 @@ CONSTANTS_DICT = {
         "mutation_ratio_breed": 0.5,
         "mutation_ratio_mutate": 0.5,
         "max_threads": 8,
+        "steady_state": False,  # True - no generation barrier, threads insert children into sorted population as soon as they are evaluated
         "save_logs_every_n_epochs": 5,
+        "checkpoint_every_n_epochs": 50,  # 0 - no checkpoints, they are saved in <logs_path>/<run>/checkpoints
         "logs_path": r"C:\Piotr\AIProjects\Evolutionary_Cars\logs",
     },
     "Param_Les_Ev_Mut_Pop": {
@@ -215,12 +223,21 @@ CONSTANTS_DICT = {
         "epochs": 10000,
         "sigma_change": 0.01,
         "learning_rate": 0.1,
+        "mirrored_sampling": True,
+        "fitness_shaping": "centered_rank",  # "centered_rank", "z_score"
+        "engine": "streaming",  # "streaming" - only (seed, fitness) pairs kept in memory, "batched" - opt-in, faster, but holds noise and population matrices (permutations x parameters)
         "save_logs_every_n_epochs": 20,
         "max_threads": 0,
+        "split_environments": False,  # True - each environment of individual is separate task, helps when few long rollouts dominate generation
+        "checkpoint_every_n_epochs": 50,  # 0 - no checkpoints, they are saved in <logs_path>/<run>/checkpoints
         "logs_path": r"C:\Piotr\AIProjects\Evolutionary_Cars\logs",
     },
     "visualization": {
         "car_image_path": car_image_path,
         "map_image_path": map_image_path,
+        "preview_mode": "file",  # preview of the best individual: "file" - episode recorded in background and saved in logs, "viewer" - also played in separate process, "inline" - blocking pygame window, "none"
+    },
+    "metrics": {
+        "sink": "jsonl",  # per-generation metrics of all algorithms in <logs_path>/<run>/metrics.<sink>: "jsonl", "csv", "none" - disabled
     },
 }
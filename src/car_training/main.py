@@ -1,3 +1,5 @@
+import argparse
+
 from src.car_training.Evolutionary_Algorithms.Evolutionary_Strategies.Evolutionary_Mutate_Population import \
     Evolutionary_Mutate_Population
 from src.car_training.Evolutionary_Algorithms.Evolutionary_Strategies.Evolutionary_Mutate_Population_Original import \
@@ -5,10 +7,13 @@ from src.car_training.Evolutionary_Algorithms.Evolutionary_Strategies.Evolutiona
 from src.car_training.Evolutionary_Algorithms.Evolutionary_Strategies.Evolutionary_Strategy import Evolutionary_Strategy
 from src.car_training.Evolutionary_Algorithms.Genetic_Algorithm.Differential_Evolution import Differential_Evolution
 from src.car_training.Evolutionary_Algorithms.Genetic_Algorithm.Genetic_Algorithm import Genetic_Algorithm
+from src.car_training.Evolutionary_Algorithms.general_functions_provider import resume_policy_search
 from src.car_training.constants import CONSTANTS_DICT
 
 # run this script from terminal, be in directory Stock_Agent and paste:
 # python -m src.car_training.main.py
+# to continue interrupted run from its checkpoints:
+# python -m src.car_training.main --resume <logs_path>/<run>/checkpoints
 
 # spróbować SHADE Differential Evolution, uważać na upiększanie - oszukano na dekompozycji
 # Omidvar - dekompozycja w przestrzeniach ciągłych
@@ -43,13 +48,27 @@ from src.car_training.constants import CONSTANTS_DICT
 
 # spróbować
 
-# policy_search_algorithm = Differential_Evolution(CONSTANTS_DICT)
-# policy_search_algorithm = Evolutionary_Strategy(CONSTANTS_DICT)
-# policy_search_algorithm = Genetic_Algorithm(CONSTANTS_DICT)
-policy_search_algorithm = Evolutionary_Mutate_Population(CONSTANTS_DICT)
-# policy_search_algorithm = Evolutionary_Mutate_Population_Original(CONSTANTS_DICT)
-# policy_search_algorithm = Param_Les_Ev_Mut_Pop(CONSTANTS_DICT)
-# policy_search_algorithm = GESMR(CONSTANTS_DICT)
-policy_search_algorithm.run()
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", default=None, help="checkpoints directory of interrupted run")
+    args = parser.parse_args()
+
+    if args.resume is not None:
+        policy_search_algorithm = resume_policy_search(args.resume)
+    else:
+        # policy_search_algorithm = Differential_Evolution(CONSTANTS_DICT)
+        # policy_search_algorithm = Evolutionary_Strategy(CONSTANTS_DICT)
+        # policy_search_algorithm = Genetic_Algorithm(CONSTANTS_DICT)
+        policy_search_algorithm = Evolutionary_Mutate_Population(CONSTANTS_DICT)
+        # policy_search_algorithm = Evolutionary_Mutate_Population_Original(CONSTANTS_DICT)
+        # policy_search_algorithm = Param_Les_Ev_Mut_Pop(CONSTANTS_DICT)
+        # policy_search_algorithm = GESMR(CONSTANTS_DICT)
+    policy_search_algorithm.run()
+
+
+if __name__ == "__main__":
+    # argv is parsed only when run as script, so importing this module does not consume argv of caller
+    main()
 
 # run_basic_environment_visualization()
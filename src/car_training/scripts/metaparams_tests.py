@@ -1,8 +1,11 @@
+import argparse
 import copy
+import json
+import multiprocessing
 import os
 import time
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from typing import Dict, Any, List, Tuple
+from dataclasses import dataclass
+from typing import Dict, Any, List, Optional, Tuple
 
 from src.car_training.Evolutionary_Algorithms.Evolutionary_Strategies.Evolutionary_Mutate_Population import Evolutionary_Mutate_Population
 from src.car_training.Evolutionary_Algorithms.general_functions_provider import get_policy_search_class
@@ -11,13 +14,23 @@ from src.car_training.constants import CONSTANTS_DICT
 
 # run this script from terminal, be in directory Evolutionary_Cars and paste:
 # python -m src.car_training.scripts.metaparams_tests
+# to continue interrupted sweep (finished and stopped cases are skipped):
+# python -m src.car_training.scripts.metaparams_tests --save-dir logs/metaparameters_tests_1713343392
 
 POLICY_SEARCH_ALGORITHM = Evolutionary_Mutate_Population
 TESTS_TRIES = 3
-CONCURRENT_WORKERS = 1
+AVAILABLE_CORES = os.cpu_count()  # cases are started while sum of their max_threads fits in it
 MAX_EVALUATIONS = 100_000
 MAX_THREADS = 8
 SAVE_DIR = r"logs/metaparameters_tests_" + str(int(time.time()))
+POLL_SECONDS = 5.0
+
+# successive halving - when case reaches rung (number of evaluations), its best fitness is compared with other cases
+# of the same algorithm that reached this rung, if it is not in the best 1 / HALVING_ETA of them, case is stopped
+# decision is made only if at least HALVING_MIN_CASES cases reached the rung, empty list - no early stopping
+HALVING_RUNGS = [MAX_EVALUATIONS // 9, MAX_EVALUATIONS // 3]
+HALVING_ETA = 3
+HALVING_MIN_CASES = 3
 
 
 # everything should be in list - so it can be iterated, base level of dictionary should be list
@@ -218,46 +231,193 @@ def save_name(dict_to_use: Dict[str, Any], case_index: int) -> str:
     return "logs_" + dict_to_name(dict_to_use) + "__case" + str(case_index) + ".csv"
 
 
-def test_one_case(basic_dict: Dict[str, Any], special_dict: Dict[str, Any], case_index: int) -> None:
+def test_one_case(basic_dict: Dict[str, Any], special_dict: Dict[str, Any], case_index: int, save_dir: str = SAVE_DIR) -> None:
+    """
+    Runs one case, logs of algorithm (e.g. metrics.jsonl written every generation) are in save_dir/partial/<case name>,
+    csv with logs is written at the end, atomically, so its existence means that case is finished
+    :param basic_dict: constants_dict
+    :param special_dict: values changed in constants_dict
+    :param case_index: try number
+    :param save_dir: directory of sweep
+    :return:
+    """
     dict_copy = copy.deepcopy(basic_dict)
     change_dict_value(dict_copy, special_dict)
 
-    os.makedirs(SAVE_DIR, exist_ok=True)
-    saved_name = SAVE_DIR + r"/" + save_name(special_dict, case_index)
+    os.makedirs(save_dir, exist_ok=True)
+    saved_name = save_dir + r"/" + save_name(special_dict, case_index)
 
     method_name = list(special_dict)[0]
+    dict_copy[method_name]["logs_path"] = partial_logs_dir(save_dir, special_dict, case_index)
+    dict_copy["metrics"]["sink"] = "jsonl"  # used by successive halving
     searching_method = get_policy_search_class(method_name)(dict_copy)
     logs_df = searching_method.run()
 
-    logs_df.to_csv(saved_name, index=False, sep=",")
+    logs_df.to_csv(saved_name + ".tmp", index=False, sep=",")
+    os.replace(saved_name + ".tmp", saved_name)
+
+
+def partial_logs_dir(save_dir: str, special_dict: Dict[str, Any], case_index: int) -> str:
+    return os.path.join(save_dir, "partial", save_name(special_dict, case_index)[:-len(".csv")])
+
+
+def case_threads(basic_dict: Dict[str, Any], special_dict: Dict[str, Any]) -> int:
+    """
+    Returns number of threads declared by case (max_threads of its algorithm, <= 0 means all cores)
+    :param basic_dict: constants_dict
+    :param special_dict: values changed in constants_dict
+    :return:
+    """
+    method_name = list(special_dict)[0]
+    max_threads = special_dict[method_name].get("max_threads", basic_dict[method_name].get("max_threads", 1))
+    return os.cpu_count() if max_threads <= 0 else max_threads
+
+
+@dataclass
+class Sweep_Case:
+    special_dict: Dict[str, Any]
+    case_index: int
+    threads: int
+    name: str
+    process: Optional[multiprocessing.Process] = None
+    metrics_offset: int = 0  # bytes of metrics.jsonl already read
+    next_rung: int = 0
+    best_fitness: float = float("-inf")
+
+    @property
+    def method_name(self) -> str:
+        return list(self.special_dict)[0]
+
+
+class Sweep_Runner:
+    """
+    Runs all cases, each in its own process, packs them onto available_cores by their declared number of threads
+    (the biggest cases that fit are started first), skips cases finished or stopped in previous runs of the same save_dir
+    and stops cases that are clearly worse than others (successive halving, see HALVING_RUNGS)
+    """
+    def __init__(self, basic_dict: Dict[str, Any], save_dir: str, available_cores: int, rungs: List[int], eta: int, min_cases: int) -> None:
+        """
+        :param basic_dict: constants_dict
+        :param save_dir: csv files of finished cases, .stopped files of stopped cases, rungs.json and partial logs are saved here
+        :param available_cores: sum of threads of running cases does not exceed it
+        :param rungs: numbers of evaluations at which cases are compared
+        :param eta: only the best 1 / eta cases that reached rung are kept
+        :param min_cases: cases are not stopped at rung, until this number of cases reached it
+        """
+        self.basic_dict = basic_dict
+        self.save_dir = save_dir
+        self.available_cores = available_cores
+        self.rungs = rungs
+        self.eta = eta
+        self.min_cases = min_cases
+        os.makedirs(self.save_dir, exist_ok=True)
+        self.rung_results: Dict[str, Dict[str, Dict[str, float]]] = self._load_json("rungs.json", {})  # method -> rung -> case name -> fitness
+
+    def run(self, cases: List[Sweep_Case]) -> None:
+        """
+        Runs cases until all of them are finished or stopped
+        :param cases:
+        :return:
+        """
+        pending = [case for case in cases if not self._is_done(case)]
+        print(f"Cases: {len(cases)}, already done: {len(cases) - len(pending)}")
+        pending.sort(key=lambda case: case.threads, reverse=True)
+        running: List[Sweep_Case] = []
+
+        while pending or running:
+            for case in list(running):
+                self._read_metrics(case)
+                if not case.process.is_alive():
+                    case.process.join()
+                    running.remove(case)
+                    print(f"Finished {case.name}, exit code {case.process.exitcode}")
+                elif self._should_stop(case):
+                    case.process.terminate()
+                    case.process.join()
+                    running.remove(case)
+                    self._write_json(case.name + ".stopped", {"rung": self.rungs[case.next_rung - 1], "best_fitness": case.best_fitness})
+                    print(f"Stopped {case.name} at {self.rungs[case.next_rung - 1]} evaluations, best fitness {case.best_fitness}")
+
+            free_cores = self.available_cores - sum(case.threads for case in running)
+            for case in list(pending):
+                # case bigger than all cores is run alone
+                if case.threads <= free_cores or not running:
+                    case.process = multiprocessing.Process(target=test_one_case, args=(self.basic_dict, case.special_dict, case.case_index, self.save_dir))
+                    case.process.start()
+                    pending.remove(case)
+                    running.append(case)
+                    free_cores -= case.threads
+                    print(f"Started {case.name} ({case.threads} threads), running: {len(running)}, pending: {len(pending)}")
+            time.sleep(POLL_SECONDS)
+
+    def _is_done(self, case: Sweep_Case) -> bool:
+        return os.path.exists(os.path.join(self.save_dir, case.name)) or os.path.exists(os.path.join(self.save_dir, case.name + ".stopped"))
+
+    def _read_metrics(self, case: Sweep_Case) -> None:
+        """
+        Reads new rows of metrics.jsonl of case and records its best fitness at rungs it reached
+        """
+        logs_dir = partial_logs_dir(self.save_dir, case.special_dict, case.case_index)
+        runs = sorted(os.listdir(logs_dir)) if os.path.isdir(logs_dir) else []
+        metrics_path = os.path.join(logs_dir, runs[-1], "metrics.jsonl") if runs else None
+        if metrics_path is None or not os.path.exists(metrics_path):
+            return
+        with open(metrics_path, "rb") as file:
+            file.seek(case.metrics_offset)
+            lines = file.read().split(b"\n")
+        # the last element is empty or incomplete line, it is read again next time
+        case.metrics_offset += sum(len(line) + 1 for line in lines[:-1])
+        for line in lines[:-1]:
+            row = json.loads(line)
+            case.best_fitness = max(case.best_fitness, row["best_fitness"])
+            while case.next_rung < len(self.rungs) and row["total_evaluations"] >= self.rungs[case.next_rung]:
+                rung_cases = self.rung_results.setdefault(case.method_name, {}).setdefault(str(case.next_rung), {})
+                rung_cases[case.name] = case.best_fitness
+                case.next_rung += 1
+                self._write_json("rungs.json", self.rung_results)
+
+    def _should_stop(self, case: Sweep_Case) -> bool:
+        """
+        Case is stopped if at the last rung it reached, it is not in the best 1 / eta of cases of the same algorithm
+        """
+        if case.next_rung == 0:
+            return False
+        rung_cases = self.rung_results[case.method_name][str(case.next_rung - 1)]
+        if len(rung_cases) < self.min_cases:
+            return False
+        kept_number = max(len(rung_cases) // self.eta, 1)
+        kept_threshold = sorted(rung_cases.values(), reverse=True)[kept_number - 1]
+        return rung_cases[case.name] < kept_threshold
+
+    def _load_json(self, file_name: str, default: Any) -> Any:
+        file_path = os.path.join(self.save_dir, file_name)
+        if not os.path.exists(file_path):
+            return default
+        with open(file_path, "r") as file:
+            return json.load(file)
+
+    def _write_json(self, file_name: str, data: Any) -> None:
+        file_path = os.path.join(self.save_dir, file_name)
+        with open(file_path + ".tmp", "w") as file:
+            json.dump(data, file, indent=1)
+        os.replace(file_path + ".tmp", file_path)
 
 
 if __name__ == "__main__":
-    possible_dicts = create_all_special_dicts(TESTED_VALUES)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--save-dir", default=SAVE_DIR, help="directory of sweep, existing one is continued")
+    args = parser.parse_args()
 
-    futures = []
+    possible_dicts = create_all_special_dicts(TESTED_VALUES)
+    all_cases = [
+        Sweep_Case(special_dict, i, case_threads(CONSTANTS_DICT, special_dict), save_name(special_dict, i))
+        for special_dict in possible_dicts
+        for i in range(TESTS_TRIES)
+    ]
+    runner = Sweep_Runner(CONSTANTS_DICT, args.save_dir, AVAILABLE_CORES, HALVING_RUNGS, HALVING_ETA, HALVING_MIN_CASES)
     try:
-        with ProcessPoolExecutor(max_workers=CONCURRENT_WORKERS) as executor:
-            # Submit all the tasks to the executor
-            for special_dict in possible_dicts:
-                for i in range(TESTS_TRIES):
-                    # Submitting the task to be executed in parallel
-                    future = executor.submit(test_one_case, CONSTANTS_DICT, special_dict, i)
-                    futures.append(future)
-
-            # Process the results as they are completed
-            for future in as_completed(futures):
-                try:
-                    result = future.result()
-                    print(result)
-                except Exception as e:
-                    print(f"Error occurred in future: {e}")
-
-    except Exception as e:
-        print(f"Error occurred while executing the tasks: {e}")
-
+        runner.run(all_cases)
     finally:
-        # Cleanup if needed
         print("Processing complete.")
 
     # for special_dict in possible_dicts:
@@ -10,7 +10,12 @@ np.random.seed(int(time.time() * 1000) % 2**32)
 
 AI_MODES = Literal["easy", "medium", "hard"]
 NEURAL_NETWORKS_DIR = Path("networks")
+MODEL_STORE_DIR = NEURAL_NETWORKS_DIR / "store"  # built from NEURAL_NETWORKS_DIR/*.pkl, see model_store.py
 IMAGES_DIR = Path("images")
+MAPS_CACHE_DIR = IMAGES_DIR / "cache"  # collision maps processed from bounding maps, see map_loader.py
+REPLAYS_DIR = Path("replays")
+RECORD_GAMES = False  # True - each game is saved in REPLAYS_DIR, it can be watched from main menu
+MAX_REPLAYS = 20  # when more replays are saved, the oldest ones are removed
 
 PLAYER_CAR_CHANGEABLE_INIT = {
     "max_speed": 10.0,
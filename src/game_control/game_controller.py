@@ -1,33 +1,70 @@
 import dataclasses
-import pickle
 import random
+import time
 from abc import abstractmethod
 from pathlib import Path
 from typing import Literal, Any
 
 import numpy as np
-from PIL import Image
-
+from src.car_simulator.input_state import InputState
 from src.car_simulator.car_python import CarWrapper, Line, CarAIWrapper, CarPlayerWrapper, \
-    GameSimulation
+    GameSimulation, ReplaySimulation
+from src.car_training.Environments_Visualization.Episode_Recorder import load_episode
+from src.car_training.Neural_Network.Raw_Numpy.Raw_Numpy_Models.Normal.Normal_model import Normal_model
 from src.game_control.constants import AI_STRUCTURE, PLAYER_CAR_CHANGEABLE_INIT, CARS, MAPS, \
-    AI_CAR_CHANGEABLE_INIT, MAX_AI_CARS, FPS, DEFAULT_SECONDS, NEURAL_NETWORKS_DIR, AI_MODES
+    AI_CAR_CHANGEABLE_INIT, MAX_AI_CARS, FPS, DEFAULT_SECONDS, AI_MODES, REPLAYS_DIR, RECORD_GAMES, \
+    MAX_REPLAYS
+from src.game_control.map_loader import CollisionMap, load_collision_map
+from src.game_control.model_store import ModelStore, ModelEntry
 
 class ModelAISelector:
     def __init__(self):
-        # open all models from NEURAL_NETWORKS_DIR
-        models_dirs = NEURAL_NETWORKS_DIR.glob("*.pkl")
-        self.models = []
-        for model_dir in models_dirs:
-            with open(model_dir, "rb") as f:
-                self.models.append(pickle.load(f))
-
-    def find_fittest_model(self, max_speed: float, acceleration: float, width: int, height: int, turn_speed: float) -> dict[str, Any]:
-        sorted_models = sorted(self.models, key=lambda x: self._mark_model(x, max_speed, acceleration, width, height, turn_speed), reverse=True)
-        return sorted_models[0]["neural_network_params"]
-
-    def _mark_model(self, model, max_speed: float, acceleration: float, width: int, height: int, turn_speed: float):
-        model_kwargs = model["universal_kwargs"]
+        # only index of models is read, weights of chosen model are memory-mapped when it is needed
+        self.model_store = ModelStore()
+        self.models = self.model_store.entries
+
+        # models with the same (car_dimensions, max_speed, speed_change, angle_max_change) get the same mark,
+        # so only the fittest one of each such group can be chosen
+        self.models_by_key: dict[tuple, ModelEntry] = {}
+        for model in self.models:
+            key = self._model_key(model)
+            if key not in self.models_by_key or self._fitness(model) > self._fitness(self.models_by_key[key]):
+                self.models_by_key[key] = model
+        self._chosen_models: dict[tuple, Normal_model] = {}
+        self._loaded_models: dict[str, Normal_model] = {}
+
+    def find_fittest_model(self, max_speed: float, acceleration: float, width: int, height: int, turn_speed: float) -> Normal_model:
+        """
+        Each stored model is loaded only once, cars that get the same model share one Normal_model,
+        so GameSimulation can evaluate them in one batched forward pass
+        :return: model with parameters of the fittest matching network
+        """
+        query = ((width, height), max_speed, acceleration, turn_speed)
+        if query not in self._chosen_models:
+            best_model = self.models_by_key.get(query)  # exact match has the highest possible mark
+            if best_model is None:
+                best_model = max(
+                    self.models_by_key.values(),
+                    key=lambda x: (self._mark_model(x, max_speed, acceleration, width, height, turn_speed), self._fitness(x))
+                )
+            if best_model.name not in self._loaded_models:
+                model = Normal_model(**AI_STRUCTURE["neural_network"])
+                model.set_parameters(self.model_store.load_params(best_model))
+                self._loaded_models[best_model.name] = model
+            self._chosen_models[query] = self._loaded_models[best_model.name]
+        return self._chosen_models[query]
+
+    @staticmethod
+    def _model_key(model: ModelEntry) -> tuple:
+        model_kwargs = model.universal_kwargs
+        return model_kwargs["car_dimensions"], model_kwargs["max_speed"], model_kwargs["speed_change"], model_kwargs["angle_max_change"]
+
+    @staticmethod
+    def _fitness(model: ModelEntry) -> float:
+        return model.fitness if model.fitness is not None else -np.inf
+
+    def _mark_model(self, model: ModelEntry, max_speed: float, acceleration: float, width: int, height: int, turn_speed: float):
+        model_kwargs = model.universal_kwargs
         rank = 0
         if model_kwargs["car_dimensions"] == (width, height):
             rank += 10
@@ -76,7 +113,7 @@ class CarDataHolder:
     #     self.height = min(max(height, CAR_CHANGEABLE_RANGE["height"][0]), CAR_CHANGEABLE_RANGE["height"][1])
 
     @abstractmethod
-    def create_car_wrapper(self, x: float, y: float, start_angle: float, map_view: np.ndarray, end_line: Line, false_end_line: Line, start_before_end_line: bool, max_laps: int) -> CarWrapper:
+    def create_car_wrapper(self, x: float, y: float, start_angle: float, collision_map: CollisionMap, end_line: Line, false_end_line: Line, start_before_end_line: bool, max_laps: int) -> CarWrapper:
         pass
 
     def load_dict(self, data: dict[str, Any]):
@@ -93,9 +130,10 @@ class CarDataHolder:
 @dataclasses.dataclass
 class CarPlayerDataHolder(CarDataHolder):
 
-    def __init__(self, name: str, image: Path):
+    def __init__(self, name: str, image: Path, input_state: InputState):
         self.name = name
         self.image = image
+        self.input_state = input_state
         self.max_speed = PLAYER_CAR_CHANGEABLE_INIT["max_speed"]
         self.min_speed = PLAYER_CAR_CHANGEABLE_INIT["min_speed"]
         self.acceleration = PLAYER_CAR_CHANGEABLE_INIT["acceleration"]
@@ -103,7 +141,7 @@ class CarPlayerDataHolder(CarDataHolder):
         self.inactive_steps = PLAYER_CAR_CHANGEABLE_INIT["inactive_steps"]
         self.width, self.height = PLAYER_CAR_CHANGEABLE_INIT["width_height"]
 
-    def create_car_wrapper(self, x: float, y: float, start_angle: float, map_view: np.ndarray, end_line: Line, false_end_line: Line, start_before_end_line: bool, max_laps: int) -> CarPlayerWrapper:
+    def create_car_wrapper(self, x: float, y: float, start_angle: float, collision_map: CollisionMap, end_line: Line, false_end_line: Line, start_before_end_line: bool, max_laps: int) -> CarPlayerWrapper:
         car_init_data = {
             "x": x,
             "y": y,
@@ -113,7 +151,9 @@ class CarPlayerDataHolder(CarDataHolder):
             "acceleration": self.acceleration,
             "turn_speed": self.turn_speed,
             "inactive_steps": self.inactive_steps,
-            "map_view": map_view,
+            "map_view": collision_map.map_view,
+            "wall_normals": collision_map.wall_normals,
+            "coarse_map": collision_map.coarse_map,
             "width": self.width,
             "height": self.height,
             "rays_distances_scale_factor": 1.0,
@@ -122,6 +162,7 @@ class CarPlayerDataHolder(CarDataHolder):
         }
 
         return CarPlayerWrapper(
+            input_state=self.input_state,
             car_init_data=car_init_data,
             end_line=end_line,
             false_end_line=false_end_line,
@@ -160,7 +201,7 @@ class CarAIDataHolder(CarDataHolder):
         self.active = data["active"]
         self.mode = data["mode"]
 
-    def create_car_wrapper(self, x: float, y: float, start_angle: float, map_view: np.ndarray, end_line: Line, false_end_line: Line, start_before_end_line: bool, max_laps: int) -> CarAIWrapper:
+    def create_car_wrapper(self, x: float, y: float, start_angle: float, collision_map: CollisionMap, end_line: Line, false_end_line: Line, start_before_end_line: bool, max_laps: int) -> CarAIWrapper:
         car_init_data = {
             "x": x,
             "y": y,
@@ -170,7 +211,9 @@ class CarAIDataHolder(CarDataHolder):
             "acceleration": self.acceleration,
             "turn_speed": self.turn_speed,
             "inactive_steps": self.inactive_steps,
-            "map_view": map_view,
+            "map_view": collision_map.map_view,
+            "wall_normals": collision_map.wall_normals,
+            "coarse_map": collision_map.coarse_map,
             "width": self.width,
             "height": self.height,
             "rays_distances_scale_factor": AI_STRUCTURE["rays_distances_scale_factor"],
@@ -178,7 +221,7 @@ class CarAIDataHolder(CarDataHolder):
             "rays_degrees": AI_STRUCTURE["rays_degrees"],
         }
 
-        nn_params = self.model_selector.find_fittest_model(
+        model = self.model_selector.find_fittest_model(
             max_speed=self.max_speed,
             acceleration=self.acceleration,
             width=self.width,
@@ -197,8 +240,7 @@ class CarAIDataHolder(CarDataHolder):
 
 
         return CarAIWrapper(
-            neural_network_structure=AI_STRUCTURE["neural_network"],
-            neural_network_params=nn_params,
+            model=model,
             random_action_prob=random_action_prob,
             car_init_data=car_init_data,
             end_line=end_line,
@@ -220,13 +262,15 @@ class GameController:
     def __init__(self):
         self.model_ai_selector = ModelAISelector()
 
-        self.player = CarPlayerDataHolder("Player", CARS[0])
+        self.input_state = InputState()  # fed by key events of GUI
+        self.player = CarPlayerDataHolder("Player", CARS[0], self.input_state)
         self.ai_players = [
             CarAIDataHolder(f"AI {i}", CARS[i % len(CARS)], self.model_ai_selector) for i in range(1, MAX_AI_CARS + 1)
         ]
         self.selected_map = 0
         self.map_laps = 3 if MAPS[self.selected_map]["start_before_end_line"] else 1
         self.map_max_timesteps = DEFAULT_SECONDS * FPS
+        self._maps_cache: dict[int, CollisionMap] = {}
 
     # def save_state(self):
     #     state = {
@@ -252,9 +296,21 @@ class GameController:
     def get_map_image(self) -> Path:
         return MAPS[self.selected_map]["image"]
 
-    def create_game_simulation(self) -> GameSimulation:
-        img = Image.open(MAPS[self.selected_map]["bounding_map"]).convert('L')  # 'L' stands for luminance
-        map_view = np.array(np.array(img) / 255, dtype=np.bool_)
+    def _load_map(self) -> CollisionMap:
+        """
+        Collision map is loaded once per map (from disk cache if possible), all cars of all games on the map share it
+        :return:
+        """
+        if self.selected_map not in self._maps_cache:
+            self._maps_cache[self.selected_map] = load_collision_map(MAPS[self.selected_map]["bounding_map"])
+        return self._maps_cache[self.selected_map]
+
+    def create_game_simulation(self, include_player: bool = True) -> GameSimulation:
+        """
+        :param include_player: False - race of AI cars only, e.g. for GameSimulation.run_until_finished(), it is not recorded
+        :return:
+        """
+        collision_map = self._load_map()
         map_data_tmp = MAPS[self.selected_map]
         x = map_data_tmp["x"]
         y = map_data_tmp["y"]
@@ -268,7 +324,7 @@ class GameController:
                 x=x,
                 y=y,
                 start_angle=start_angle,
-                map_view=map_view,
+                collision_map=collision_map,
                 end_line=end_line,
                 false_end_line=false_end_line,
                 start_before_end_line=start_before_end_line,
@@ -281,17 +337,44 @@ class GameController:
                 x=x,
                 y=y,
                 start_angle=start_angle,
-                map_view=map_view,
+                collision_map=collision_map,
                 end_line=end_line,
                 false_end_line=false_end_line,
                 start_before_end_line=start_before_end_line,
                 max_laps=self.map_laps
             )
-        ]
+        ] if include_player else []
 
-        return GameSimulation(
+        simulation = GameSimulation(
             cars_ai=cars_ai,
             cars_players=players,
             max_timesteps=self.map_max_timesteps
         )
+        if RECORD_GAMES and include_player:
+            simulation.start_recording({"map": self.selected_map, "start_time": int(time.time())})
+        return simulation
+
+    def save_replay(self, simulation: GameSimulation) -> None:
+        """
+        Saves recorded game, game saved again (e.g. after resume) overwrites its previous file,
+        only MAX_REPLAYS newest replays are kept
+        :param simulation:
+        :return:
+        """
+        if simulation.recorder is not None:
+            metadata = simulation.recorder.metadata
+            simulation.save_recording(str(REPLAYS_DIR / f"replay_{metadata['start_time']}_{MAPS[metadata['map']]['name'].replace(' ', '_')}.npz"))
+            replays = sorted(REPLAYS_DIR.glob("replay_*.npz"), key=lambda path: path.stat().st_mtime_ns, reverse=True)
+            for old_replay in replays[MAX_REPLAYS:]:
+                old_replay.unlink()
+
+    def create_replay_simulation(self, file_path: Path, speed: float = 1.0) -> tuple[ReplaySimulation, Path]:
+        """
+        Loads recorded game
+        :param file_path: file saved by save_replay
+        :param speed: recorded steps per step of replay
+        :return: replay simulation and map image
+        """
+        episode = load_episode(str(file_path))
+        return ReplaySimulation(episode, speed), MAPS[episode.metadata["map"]]["image"]
 
@@ -0,0 +1,95 @@
+import hashlib
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from src.car_training.Environments.Car_Physics.Car_Physics import compute_wall_normals, compute_coarse_map
+from src.game_control.constants import MAPS_CACHE_DIR
+
+CACHE_VERSION = 1  # change when format or computation of any level changes, old cache files are then rebuilt
+
+
+@dataclass
+class CollisionMap:
+    """
+    Levels of one map, shared by all cars on it
+    """
+    map_view: np.ndarray  # uint8 (rows, cols), 1 is wall, fine level checked by rays and collisions
+    coarse_map: np.ndarray  # uint8, see compute_coarse_map, rays skip its empty cells
+    wall_normals: np.ndarray  # uint8, see compute_wall_normals
+
+
+def load_collision_map(image_path: Path, cache_dir: Path = MAPS_CACHE_DIR) -> CollisionMap:
+    """
+    Loads collision map from cache_dir, if it is missing or the image changed, it is computed and saved there.
+    In cache map_view is bit-packed, so it is read much faster than the png is decoded.
+    :param image_path: bounding map, black is free space, anything else is wall
+    :param cache_dir:
+    :return:
+    """
+    image_path = Path(image_path).resolve()
+    # maps with the same name in different directories get different files
+    path_hash = hashlib.sha1(str(image_path).encode("utf-8")).hexdigest()[:12]
+    cache_path = Path(cache_dir) / f"{image_path.stem}_{path_hash}.npz"
+    source_stat = image_path.stat()
+    source_key = np.array([CACHE_VERSION, source_stat.st_mtime_ns, source_stat.st_size], dtype=np.int64)
+
+    collision_map = _read_cache(cache_path, source_key)
+    if collision_map is None:
+        map_view = load_map_view(image_path)
+        collision_map = CollisionMap(
+            map_view=map_view,
+            coarse_map=compute_coarse_map(map_view),
+            wall_normals=compute_wall_normals(map_view),
+        )
+        _write_cache(cache_path, source_key, collision_map)
+    return collision_map
+
+
+def load_map_view(image_path: Path) -> np.ndarray:
+    """
+    Image is thresholded by PIL while it is still 8-bit, so no float or bool copy of the whole map is created
+    :param image_path:
+    :return: uint8 (rows, cols), 1 is wall
+    """
+    with Image.open(image_path) as img:
+        walls = img.convert('L').point(lambda value: 1 if value else 0)  # 'L' stands for luminance
+    return np.array(walls)
+
+
+def _read_cache(cache_path: Path, source_key: np.ndarray) -> CollisionMap | None:
+    try:
+        with np.load(cache_path) as cache:
+            if not np.array_equal(cache["source_key"], source_key):
+                return None
+            rows, cols = cache["shape"]
+            map_view = np.unpackbits(cache["map_view"], count=rows * cols).reshape(rows, cols)
+            return CollisionMap(map_view=map_view, coarse_map=cache["coarse_map"], wall_normals=cache["wall_normals"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _write_cache(cache_path: Path, source_key: np.ndarray, collision_map: CollisionMap) -> None:
+    os.makedirs(cache_path.parent, exist_ok=True)
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    with open(tmp_path, "wb") as file:
+        np.savez(
+            file,
+            source_key=source_key,
+            shape=np.array(collision_map.map_view.shape, dtype=np.int64),
+            map_view=np.packbits(collision_map.map_view),
+            coarse_map=collision_map.coarse_map,
+            wall_normals=collision_map.wall_normals,
+        )
+    os.replace(tmp_path, cache_path)
+
+
+if __name__ == "__main__":
+    # builds cache of all maps, e.g. before first game: python -m src.game_control.map_loader
+    from src.game_control.constants import MAPS
+    for map_data in MAPS:
+        collision_map = load_collision_map(map_data["bounding_map"])
+        print(f"{map_data['name']}: {collision_map.map_view.shape[1]}x{collision_map.map_view.shape[0]}")
@@ -0,0 +1,139 @@
+import json
+import os
+import pickle
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from src.car_training.Neural_Network.Raw_Numpy.Parameters_Layout import Parameters_Layout
+from src.game_control.constants import NEURAL_NETWORKS_DIR, MODEL_STORE_DIR
+
+INDEX_FILE_NAME = "index.json"
+INDEX_VERSION = 1
+FITNESS_PATTERN = re.compile(r"_f(-?\d+(?:\.\d+)?)$")  # e.g. best_individual_gen11_1717165997_f-556.0
+
+
+@dataclass
+class ModelEntry:
+    name: str
+    weights_file: str
+    fitness: float | None
+    universal_kwargs: dict[str, Any]
+    layout: list[tuple[tuple[str, ...], tuple[int, ...], int, int]]  # key path, shape, start, end - as Parameters_Layout.entries
+
+
+class ModelStore:
+    """
+    Compact store of trained networks: weights of each model are one flat float32 .npy file, metadata of all models
+    (universal_kwargs, fitness, layout of weights) is in one index, so opening the store does not read any weights.
+    Weights of chosen model are memory-mapped on demand.
+    Store is built from pickled models in NEURAL_NETWORKS_DIR, only new or changed .pkl files are converted.
+    """
+    def __init__(self, networks_dir: Path = NEURAL_NETWORKS_DIR, store_dir: Path = MODEL_STORE_DIR):
+        self.networks_dir = Path(networks_dir)
+        self.store_dir = Path(store_dir)
+        self.entries: list[ModelEntry] = []
+        self._load_or_update_index()
+
+    def load_params(self, entry: ModelEntry) -> dict[str, Any]:
+        """
+        Memory-maps weights of model, arrays are copy-on-write views of the file, so they can be passed to set_parameters
+        :param entry: one of self.entries
+        :return: nested dict of np.ndarray, the same as neural_network_params of pickled model
+        """
+        vector = np.load(self.store_dir / entry.weights_file, mmap_mode="c")
+        params: dict[str, Any] = {}
+        for key_path, shape, start, end in entry.layout:
+            current = params
+            for key in key_path[:-1]:
+                current = current.setdefault(key, {})
+            current[key_path[-1]] = vector[start:end].reshape(shape)
+        return params
+
+    def _load_or_update_index(self) -> None:
+        sources = {path.name: path.stat().st_mtime_ns for path in self.networks_dir.glob("*.pkl")}
+        index = self._read_index()
+        if index is not None and index["sources"] == sources:
+            self.entries = [_entry_from_json(entry_json) for entry_json in index["models"]]
+            return
+
+        old_entries = {}
+        if index is not None:
+            old_entries = {
+                entry_json["name"]: entry_json for entry_json in index["models"]
+                if index["sources"].get(entry_json["name"] + ".pkl") == sources.get(entry_json["name"] + ".pkl")
+            }
+        os.makedirs(self.store_dir, exist_ok=True)
+        models_json = []
+        for source_name in sorted(sources):
+            name = source_name[:-len(".pkl")]
+            if name in old_entries and (self.store_dir / old_entries[name]["weights_file"]).exists():
+                models_json.append(old_entries[name])
+            else:
+                models_json.append(self._convert_model(name))
+
+        self._remove_stale_weights({model_json["weights_file"] for model_json in models_json})
+        self._write_index({"version": INDEX_VERSION, "sources": sources, "models": models_json})
+        self.entries = [_entry_from_json(entry_json) for entry_json in models_json]
+
+    def _convert_model(self, name: str) -> dict[str, Any]:
+        with open(self.networks_dir / (name + ".pkl"), "rb") as file:
+            model = pickle.load(file)
+        layout = Parameters_Layout(model["neural_network_params"])
+        weights_file = name + ".npy"
+        tmp_path = self.store_dir / (weights_file + ".tmp")
+        with open(tmp_path, "wb") as file:
+            np.save(file, layout.flatten(model["neural_network_params"]))
+        os.replace(tmp_path, self.store_dir / weights_file)
+
+        fitness_match = FITNESS_PATTERN.search(name)
+        return {
+            "name": name,
+            "weights_file": weights_file,
+            "fitness": float(fitness_match.group(1)) if fitness_match else None,
+            "universal_kwargs": model["universal_kwargs"],
+            "layout": [[list(key_path), list(shape), start, end] for key_path, shape, start, end in layout.entries],
+        }
+
+    def _read_index(self) -> dict[str, Any] | None:
+        try:
+            with open(self.store_dir / INDEX_FILE_NAME, "r") as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            return None
+        return index if index.get("version") == INDEX_VERSION else None
+
+    def _write_index(self, index: dict[str, Any]) -> None:
+        tmp_path = self.store_dir / (INDEX_FILE_NAME + ".tmp")
+        with open(tmp_path, "w") as file:
+            json.dump(index, file, indent=1)
+        os.replace(tmp_path, self.store_dir / INDEX_FILE_NAME)
+
+    def _remove_stale_weights(self, weights_files: set[str]) -> None:
+        for path in self.store_dir.glob("*.npy"):
+            if path.name not in weights_files:
+                path.unlink()
+
+
+def _entry_from_json(entry_json: dict[str, Any]) -> ModelEntry:
+    # json has no tuples, but e.g. car_dimensions are compared with tuples
+    universal_kwargs = {
+        key: tuple(value) if isinstance(value, list) else value
+        for key, value in entry_json["universal_kwargs"].items()
+    }
+    return ModelEntry(
+        name=entry_json["name"],
+        weights_file=entry_json["weights_file"],
+        fitness=entry_json["fitness"],
+        universal_kwargs=universal_kwargs,
+        layout=[(tuple(key_path), tuple(shape), start, end) for key_path, shape, start, end in entry_json["layout"]],
+    )
+
+
+if __name__ == "__main__":
+    # builds or updates store, e.g. after adding new networks: python -m src.game_control.model_store
+    store = ModelStore()
+    print(f"{len(store.entries)} models in {store.store_dir}")
@@ -0,0 +1,128 @@
+import dataclasses
+import math
+import threading
+import time
+
+from src.car_simulator.car_cython import CarDrawInfo
+from src.car_simulator.car_python import GameSimulation, ReplaySimulation
+from src.game_control.constants import FPS
+
+MAX_CATCH_UP_STEPS = 5  # if simulation is more steps behind, the rest of lag is dropped (game slows down instead of freezing)
+
+
+@dataclasses.dataclass(frozen=True)
+class SimulationSnapshot:
+    """
+    Immutable state of simulation after one step, draw infos are new objects created in each step, so they are not changed later
+    """
+    timestep: int
+    cars: tuple[CarDrawInfo, ...]
+    previous_cars: tuple[CarDrawInfo, ...]
+    player_laps: tuple[int, ...]
+    step_time: float  # time.perf_counter() to which this step belongs, used for interpolation
+    finished: bool
+
+    def interpolated_cars(self, now: float, step_seconds: float = 1 / FPS) -> list[CarDrawInfo]:
+        """
+        Interpolates between previous and current step, so cars move smoothly at any frame rate
+        (drawn state is at most one step behind simulation)
+        :param now: time.perf_counter()
+        :param step_seconds: duration of one simulation step
+        :return: draw infos of cars
+        """
+        alpha = min(max((now - self.step_time) / step_seconds, 0.0), 1.0)
+        if alpha == 1.0:
+            return list(self.cars)
+        return [
+            CarDrawInfo(
+                previous.x + (current.x - previous.x) * alpha,
+                previous.y + (current.y - previous.y) * alpha,
+                previous.angle_radians + _angle_difference(current.angle_radians, previous.angle_radians) * alpha,
+                current.width,
+                current.height,
+                current.inactive_ratio,
+            )
+            for previous, current in zip(self.previous_cars, self.cars)
+        ]
+
+
+class SimulationRunner:
+    """
+    Runs simulation in its own thread with fixed timestep (FPS steps per second of real time), independently of drawing.
+    After each step new SimulationSnapshot is published (reference is replaced, which is atomic), GUI only reads it.
+    Thread stops when simulation is finished or stop() is called, new runner can continue the same simulation.
+    """
+    def __init__(self, simulation: GameSimulation | ReplaySimulation, cars: list, steps_per_second: float = FPS):
+        """
+        :param simulation: it should not be used by other threads while runner is running
+        :param cars: cars in order of snapshot, the last one is the player
+        :param steps_per_second:
+        """
+        self.simulation = simulation
+        self.cars = cars
+        self.step_seconds = 1 / steps_per_second
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._error: BaseException | None = None
+        cars_info = tuple(car.get_car_draw_info() for car in cars)
+        self._snapshot = self._create_snapshot(cars_info, cars_info, time.perf_counter())
+
+    @property
+    def snapshot(self) -> SimulationSnapshot:
+        if self._error is not None:
+            raise self._error
+        return self._snapshot
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops thread and waits for it, so simulation can be used afterwards, e.g. saved
+        :return:
+        """
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self) -> None:
+        try:
+            previous_time = time.perf_counter()
+            accumulator = 0.0
+            while not self._stop_event.is_set():
+                now = time.perf_counter()
+                accumulator += now - previous_time
+                previous_time = now
+
+                steps = 0
+                while accumulator >= self.step_seconds:
+                    if self.simulation.is_finished():
+                        self._snapshot = dataclasses.replace(self._snapshot, finished=True)
+                        return
+                    self.simulation.step()
+                    accumulator -= self.step_seconds
+                    steps += 1
+                    self._snapshot = self._create_snapshot(
+                        self._snapshot.cars, tuple(car.get_car_draw_info() for car in self.cars), time.perf_counter() - accumulator
+                    )
+                    if steps >= MAX_CATCH_UP_STEPS:
+                        accumulator = 0.0
+                        break
+                self._stop_event.wait(self.step_seconds - accumulator)
+        except BaseException as error:
+            self._error = error
+
+    def _create_snapshot(self, previous_cars: tuple[CarDrawInfo, ...], cars: tuple[CarDrawInfo, ...], step_time: float) -> SimulationSnapshot:
+        return SimulationSnapshot(
+            timestep=self.simulation.current_timestep,
+            cars=cars,
+            previous_cars=previous_cars,
+            player_laps=tuple(self.cars[-1].get_laps()),
+            step_time=step_time,
+            finished=False,
+        )
+
+
+def _angle_difference(angle: float, previous_angle: float) -> float:
+    # the shortest way, so car does not spin when angle wraps around
+    return (angle - previous_angle + math.pi) % (2 * math.pi) - math.pi